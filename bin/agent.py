@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # Agent Listener - Listens on a TCP/IP socket for commands to execute
 
@@ -11,6 +11,32 @@ via command line options/arguments (see the usage function). Once the TCP
 listener has started, it will accept message from a TCP clients and act as
 directed by the message from the client(s).
 
+Each client connection (session) is served on its own worker thread, so many
+controllers can talk to the same agent at once and a slow OS command only
+holds up the session that sent it. The number of concurrent sessions is
+capped by the --max-sessions option. Once the cap is reached a new client is
+told straight away that the agent is busy and when to retry, and is then
+disconnected (--busy=reject, the default):
+
+   tcp recv from agent :    {AGENT_RETURN_CODE:203, AGENT_MESSAGE:"BUSY, RETRY AFTER 250 MS",
+                             RETRY_AFTER_MS:250}
+
+With --busy=queue new clients wait in the listen backlog (--backlog) until a
+session ends instead. The cap is on sessions, not on requests: a session's
+multiplexed requests (at most TA:multiplex=N at once) and the OS,async jobs
+it started (at most MAX_JOBS across the agent) do not take more slots, and
+jobs keep running after the session that started them has ended.
+
+Sessions that send nothing for --idle seconds are ended so an abandoned
+controller cannot pin a session slot, and TCP keepalive (--keepalive)
+notices peers that vanished without closing the connection.
+
+Sessions are torn down without fixed pauses. After TA:bye the agent sends its
+reply, half-closes the connection and closes it as soon as the client does.
+On TA:shutdown the agent stops accepting at once, ends idle sessions, lets
+sessions that are running a command finish it (up to the --drain deadline)
+and then exits.
+
 Message received by the Agent via TCP should be of the form:
 
    DIRECTIVE:COMMAND
@@ -20,6 +46,10 @@ Valid directives are:
    TA - Used for commands that control/query the test agent itself
    OS - Used for commands intended to be executed on the operating system
         on which the Agent is running.
+   BATCH - Runs a list of OS commands in one request (see below).
+   GET   - Sends a file from the agent host to the client (see FILE TRANSFER).
+   PUT   - Receives a file from the client onto the agent host.
+   JOB   - Queries and controls OS,async jobs (see ASYNCHRONOUS JOBS).
 
 Valid TA Commands are:
 
@@ -31,7 +61,44 @@ Valid TA Commands are:
    setname     - Sets the name of the  Agent
    getusername - Gets the name of the user that the Agent is running as
    shutdown    - Shuts down the agent
+   restart     - Hands the listening socket to a freshly started agent and
+                 exits once in-flight sessions finish (restart=force also
+                 cancels running jobs)
    localtime   - Get the localtime of server that the Agent is running on
+   protocol    - Gets or sets (protocol=1|2) the session wire protocol
+   format      - Gets or sets (format=text|json) the session reply format
+   compress    - Gets or sets (compress=on|off|BYTES) zlib compressed replies
+   shell       - Gets or sets (shell=on|off) the session's persistent shell
+   multiplex   - Gets or sets (multiplex=on|off|N) concurrent tagged requests
+   ping[=DATA] - Replies PONG at once, echoing DATA under AGENT_DATA (used by
+                 bin/calibrate_latency.py to measure the network round trip)
+
+Telemetry TA commands read /proc directly (Linux), without starting any
+process, and return their results under an extra AGENT_DATA key:
+
+   proc=NAME|PID - CPU, memory, thread and fd figures for matching processes
+   fds=PID       - Number of open file descriptors of a process
+   sockets[=PORT]- Count of TCP sockets by state, optionally for one local port
+   loadavg       - Load averages and run queue
+
+   cache         - OS result cache counters (see OS,cache below)
+   cache=clear   - Empties the OS result cache
+   uncache=CMD   - Drops the cached results of one OS command
+
+   stats         - Agent load counters and latencies (see AGENT STATISTICS)
+   stats=reset   - Zeroes the counters and latency histograms
+
+   --- Sample a process
+   tcp send from client:    TA:proc=broken-hashserve_darwin
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"PROC 1",
+                             AGENT_DATA:[{"pid": 4242, "name": "broken-hashserve_darwin",
+                                          "state": "S", "threads": 9, "fds": 14,
+                                          "rss_bytes": 8871936, "cpu_seconds": 1.27,
+                                          "cpu_percent": 12.5}]}
+
+cpu_percent is measured since the previous TA:proc sample of that process on
+the same session (since the process started, on the first sample), so a
+client polling at a fixed rate gets the CPU use over each interval.
 
 All TA directives return a Python dictionary of two key-value pairs.
 The first key-value pair is:
@@ -71,7 +138,16 @@ Agent Return Codes:
      0 - Successful execution of command
    200 - Unknown Directive
    201 - Unknown TA Command
-   220 - Unable to process OS Command
+   202 - Unable to read telemetry (no such process, no /proc)
+   203 - Agent busy, all --max-sessions sessions in use (see RETRY_AFTER_MS)
+   204 - Unable to restart the agent (see RESTART)
+   220 - Unable to process OS Command (bad OS option)
+   221 - OS option requires the framed protocol (TA:protocol=2)
+   222 - Unable to process BATCH command list
+   223 - Unable to transfer file (bad path, option or I/O error)
+   224 - File checksum mismatch, the partial file was discarded
+   225 - Unknown job or bad JOB request
+   226 - Too many running jobs (MAX_JOBS)
    255 - Invalid message format
 
 The OS directive is a command that is intended to be executed on the
@@ -121,6 +197,125 @@ Examples:
 	                           "OS_STDERR"        : "/bin/sh: Qwert: command not found"  ,
                               "OS_RETURNCODE"     : 127                                  }
 
+Directives may carry options after the directive name, separated by commas:
+
+   DIRECTIVE,option,option=value:COMMAND
+
+Unknown options are ignored. The OS directive understands:
+
+   stream - Send stdout and stderr back as they are produced instead of
+            after the command finishes. Requires the framed protocol.
+
+   shell=auto|always|never
+          - How the command is started. "always" runs it through /bin/sh as
+            before. "never" splits it like a shell would (shlex) and executes
+            the program directly, saving a /bin/sh start per command. "auto"
+            (the default, see --shell) goes direct unless the command uses
+            shell features: pipes, redirects, variables, globs, builtins...
+
+   timeout=SECONDS  - Wall-clock limit for the command.
+   cpu=SECONDS      - CPU time limit for the command: the total of its whole
+          process group (pipelines included) is checked while it runs and
+          once it exits. Each process also gets RLIMIT_CPU one second above
+          it, for processes that leave the group.
+   maxout=BYTES     - Limit on stdout plus stderr; output is cut at the limit.
+   maxrss=BYTES     - Limit on the resident memory of the command's processes.
+          Sizes take an optional K, M or G suffix. A command run with any
+          limit gets its own process group; when a limit is hit the whole
+          group is killed and the OS_LIMIT key of the reply names the limit
+          (timeout, cpu, maxout or maxrss). OS_LIMIT is "" when none fired.
+
+   --- OS command with a timeout
+   tcp send from client:    OS,timeout=5:nohup ./server &
+   tcp recv from agent :    { "AGENT_RETURN_CODE" : 0                   ,
+                              "AGENT_MESSAGE"     : "LIMIT timeout"     ,
+                              "OS_COMMAND"        : "nohup ./server &"  ,
+                              "OS_STDOUT"         : ""                  ,
+                              "OS_STDERR"         : ""                  ,
+                              "OS_RETURNCODE"     : -9                  ,
+                              "OS_LIMIT"          : "timeout"           }
+
+   cache[=SECONDS]  - The command is idempotent: serve it from the agent's
+          result cache if the same command (with the same options) ran
+          successfully within the last SECONDS (default CACHE_TTL). Cached
+          replies say "CACHED" in AGENT_MESSAGE. Only commands that exited
+          0 without hitting a limit are cached. The cache holds at most
+          --cache-size results and drops the least recently used first.
+
+   --- Inventory query served from the cache
+   tcp send from client:    OS,cache=3600:uname -a
+   tcp recv from agent :    { "AGENT_RETURN_CODE" : 0           ,
+                              "AGENT_MESSAGE"     : "CACHED"    ,
+                              "OS_COMMAND"        : "uname -a"  ,
+                              "OS_STDOUT"         : "Linux ..." ,
+                              "OS_STDERR"         : ""          ,
+                              "OS_RETURNCODE"     : 0           }
+
+   TA:cache shows the cache counters (hits, misses, entries, evictions),
+   TA:cache=clear empties it and TA:uncache=COMMAND drops one command.
+
+PERSISTENT SHELL
+
+Every OS command normally runs in a fresh process, so "cd", exported variables
+and an activated virtualenv are gone by the next command, and each command
+pays the shell's start-up again. TA:shell=on gives the session one long-lived
+/bin/sh coprocess; from then on OS commands are run in it (through
+"command eval", with stdin from /dev/null) and their output is delimited by a
+random sentinel line that also carries the exit status. TA:shell=off, or the
+end of the session, stops the shell.
+
+   tcp send from client:    TA:shell=on
+   tcp send from client:    OS:cd /opt/hashserve && . venv/bin/activate
+   tcp send from client:    OS:python -V          <- runs in the same shell
+
+The timeout and maxout limits still apply; hitting one kills the shell and
+its process group, and the next command starts a new one (with the state
+lost, as when a command runs "exit"). The same happens, with OS_LIMIT
+"disconnect", when the client closes the connection while a command runs.
+Commands with the stream, async or shell= options, or the cpu or maxrss
+limits, still run as their own process, and OS,cache is ignored since the
+result depends on the shell's state.
+
+With --prefork=N the agent also starts N executor processes up front (this
+script run with --executor) and hands plain OS commands to them over a pipe.
+The executors are small and single threaded, so starting a command from them
+is cheaper than from a busy agent, and their own start-up cost is paid once.
+Run "agent.py --benchmark=N" to compare the shell, direct and prefork modes on
+the local host.
+
+   --- Streaming OS command (framed protocol)
+   tcp send from client:    OS,stream:tail -n 100 -f server.log
+   tcp recv from agent :    { "AGENT_RETURN_CODE" : 0            ,
+                              "AGENT_MESSAGE"     : "STREAM"     ,
+                              "OS_COMMAND"        : "tail ..."   ,
+                              "OS_STREAM"         : "stdout"     ,
+                              "OS_DATA"           : "...chunk..." }
+                            ... one frame per chunk, stdout or stderr ...
+                            { "AGENT_RETURN_CODE" : 0            ,
+                              "AGENT_MESSAGE"     : "STREAM END" ,
+                              "OS_COMMAND"        : "tail ..."   ,
+                              "OS_STDOUT"         : ""           ,
+                              "OS_STDERR"         : ""           ,
+                              "OS_RETURNCODE"     : 0            }
+
+Chunks are sent as soon as they are read, so the agent never holds more than
+one chunk of a streamed command's output in memory.
+
+The BATCH directive runs a list of OS commands in one round-trip. The command
+is a JSON list of strings. Up to BATCH_PARALLEL commands run at once unless
+the parallel=N option says otherwise; the sequential option runs them one
+after another in order. The reply carries one OS_* dictionary per command,
+in the order given, under the OS_RESULTS key:
+
+   tcp send from client:    BATCH,parallel=4:["uname -a", "id -un", "false"]
+   tcp recv from agent :    { "AGENT_RETURN_CODE" : 0               ,
+                              "AGENT_MESSAGE"     : "BATCH OF 3"    ,
+                              "OS_RESULTS"        : [ { "OS_COMMAND"    : "uname -a" ,
+                                                        "OS_STDOUT"     : "Linux ...",
+                                                        "OS_STDERR"     : ""         ,
+                                                        "OS_RETURNCODE" : 0          },
+                                                      ... ] }
+
 To connect to an agent using the Python Programming language see the
 example below
 
@@ -133,15 +328,39 @@ AGENT_PORT  = 1100                         # The Agent Port number
 BUFFER      = 14336 # 14k                  # The size of the TCP Buffer
 tcpSocket = socket(AF_INET, SOCK_STREAM)   # Create an object of type socket
 tcpSocket.connect((AGENT_IP,AGENT_PORT))   # Establish a connection
-tcpSocket.send("TA:version")               # Send the TA:version command
+tcpSocket.send(b"TA:version")              # Send the TA:version command
 response = tcpSocket.recv(BUFFER)          # Get the response from the agent
-print response                             # Print the response
-tcpSocket.send("TA:bye")                   # End the session with the agent
+print(response.decode())                   # Print the response
+tcpSocket.send(b"TA:bye")                  # End the session with the agent
 response = tcpSocket.recv(BUFFER)          # Get the closing notice
-print response                             # Print the closing response
+print(response.decode())                   # Print the closing response
 exit(0)                                    # clean exit
 # --- PROGRAM ENDS HERE --------------------------------------------------------
 
+Or, with the client library in lib/:
+
+# --- PROGRAM STARTS HERE ------------------------------------------------------
+from agent_client import AgentPool
+pool = AgentPool()
+print(pool.request("localhost", 1100, "TA:version"))
+print(pool.run("localhost", 1100, "uname -a")["OS_STDOUT"])
+pool.close()
+# --- PROGRAM ENDS HERE --------------------------------------------------------
+
+Replies are Python dictionary literals (str(dict)) by default, and a few TA
+commands (getname, setname, getusername) and HELP/unknown directives answer
+with a bare "[code, \"message\"]" list. A client can ask for strict JSON
+instead, after which every reply is a JSON object with the AGENT_* keys:
+
+   tcp send from client:    TA:format=json
+   tcp recv from agent :    {"AGENT_RETURN_CODE": 0, "AGENT_MESSAGE": "FORMAT json"}
+
+TA:format=text goes back to the default. lib/agent_client.py wraps all of this
+(framed protocol, JSON replies and a pool of persistent connections per agent)
+and is the recommended way to drive agents from Python test cases.
+lib/agent_fleet.py sends one message to many agents in parallel (as a module
+or from the command line) and summarizes the slowest hosts and failures.
+
 Any TCP AF_INET SOCKET_STREAM connections are accepted by the Agent
 regardless of language used. Please refer to the documentation for your
 specific language to establish a TCP AF_INET, SOCKET_STREAM connection
@@ -153,9 +372,195 @@ Please be sure to end your session with the agent using either:
    TA:quit
 
 commands.
+
+FRAMED PROTOCOL
+
+By default each message is whatever a single recv() returns and each reply is
+written as-is (the "legacy" protocol, version 1). That is fine for small
+interactive exchanges but a client cannot tell where a large reply ends, and
+two commands sent back to back may arrive as one message. A client can switch
+its session to the framed protocol (version 2) with:
+
+   tcp send from client:    TA:protocol=2
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"PROTOCOL 2"}
+
+The reply to TA:protocol is still sent in the old mode; wait for it before
+sending framed messages. From then on every message in both directions is a
+4-byte unsigned big-endian length followed by that many bytes of UTF-8 text:
+
+   +----------------+---------------------------------+
+   | length (!I)    | DIRECTIVE:COMMAND  or  reply     |
+   +----------------+---------------------------------+
+
+Framed messages may be pipelined: send several requests without waiting and
+read the replies back in the same order. TA:protocol=1 returns the session to
+the legacy protocol and TA:protocol reports the current version. Frames larger
+than MAX_FRAME bytes are rejected with return code 255 and the session ends.
+
+Framed sessions may also ask for compressed replies. TA:compress=on compresses
+every reply of COMPRESS_THRESHOLD bytes or more with zlib, TA:compress=BYTES
+sets another threshold and TA:compress=off turns it back off; the reply to the
+switch itself is never compressed. A compressed frame has the top bit of its
+length set (COMPRESSED_FLAG) and carries a zlib stream that inflates to the
+usual message. Replies that would not get smaller are sent as they are. The
+agent also accepts compressed frames from the client at any time. TA:stats
+reports the bytes before and after compression and the time spent on it.
+
+MULTIPLEXED REQUESTS
+
+In the framed protocol a client may also run several requests at once over
+one connection. After TA:multiplex=on (or TA:multiplex=N to run up to N at
+a time, default MUX_PARALLEL) every OS, BATCH or JOB request that carries an
+id=TOKEN option is run on the session's own worker threads while the agent
+goes on reading, and its reply (each frame, for OS,stream) carries the token
+back under REQUEST_ID, in whatever order the requests finish:
+
+   tcp send from client:    OS,id=1:sleep 2; echo slow
+   tcp send from client:    OS,id=2:echo fast
+   tcp recv from agent :    {..., OS_STDOUT:"fast", REQUEST_ID:"2"}
+   tcp recv from agent :    {..., OS_STDOUT:"slow", REQUEST_ID:"1"}
+
+All other requests (TA, GET, PUT, OS commands while TA:shell=on, and any
+request without an id) are still handled one at a time in the order they
+arrive, their replies tagged with REQUEST_ID when they carried an id. The
+session ends only after its outstanding requests have replied, and the idle
+timeout does not fire while any are running. TA:multiplex=off (or going back
+to TA:protocol=1) waits for outstanding requests and returns to in-order mode.
+
+AGENT STATISTICS
+
+The agent keeps a few counters about its own load so a slow test setup can be
+told apart from a slow agent. TA:stats returns them under AGENT_DATA:
+
+   tcp send from client:    TA:stats
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"STATS 12.3s",
+                             AGENT_DATA:{"seconds": 12.3,
+                                         "sessions_accepted": 40, "sessions_rejected": 0,
+                                         "sessions_active": 3,
+                                         "requests_in_flight": 4, "jobs_running": 2,
+                                         "bytes_in": 5120, "bytes_out": 88113,
+                                         "compression": {"replies": 12,
+                                             "bytes_before": 402113, "bytes_after": 61020,
+                                             "ratio": 6.59, "ms": 9.4},
+                                         "directives": {"OS": {"count": 210,
+                                             "mean_ms": 2.6, "p50_ms": 2.1, "p90_ms": 3.9,
+                                             "p99_ms": 11.8, "max_ms": 40.2}, ...}}}
+
+requests_in_flight counts every request being worked on: the one a session
+is handling in order, its multiplexed requests still running and every
+OS,async job still running (also given on their own as jobs_running).
+
+Latencies are measured from the end of the read of a message to the end of
+its reply, per directive (malformed and unknown directives are counted under
+INVALID and UNKNOWN). They are kept in fixed power-of-two buckets from
+STATS_MIN_MS, so the percentiles are bucket upper bounds (within a factor of
+two, clamped to the largest latency seen) and recording a request costs one
+lock and a few increments. Figures cover the time since the agent started or
+since the last TA:stats=reset.
+
+WORKER PROCESSES
+
+One agent process is bound by the GIL once many sessions format and log large
+outputs. With --workers=N the agent starts N worker processes (this script
+run with --worker=INDEX and the same options) that each bind the listening
+port with SO_REUSEPORT, so the kernel spreads new connections across them.
+The original process only supervises: a worker that crashes is restarted (at
+most once every WORKER_BACKOFF seconds), and TA:shutdown sent to any worker,
+SIGTERM or <Control>-<C> sent to the supervisor stops every worker, each
+draining its sessions as usual. Workers share nothing, so TA:setname,
+TA:stats, the OS,cache results and the log file (agent.py.worker<INDEX>.log)
+are per worker; a client talks to whichever worker accepted its connection.
+
+FILE TRANSFER
+
+GET and PUT move files as raw bytes instead of through OS_STDOUT, so build
+binaries and result files travel at wire speed with no size limit. Both need
+the framed protocol. The header replies are ordinary frames; the file data
+follows as FILE_LENGTH raw (unframed) bytes, sent with sendfile() by whichever
+side has the file and written in FILE_CHUNK pieces by the other. Every
+transfer carries the SHA-256 of the whole file in FILE_SHA256.
+
+   --- Fetch a file, resuming after the OFFSET bytes already received
+   tcp send from client:    GET,offset=0:/opt/hashserve/results/run1.csv
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"GET",
+                             FILE_PATH:"...", FILE_SIZE:9000, FILE_OFFSET:0,
+                             FILE_LENGTH:9000, FILE_SHA256:"9f86d0..."}
+                            ...FILE_LENGTH raw bytes...
+
+   --- Send a file (sha256 and mode are optional)
+   tcp send from client:    PUT,size=8871936,sha256=9f86d0...,mode=755:/opt/hashserve/bin/broken-hashserve
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"READY",
+                             FILE_PATH:"...", FILE_SIZE:8871936, FILE_OFFSET:0}
+   tcp send from client:    ...FILE_SIZE - FILE_OFFSET raw bytes...
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"PUT",
+                             FILE_PATH:"...", FILE_SIZE:8871936, FILE_SHA256:"9f86d0..."}
+
+PUT writes to PATH.part and renames it over PATH only once the checksum
+matches, so an interrupted upload leaves PATH untouched and the next PUT of the
+same size resumes at FILE_OFFSET (the size of PATH.part). A GET resumes from
+the offset option. Whenever an offset is past the end of the file the transfer
+restarts from 0, so the receiver should always continue from FILE_OFFSET. Whole
+directories are moved file by file (lib/agent_client.py has get_file() and
+put_file()), or packed first with OS:tar.
+
+ASYNCHRONOUS JOBS
+
+OS,async:COMMAND starts the command in the background and replies at once
+with its JOB_ID, so a long command does not hold the session open. Jobs belong
+to the agent, not to the session: they keep running (and keep their output)
+when the client disconnects, and any later session can query them. The other
+OS options (shell and limits) apply as usual.
+
+   tcp send from client:    OS,async,timeout=3600:./test_runner.py -s regression
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"JOB 7", JOB_ID:7,
+                             OS_COMMAND:"./test_runner.py -s regression"}
+
+   JOB:status=ID     - State of the job (running, done or cancelled)
+   JOB:output=ID     - State plus the output so far; stdout=N and stderr=N
+                       options skip the first N characters already fetched
+   JOB:wait=ID       - Like output, after waiting up to timeout=SECONDS
+                       (default JOB_WAIT) for the job to finish
+   JOB:cancel=ID     - Kills the job's process group
+   JOB:forget=ID     - Drops a finished job and its output
+   JOB:list          - State of every job, under AGENT_DATA
+
+   tcp send from client:    JOB,stdout=1024,timeout=60:wait=7
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"DONE", JOB_ID:7,
+                             JOB_STATE:"done", JOB_SECONDS:1805.2,
+                             JOB_STDOUT_SIZE:5120, JOB_STDERR_SIZE:0,
+                             OS_COMMAND:"...", OS_RETURNCODE:0, OS_LIMIT:"",
+                             OS_STDOUT:"...characters 1024 to 5120...", OS_STDERR:""}
+
+JOB_STDOUT_SIZE and JOB_STDERR_SIZE are the offsets to ask for next time.
+OS_RETURNCODE is null until the job ends. Output is kept in memory (use maxout
+to bound a chatty job), finished jobs are dropped JOB_KEEP seconds after they
+end, and running jobs are cancelled when the agent shuts down. With --workers
+each worker has its own jobs, so poll a job on a connection to the same worker.
+
+RESTART
+
+TA:restart upgrades an agent in place without refusing a single connection.
+The agent starts this script again (so whatever version is now on disk) with
+the same options plus --inherit-fd=N, passing it the listening socket itself
+instead of letting it bind the port. Both processes then share one socket and
+one accept queue, so connections that arrive during the handover simply wait
+to be accepted. The new agent reports on a pipe (--ready-fd) once it is
+accepting; only then does the old one reply, stop accepting and exit after
+its in-flight sessions have finished their current request, however long
+that takes. Idle sessions are ended at once; a client that sends on one
+finds it closed before any reply and has to connect again, which reaches the
+new agent (lib/agent_client.py's AgentPool does this by itself).
+
+   tcp send from client:    TA:restart
+   tcp recv from agent :    {AGENT_RETURN_CODE:0, AGENT_MESSAGE:"RESTARTING AGENT, NEW PID 4242"}
+
+If the new agent fails to start (or is not accepting within RESTART_TIMEOUT
+seconds) it is killed and the old one carries on, replying 204. Async jobs
+live in the old process and cannot move, so TA:restart replies 204 while any
+are running; TA:restart=force cancels them. Restart is not available with
+--workers, where the supervisor owns the processes.
                                                                            Q.E.D
 """
-
 # ==============================================================================
 # STANDARD LIBRARY IMPORTS
 import sys
@@ -164,11 +569,24 @@ import socket
 import time
 import getopt
 import subprocess
-from thread import start_new_thread
+import threading
+import struct
+import selectors
+import codecs
+import json
+import queue
+import shlex
+import signal
+import resource
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import bisect
+import hashlib
+import zlib
 
 # ==============================================================================
 # GLOBALS
-VERSION       = "1.1.0"  # Version of the agent
+VERSION       = "1.2.0"  # Version of the agent
 DEBUG         = False  # Flag for debug operation
 VERBOSE       = False  # Flag for verbose operation
 FIRST         = 0  # first element in a list
@@ -191,15 +609,101 @@ PAUSE_PROMPT  = "Press <Enter> to continue."  # Pause prompt text
 EXIT_SUCCESS  = 0  # Exit code
 USER          = "Unknown"  # User the agent is running as
 AGENT_NAME    = "NO_NAME"  # Name of the agent
+MAX_SESSIONS  = 16  # Maximum number of concurrent client sessions
+BACKLOG       = 128  # listen() backlog of connections not yet accepted
+BUSY_POLICY   = "reject"  # Past MAX_SESSIONS: reject (busy reply) or queue (wait in the backlog)
+RETRY_AFTER   = 250  # Milliseconds a rejected client is told to wait before retrying
+IDLE_TIMEOUT  = 600.0  # Seconds a session may send nothing before it is ended, 0 = never
+KEEPALIVE     = 60  # Seconds of silence before TCP keepalive probes start, 0 = off
+ACCEPT_POLL   = 0.5  # Seconds between session slot checks when all are busy
+DRAIN_DEADLINE = 10.0  # Seconds to let in-flight sessions finish on shutdown
+CLOSE_LINGER  = 1.0  # Seconds to wait for the client's FIN after TA:bye
+FRAME_HEADER  = struct.Struct("!I")  # Framed protocol length prefix
+MAX_FRAME     = 64 * 1024 * 1024  # Largest framed message accepted, in bytes
+COMPRESSED_FLAG = 0x80000000  # Frame length bit marking a zlib compressed payload
+COMPRESS_THRESHOLD = 1024  # Smallest reply compressed after TA:compress=on
+COMPRESS_LEVEL = 3  # zlib level; on command output 3 compresses as well as 6 in half the time
+STREAM_CHUNK  = 65536  # Largest read from a command's stdout/stderr pipe
+LOG_MAX_BYTES      = 10 * 1024 * 1024  # Rotate the log file past this size
+LOG_BACKUPS        = 3     # Rotated log files kept (agent.py.log.1 ... .3)
+LOG_FLUSH_INTERVAL = 1.0   # Seconds between log file flushes
+LOG_FLUSH_BYTES    = 65536  # Flush the log early once this much is queued
+SHELL_MODE    = "auto"  # How OS commands are started: always, never or auto (see Command.argv())
+SHELL_CHARS   = set("|&;<>()$`\\*?[]{}~#=%!\n")  # Any of these in a command needs /bin/sh
+SHELL_BUILTINS = set(["cd", "export", "source", ".", "exit", "set", "unset", "alias",
+                      "ulimit", "umask", "eval", "exec", "read", "wait", "trap",
+                      "shift", "return", "local", "type", "hash", "jobs", "fg", "bg"])
+PAGE_SIZE     = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096  # Bytes per memory page
+LIMIT_POLL    = 0.1  # Seconds between limit checks while a limited command runs
+LIMIT_KEYS    = ("timeout", "cpu", "maxout", "maxrss")  # OS/BATCH options that are limits
+CPU_SLACK     = 0.05  # Seconds of CPU under the cpu limit still counted as reaching it (rusage rounding)
+PREFORK       = 0  # Number of pre-forked executor processes, 0 = start commands from the agent
+WORKERS       = 0  # --workers=N agent processes sharing the port, 0 = serve from this process
+WORKER_INDEX  = None  # Set to 1..N in a worker started by the supervisor
+WORKER_POLL   = 0.2  # Seconds between supervisor checks on its workers
+WORKER_BACKOFF = 1.0  # Least seconds between restarts of the same worker
+BIND_FAILED   = 6  # Exit code for "unable to bind", a worker with it is not restarted
+RESTART_TIMEOUT = 10.0  # Seconds TA:restart waits for the new agent to accept connections
+INHERIT_FD    = None  # --inherit-fd: listening socket handed over by TA:restart
+READY_FD      = None  # --ready-fd: pipe the new agent reports "ready" on
+BENCHMARK_RUNS = 0  # --benchmark=N runs the start-up micro-benchmark and exits
+BENCHMARK_COMMAND = "echo benchmark"  # Command timed by the micro-benchmark
+CACHE_TTL     = 300.0  # Default seconds an OS,cache result stays fresh
+CACHE_SIZE    = 256    # Most OS results kept in the cache
+STATS_MIN_MS  = 0.05   # Upper bound of the first latency bucket
+STATS_BUCKETS = 24     # Latency buckets, each twice as wide as the one before
+FILE_CHUNK    = 1024 * 1024  # Largest read or write of a file transfer
+MAX_JOBS      = 256     # Most OS,async jobs running at once
+JOB_KEEP      = 3600.0  # Seconds a finished job is kept after it ends
+JOB_WAIT      = 30.0    # Default seconds JOB:wait waits for a job to finish
+MUX_PARALLEL  = 16  # Requests run at once per session after TA:multiplex=on
+MAX_MUX_PARALLEL = 64  # Upper bound on TA:multiplex=N
+BATCH_PARALLEL     = 8   # Default number of BATCH commands run at once
+MAX_BATCH_PARALLEL = 32  # Upper bound on BATCH,parallel=N
 AGENT_RETURN_CODE = "AGENT_RETURN_CODE"  # \
 AGENT_MESSAGE     = "AGENT_MESSAGE"      #  \
 OS_COMMAND        = "OS_COMMAND"         #   \__ Response key names used in
 OS_STDOUT         = "OS_STDOUT"          #   /   the response dictionary
 OS_STDERR         = "OS_STDERR"          #  /
 OS_RETURNCODE     = "OS_RETURNCODE"      # /
-closeSocketPause   = 3  # Time in seconds to wait for the socket to close cleanly
+OS_STREAM         = "OS_STREAM"          # \__ Streamed chunk keys
+OS_DATA           = "OS_DATA"            # /
+OS_RESULTS        = "OS_RESULTS"         # List of OS_* dictionaries from BATCH
+OS_LIMIT          = "OS_LIMIT"           # Name of the limit that stopped the command
+AGENT_DATA        = "AGENT_DATA"         # Structured data from telemetry TA commands
+RETRY_AFTER_MS    = "RETRY_AFTER_MS"     # Busy reply: milliseconds to wait before retrying
+REQUEST_ID        = "REQUEST_ID"         # Multiplexed replies: the id= option of the request
+FILE_PATH         = "FILE_PATH"          # \
+FILE_SIZE         = "FILE_SIZE"          #  \
+FILE_OFFSET       = "FILE_OFFSET"        #   > GET/PUT header keys
+FILE_LENGTH       = "FILE_LENGTH"        #  /
+FILE_SHA256       = "FILE_SHA256"        # /
+JOB_ID            = "JOB_ID"             # \
+JOB_STATE         = "JOB_STATE"          #  \
+JOB_SECONDS       = "JOB_SECONDS"        #   > OS,async and JOB reply keys
+JOB_STDOUT_SIZE   = "JOB_STDOUT_SIZE"    #  /
+JOB_STDERR_SIZE   = "JOB_STDERR_SIZE"    # /
+CLOCK_TICKS       = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100  # /proc time unit
+TCP_STATES        = {"01": "ESTABLISHED", "02": "SYN_SENT", "03": "SYN_RECV",
+                     "04": "FIN_WAIT1", "05": "FIN_WAIT2", "06": "TIME_WAIT",
+                     "07": "CLOSE", "08": "CLOSE_WAIT", "09": "LAST_ACK",
+                     "0A": "LISTEN", "0B": "CLOSING"}  # /proc/net/tcp st column
+shutdownRequested  = threading.Event()  # Set by TA:shutdown from any session
+restartRequests    = queue.Queue()      # TA:restart reply queues, served by the listener
+replacement        = None               # Agent process started by TA:restart
+tcpSocket          = None               # Listening socket, created at start up
+wakeReader, wakeWriter = os.pipe()      # Wakes the listener on shutdown or restart requests
+activeSessions     = set()              # Sessions currently being served
+sessionsChanged    = threading.Condition()  # Guards activeSessions, notified as sessions end
+agentLock          = threading.Lock()   # Guards agent-wide state shared by sessions
+log                = None               # Logger, created at start up
+executorPool       = None               # ExecutorPool when --prefork is used
+resultCache        = None               # ResultCache for OS,cache, created at start up
+agentStats         = None               # AgentStats for TA:stats, created at start up
+jobTable           = None               # JobTable for OS,async, created at start up
 helpMessage = """
-Agent commands must be of the form TA:command or OS:command.
+Agent commands must be of the form TA:command, OS:command, BATCH:["command", ...],
+GET:path, PUT,size=N:path or JOB:action=ID.
 
 Valid TA commands are: help, version, exit, quit, bye, or shutdown
 Valid OS commands depend on the Angent's operating system."" 
@@ -211,37 +715,184 @@ Valid OS commands depend on the Angent's operating system.""
 class Command:
 
     # --------------------------------------------------------- Command.__init__()
-    def __init__(self, command):
+    def __init__(self, command, shell=None, timeout=None, cpu=None, maxout=None, maxrss=None, detach=False):
         """ Creates an instance of an object of type Command. """
         self.command    = str(command).strip()    # The command to execute
+        self.shell      = SHELL_MODE if shell is None else shell  # always, never or auto
+        self.timeout    = timeout                 # Wall-clock limit in seconds
+        self.cpu        = cpu                     # CPU time limit in seconds
+        self.maxout     = maxout                  # Output limit in bytes
+        self.maxrss     = maxrss                  # Resident memory limit in bytes
+        self.limited    = any(limit is not None for limit in (timeout, cpu, maxout, maxrss))
+        self.detach     = detach                  # Own process group, so cancel() reaches every child
+        self._process   = None                    # Running process, for cancel()
+        self.limitHit   = ""                      # Name of the limit that stopped the command
         self._stdout    = subprocess.PIPE         # Standard Output PIPE
         self._stderr    = subprocess.PIPE         # Standard Error PIPE
         self.output     = "Command not executed"  # Output from command
         self.error      = "Command not executed"  # Error from command
         self.returnCode = 127                     # Return code from command
 
+    # ------------------------------------------------------------ Command.argv()
+    def argv(self):
+        """ Returns the argument list to execute directly, or None when the
+            command has to go through /bin/sh. """
+        if self.shell == "always":
+            return None
+        if self.shell == "auto":
+            if any(character in SHELL_CHARS for character in self.command):
+                return None
+            try:
+                argv = shlex.split(self.command)
+            except ValueError:
+                return None  # Unbalanced quotes, let the shell complain
+            if len(argv) < 1 or argv[FIRST] in SHELL_BUILTINS:
+                return None
+            return argv
+        return shlex.split(self.command)  # "never"
+
+    # ----------------------------------------------------------- Command._start()
+    def _start(self):
+        """ Starts the command and returns the process. """
+        if self.limitHit == "cancel":
+            raise OSError("cancelled before it started")
+        newSession = self.limited or self.detach
+        argv = self.argv()
+        process = None
+        if argv is not None:
+            try:
+                process = subprocess.Popen(argv,
+                                           stdout=self._stdout,
+                                           stderr=self._stderr,
+                                           start_new_session=newSession)  # Execute the program directly
+            except FileNotFoundError:
+                if self.shell == "never":
+                    raise
+                # auto: let /bin/sh report "not found" (127) as it always has
+        if process is None:
+            process = subprocess.Popen(self.command,
+                                       stdout=self._stdout,
+                                       shell=True,
+                                       stderr=self._stderr,
+                                       start_new_session=newSession)  # Execute the command
+        if self.cpu is not None:
+            try:
+                cpuSeconds = int(self.cpu) + 1  # Backstop for processes that leave the group, _pump() enforces cpu
+                resource.prlimit(process.pid, resource.RLIMIT_CPU, (cpuSeconds, cpuSeconds + 1))
+            except (OSError, ValueError):
+                pass  # Process already gone
+        self._process = process
+        if self.limitHit == "cancel":
+            self._kill(process, "cancel")  # cancel() ran while the process started
+        return process
+
+    # ---------------------------------------------------------- Command.cancel()
+    def cancel(self):
+        """ Kills the command from another thread; limitHit becomes "cancel". """
+        process = self._process
+        if process is None:
+            self.limitHit = "cancel"  # _start() will refuse to start it
+        elif process.poll() is None:
+            self._kill(process, "cancel")
+
+    # ------------------------------------------------------------ Command._kill()
+    def _kill(self, process, limit):
+        """ Records which limit fired and kills the command's process group. """
+        self.limitHit = limit
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            process.kill()
+
+    # ------------------------------------------------------------ Command._pump()
+    def _pump(self, process, onOutput):
+        """ Reads stdout and stderr as they are produced and hands each decoded
+            chunk to onOutput("stdout"|"stderr", text). If onOutput raises (the
+            client went away) the command is killed and the error re-raised. """
+        streams  = {process.stdout.fileno(): ("stdout", codecs.getincrementaldecoder('utf-8')('replace')),
+                    process.stderr.fileno(): ("stderr", codecs.getincrementaldecoder('utf-8')('replace'))}
+        selector = selectors.DefaultSelector()
+        selector.register(process.stdout, selectors.EVENT_READ)
+        selector.register(process.stderr, selectors.EVENT_READ)
+        deadline  = None if self.timeout is None else time.monotonic() + float(self.timeout)
+        poll      = LIMIT_POLL if self.limited else None
+        outputted = 0  # Bytes of stdout and stderr so far
+        try:
+            while selector.get_map() and not self.limitHit:
+                for key, events in selector.select(poll):
+                    chunk = os.read(key.fd, STREAM_CHUNK)
+                    name, decoder = streams[key.fd]
+                    if self.maxout is not None and outputted + len(chunk) > self.maxout:
+                        chunk = chunk[:max(0, self.maxout - outputted)]
+                        self._kill(process, "maxout")
+                    outputted += len(chunk)
+                    if chunk:
+                        text = decoder.decode(chunk)
+                    else:
+                        text = decoder.decode(b"", True)
+                    if not chunk or self.limitHit:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                    if text:
+                        onOutput(name, text)
+                if self.limitHit:
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    self._kill(process, "timeout")
+                elif self.maxrss is not None and processGroupRSS(process.pid) > self.maxrss:
+                    self._kill(process, "maxrss")
+                elif self.cpu is not None and processGroupCPU(process.pid) > self.cpu:
+                    self._kill(process, "cpu")  # RLIMIT_CPU is per process, a pipeline can share the budget
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()  # Limit hit: stop reading what is left
+            selector.close()
+        self.returnCode, cpuUsed = waitForUsage(process)  # Get Return Code
+        if self.cpu is not None and not self.limitHit:
+            if cpuUsed >= self.cpu - CPU_SLACK:
+                self.limitHit = "cpu"  # A process outside the group hit the RLIMIT_CPU backstop
+
     # ------------------------------------------------------------- Command.run()
     def run(self):
         """ Executes the command in the specified shell. """
+        output = []
+        error  = []
         try:
-            results = subprocess.Popen(self.command,
-                                       stdout=self._stdout,
-                                       shell=True,
-                                       stderr=self._stderr)  # Execute the command
-            self.output, self.error = results.communicate()  # Get output and error
-            self.returnCode = results.returncode  # Get Return Code
+            process = self._start()
+            self._pump(process, lambda name, text: (output if name == "stdout" else error).append(text))
+            self.output = "".join(output)  # Get output and error
+            self.error  = "".join(error)
         except Exception as e:
             self.output = str(e)
             self.error = "Unable to execute: \"%s\"" % self.command
             self.returnCode = 113
 
+    # ---------------------------------------------------------- Command.stream()
+    def stream(self, onOutput):
+        """ Executes the command, passing output to onOutput as it arrives
+            instead of keeping it. Errors raised by onOutput propagate. """
+        try:
+            process = self._start()
+        except Exception as e:
+            self.output = str(e)
+            self.error = "Unable to execute: \"%s\"" % self.command
+            self.returnCode = 113
+            return
+        self.output = ""
+        self.error  = ""
+        self._pump(process, onOutput)
+
     # ----------------------------------------------------- Command.showResults()
     def showResults(self):
         """ Prints original command and resutls to stdout. """
-        print "COMMAND     : \"%s\"" % self.command
-        print "OUTPUT      : \"%s\"" % self.output.strip()
-        print "ERROR       : \"%s\"" % self.error.strip()
-        print "RETURN CODE : %d" % self.returnCode
+        print("COMMAND     : \"%s\"" % self.command)
+        print("OUTPUT      : \"%s\"" % self.output.strip())
+        print("ERROR       : \"%s\"" % self.error.strip())
+        print("RETURN CODE : %d" % self.returnCode)
 
         # ---------------------------------------------------- Command.returnResuls()
 
@@ -250,7 +901,8 @@ class Command:
         results = {"command": self.command.strip(),
                    "output": self.output.strip(),
                    "error": self.error.strip(),
-                   "returnCode": self.returnCode}
+                   "returnCode": self.returnCode,
+                   "limit": self.limitHit}
         return results
 
     # ==================================================================== Logger()
@@ -258,10 +910,13 @@ class Command:
 
 class Logger:
 
-    """ Rolling my own Logger for ... reasons """
+    """ Rolling my own Logger for ... reasons. logit() only formats the entry
+        and puts it on a queue; a background writer thread batches entries to
+        the file, flushing every LOG_FLUSH_INTERVAL seconds or LOG_FLUSH_BYTES
+        bytes, and rotates the file once it grows past LOG_MAX_BYTES. """
 
     # --------------------------------------------------------- Logger.__init__()
-    def __init__(self, logFile):
+    def __init__(self, logFile, maxBytes=None, backups=None):
         """ Creates an instance of an object of type Logger. """
         self.logPathFile      = str(logFile).strip()                         # Log path and file name
         self.logFile          = os.path.split(self.logPathFile)[LAST]        # Log file name only
@@ -277,9 +932,17 @@ class Logger:
         timeString            = "%H:%M:%S"                                   # Time format string
         self._timestampFormat = dateString + self._logEntrySep + timeString  # log text timestamp format
         self.valid            = False                                        # is the log file valid
+        self.maxBytes         = LOG_MAX_BYTES if maxBytes is None else maxBytes  # Rotate past this size
+        self.backups          = LOG_BACKUPS if backups is None else backups      # Rotated files kept
+        self._queue           = queue.Queue()                                # Entries waiting to be written
+        self._writer          = None                                         # Background writer thread
         # - - - - - - - - - - - - - - - - - - - - - - - -
         self._createLogFolder()
         self._createLogFile()
+        if self.valid:
+            self._writer = threading.Thread(target=self._writeLoop, name="log-writer")
+            self._writer.daemon = True
+            self._writer.start()
 
     # ------------------------------------------------- Logger.createLogFolder()
     def _createLogFolder(self):
@@ -323,14 +986,14 @@ class Logger:
     # ------------------------------------------------------------- Logger._now()
     def _now(self):
         """ returns a consistent time stamp """
-        if DEBUG: print self._timestampFormat
+        if DEBUG: print(self._timestampFormat)
         return time.strftime(self._timestampFormat, time.localtime())
 
     # ------------------------------------------------------------ Logger.logit()
     def logit(self, message, level=1):
-        """logIt(message, optional level) Writes an ertry to a log file.
+        """logIt(message, optional level) Queues an ertry for the log file.
            Log level vaules are: 1=INFO, 2=WARNING, 3=ERROR.
-           By default all log entries are INFO. """
+           By default all log entries are INFO. Never blocks on file I/O. """
         if self.valid:
             entry = self._now() + self._logEntrySep
             if level == self._infoLevel:
@@ -342,28 +1005,1444 @@ class Logger:
             else:
                 entry = entry + "GOK" + self._logEntrySep  # God only knows
             entry = entry + str(message) + os.linesep
-            try:
-                log = open(self.logFile, FOR_APPENDING)
-                log.write(entry)
-                log.close()
-            except Exception as e:
-                self.showError("Unable to write to log file \"%s\"\n%s" % (self.logPathFile), str(e))
+            self._queue.put(entry)
         else:
             self._showError("Log file \"%s\" is not valid" % self.logPathFile)
 
+    # ------------------------------------------------------- Logger._writeLoop()
+    def _writeLoop(self):
+        """ Writer thread: collects queued entries and writes them in batches.
+            A None entry is the signal to flush what is left and stop. """
+        try:
+            logFile = open(self.logPathFile, FOR_APPENDING)
+        except Exception as e:
+            self._showError("Unable to write to log file \"%s\"\n%s" % (self.logPathFile, str(e)))
+            self.valid = False
+            return
+        size      = logFile.tell()
+        batch     = []
+        batchSize = 0
+        deadline  = time.monotonic() + LOG_FLUSH_INTERVAL
+        running   = True
+        while running:
+            try:
+                entry = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                if entry is None:
+                    running = False
+                elif entry is Logger._RESET:
+                    batch, batchSize = [], 0
+                    logFile.close()
+                    logFile = open(self.logPathFile, FOR_WRITING)
+                    size = 0
+                else:
+                    batch.append(entry)
+                    batchSize += len(entry)
+            except queue.Empty:
+                pass
+            if batch and (not running or batchSize >= LOG_FLUSH_BYTES or time.monotonic() >= deadline):
+                try:
+                    logFile.write("".join(batch))
+                    logFile.flush()
+                    size += batchSize
+                    if self.maxBytes > 0 and size >= self.maxBytes:
+                        logFile.close()
+                        self._rotate()
+                        logFile = open(self.logPathFile, FOR_APPENDING)
+                        size = 0
+                except Exception as e:
+                    self._showError("Unable to write to log file \"%s\"\n%s" % (self.logPathFile, str(e)))
+                batch, batchSize = [], 0
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+        logFile.close()
+
+    # ---------------------------------------------------------- Logger._rotate()
+    def _rotate(self):
+        """ agent.py.log -> agent.py.log.1 -> ... -> agent.py.log.<backups> """
+        for index in range(self.backups - 1, 0, -1):
+            older = "%s.%d" % (self.logPathFile, index)
+            if os.path.exists(older):
+                os.replace(older, "%s.%d" % (self.logPathFile, index + 1))
+        if self.backups > 0:
+            os.replace(self.logPathFile, "%s.1" % self.logPathFile)
+        else:
+            os.remove(self.logPathFile)
+
+    # ------------------------------------------------------------ Logger.close()
+    def close(self, timeout=5.0):
+        """ Writes out everything still queued and stops the writer thread. """
+        if self._writer is not None and self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout)
+
     # ------------------------------------------------------------ Logger.reset()
     def reset(self):
+        """ Empties the log file (done by the writer, in order with other entries). """
         if self.valid:
-            try:
-                os.remove(self.logPathFile)
-                self.valid = False
-            except Exceptions as e:
-                self._showError("Unable to reset the log file \"%s\"" % self.logPathFile)
-            if self.valid: self.logit("Log file reset")
+            self._queue.put(Logger._RESET)
+            self.logit("Log file reset")
+
+Logger._RESET = object()  # Queue marker asking the writer to empty the log file
 
 # === End of class Logger =====
 
 
+# ==================================================================== Session()
+class Session:
+
+    """ One client connection. Each session is served on its own worker thread
+        so a slow OS command only holds up the client that sent it. """
+
+    # -------------------------------------------------------- Session.__init__()
+    def __init__(self, connection, remoteAddr):
+        """ Creates an instance of an object of type Session. """
+        self.connection = connection  # Connected client socket
+        self.remoteAddr = remoteAddr  # (address, port) of the client
+        self.active     = True        # Cleared when the session should end
+        self.framed     = False       # True once the client asks for TA:protocol=2
+        self.jsonReplies = False      # True once the client asks for TA:format=json
+        self.compressThreshold = None # Smallest reply compressed, None = TA:compress=off
+        self.shell      = None        # PersistentShell after TA:shell=on
+        self.multiplexer = None       # ThreadPoolExecutor after TA:multiplex=on
+        self.multiplexParallel = 0    # Its number of threads
+        self._sendLock  = threading.RLock()  # One reply (or GET transfer) on the wire at a time
+        self._request   = threading.local()  # .id: REQUEST_ID of the request this thread serves
+        self._inFlight  = 0           # Multiplexed requests not yet answered
+        self._flightLock = threading.Lock()
+        self._pending   = b""         # Bytes received but not yet consumed
+        self.busy       = False       # True while a request is being processed
+        self._cpuSamples = {}         # pid -> (time, cpu seconds) of the last TA:proc sample
+
+    # ------------------------------------------------------------ Session.send()
+    def send(self, response, legacy=None):
+        """ Sends a response dictionary to the client. In text mode the
+            dictionary is sent as str(response), or as the legacy string when
+            one is given; in JSON mode it is always sent as a JSON object. """
+        requestId = getattr(self._request, "id", None)
+        if requestId is not None:
+            response[REQUEST_ID] = requestId
+            legacy = None  # The tag needs the dictionary form
+        if self.jsonReplies:
+            message = json.dumps(response)
+        elif legacy is not None:
+            message = legacy
+        else:
+            message = str(response)
+        if VERBOSE: showMessage("Sending to %s: %s" % (str(self.remoteAddr), message))
+        if LOGGING: log.logit("Sending to %s: %s" % (str(self.remoteAddr), message))
+        payload = message.encode('utf-8')
+        if self.framed:
+            flags = 0
+            if self.compressThreshold is not None and len(payload) >= self.compressThreshold:
+                started = time.perf_counter()
+                packed = zlib.compress(payload, COMPRESS_LEVEL)
+                agentStats.compressed(len(payload), len(packed), time.perf_counter() - started)
+                if len(packed) < len(payload):
+                    payload, flags = packed, COMPRESSED_FLAG
+            payload = FRAME_HEADER.pack(len(payload) | flags) + payload
+        with self._sendLock:
+            self.connection.sendall(payload)
+            agentStats.bytesOut += len(payload)
+
+    # --------------------------------------------------------- Session._recvExact()
+    def _recvExact(self, size):
+        """ Returns exactly size bytes from the client, or None if the client
+            closed the connection first. """
+        while len(self._pending) < size:
+            data = self.connection.recv(max(BUF_SIZE, size - len(self._pending)))
+            if not data:
+                return None
+            agentStats.bytesIn += len(data)
+            self._pending += data
+        data = self._pending[:size]
+        self._pending = self._pending[size:]
+        return data
+
+    # --------------------------------------------------------- Session.receive()
+    def receive(self):
+        """ Returns the next message from the client as a string, or None
+            when the client has closed the connection. """
+        if not self.framed:
+            # Legacy protocol: one recv() is one message
+            if self._pending:
+                data, self._pending = self._pending, b""
+            else:
+                data = self.connection.recv(BUF_SIZE)
+                agentStats.bytesIn += len(data)
+            if not data:
+                return None
+            return data.decode('utf-8', 'replace').strip()
+        header = self._recvExact(FRAME_HEADER.size)
+        if header is None:
+            return None
+        size = FRAME_HEADER.unpack(header)[FIRST]
+        compressed = size & COMPRESSED_FLAG
+        size &= ~COMPRESSED_FLAG
+        if size > MAX_FRAME:
+            self.send(build_TA_Response(255, "Frame of %d bytes exceeds %d" % (size, MAX_FRAME)))
+            return None  # Cannot resynchronize, end the session
+        data = self._recvExact(size)
+        if data is None:
+            return None
+        if compressed:
+            try:
+                inflater = zlib.decompressobj()
+                data = inflater.decompress(data, MAX_FRAME)
+                if inflater.unconsumed_tail:
+                    raise zlib.error("inflates past %d bytes" % MAX_FRAME)
+            except zlib.error as e:
+                message = "Bad compressed frame from %s: %s" % (str(self.remoteAddr), str(e))
+                if LOGGING: log.logit(message, WARN)
+                return ""  # Answered as an invalid message
+        return data.decode('utf-8', 'replace').strip()
+
+    # ------------------------------------------------------------- Session.run()
+    def run(self):
+        """ Reads messages from the client until the session ends. """
+        try:
+            while self.active and not shutdownRequested.is_set():
+                try:
+                    data = self.receive()
+                except socket.timeout:
+                    if self._inFlight > 0:
+                        continue  # Not idle while multiplexed requests run
+                    raise
+                if data is None:
+                    # Client went away without saying TA:bye
+                    message = "Connection closed by %s" % str(self.remoteAddr)
+                    if VERBOSE: showMessage(message)
+                    if LOGGING: log.logit(message)
+                    break
+                self.busy = True
+                started = time.perf_counter()
+                directive = self.process(data)
+                if directive is not None:  # None: handed to the multiplexer
+                    agentStats.record(directive, time.perf_counter() - started)
+                self.busy = False
+        except socket.timeout:
+            message = "Session with %s idle for %s seconds, closing" % (str(self.remoteAddr), IDLE_TIMEOUT)
+            if VERBOSE: showMessage(message)
+            if LOGGING: log.logit(message, WARN)
+        except socket.error as e:
+            message = "Session with %s ended: %s" % (str(self.remoteAddr), str(e))
+            if VERBOSE: showMessage(message)
+            if LOGGING: log.logit(message, WARN)
+        finally:
+            self.close()
+
+    # ----------------------------------------------------------- Session.close()
+    def close(self):
+        """ Graceful teardown: half-close our side so the client sees EOF right
+            after the last reply, wait briefly for the client's own FIN so the
+            reply is not cut off by a reset, then close. """
+        self.stopMultiplexer()  # Outstanding requests reply first
+        if self.shell is not None:
+            self.shell.close()
+            self.shell = None
+        try:
+            self.connection.shutdown(socket.SHUT_WR)
+            self.connection.settimeout(CLOSE_LINGER)
+            while self.connection.recv(BUF_SIZE):
+                pass  # Discard anything the client still sends
+        except (socket.error, socket.timeout):
+            pass
+        self.connection.close()
+
+    # ------------------------------------------------ Session.requestsInFlight()
+    def requestsInFlight(self):
+        """ Returns the requests this session is working on: the one handled
+            in order plus the multiplexed ones not yet answered. """
+        with self._flightLock:
+            return int(self.busy) + self._inFlight
+
+    # ------------------------------------------------------------ Session.wake()
+    def wake(self):
+        """ Ends an idle session during shutdown by making its recv() see EOF. """
+        try:
+            self.connection.shutdown(socket.SHUT_RD)
+        except socket.error:
+            pass
+
+    # --------------------------------------------------------- Session.process()
+    def process(self, data):
+        """ Parses one DIRECTIVE:COMMAND message and acts on it. Returns the
+            directive name the request is counted under in TA:stats, or None
+            when it was handed to the multiplexer (which counts it itself). """
+        message = "Message from %s: %s" % (str(self.remoteAddr), data)
+        if VERBOSE: showMessage(message)
+        if LOGGING: log.logit(message)
+
+        # --- Check message from client and see if it is in form:
+        #     DIRECTIVE:COMMAND
+        messageParts = data.split(':', 1)
+        if len(messageParts) != 2:
+            self.send(build_TA_Response(98, "Invalid message"))
+            return "INVALID"
+
+        # --- Parse out and clean up the directive, options and command
+        directive, options = parseDirective(messageParts[FIRST])
+        command = messageParts[LAST].strip()
+
+        # --- Multiplexed requests run concurrently, the rest in order
+        if self.multiplexer is None:
+            return self.dispatch(directive, command, options)
+        requestId = options.get("id")
+        if requestId is not None and directive in ("OS", "BATCH", "JOB") \
+                and not (directive == "OS" and self.shell is not None):
+            with self._flightLock:
+                self._inFlight += 1
+            self.multiplexer.submit(self._dispatchTagged, requestId, directive, command, options)
+            return None
+        self._request.id = requestId
+        try:
+            return self.dispatch(directive, command, options)
+        finally:
+            self._request.id = None
+
+    # -------------------------------------------------- Session._dispatchTagged()
+    def _dispatchTagged(self, requestId, directive, command, options):
+        """ Multiplexer thread body: runs one tagged request. """
+        self._request.id = requestId
+        started = time.perf_counter()
+        try:
+            agentStats.record(self.dispatch(directive, command, options), time.perf_counter() - started)
+        except Exception as e:
+            message = "Request %s from %s failed: %s" % (requestId, str(self.remoteAddr), str(e))
+            if VERBOSE: showMessage(message)
+            if LOGGING: log.logit(message, WARN)
+        finally:
+            self._request.id = None
+            with self._flightLock:
+                self._inFlight -= 1
+
+    # --------------------------------------------------------- Session.dispatch()
+    def dispatch(self, directive, command, options):
+        """ Acts on one parsed request. Returns the directive name the request
+            is counted under in TA:stats. """
+        if directive == "TA":
+            self.processTA(command)
+        elif directive == "OS":
+            self.processOS(command, options)
+        elif directive == "BATCH":
+            self.processBATCH(command, options)
+        elif directive == "GET":
+            self.processGET(command, options)
+        elif directive == "PUT":
+            self.processPUT(command, options)
+        elif directive == "JOB":
+            self.processJOB(command, options)
+        elif directive == "HELP":
+            #
+            #    *** ****************************** ***
+            #    *** HELP DIRECTIVES PROCESSED HERE ***
+            #    *** ****************************** ***
+            #
+            self.send(build_TA_Response(0, helpMessage), "[0, \"%s\"]" % helpMessage)
+        else:
+            #
+            #    *** ********************************* ***
+            #    *** UNKNOWN DIRECTIVES PROCESSED HERE ***
+            #    *** ********************************* ***
+            #
+            if VERBOSE: showMessage("Sending Unknown Directive")
+            message = "UNKNOWN DIRECTIVE: %s" % directive
+            self.send(build_TA_Response(200, message), "[200, \"%s\"]" % message)
+            return "UNKNOWN"
+        return directive
+
+    # ------------------------------------------------------- Session.processTA()
+    def processTA(self, command):
+        """ Handles commands that control/query the test agent itself. """
+        global AGENT_NAME
+        #
+        #    *** **************************** ***
+        #    *** TA DIRECTIVES PROCESSED HERE ***
+        #    *** **************************** ***
+        #
+        # ------------------------------------------------- TA:VERSION
+        if command == "version":
+            self.send(build_TA_Response(0, "VERSION %s" % VERSION))
+        # ----------------------------------------------------- TA:BYE
+        elif command == "bye" or command == "quit" or command == "exit":
+            self.send(build_TA_Response(0, "CLOSING CONNECTION"))
+            self.active = False  # Flag end of session
+        # ------------------------------------------------ TA:SHUTDOWN
+        elif command == "shutdown" or command == "SHUTDOWN":
+            self.send(build_TA_Response(0, "SHUTTING DOWN AGENT"))
+            self.active = False  # Flag end of session
+            requestShutdown()  # Flag end of listener Loop
+            if WORKER_INDEX is not None:
+                os.kill(os.getppid(), signal.SIGTERM)  # Supervisor stops the other workers
+        # ------------------------------------------------- TA:RESTART
+        elif command.split('=')[FIRST].strip() == "restart":
+            self.restartAgent(command)
+        # ------------------------------------------------- TA:GETNAME
+        elif command == "getname" or command == "GETNAME":
+            self.send(build_TA_Response(0, AGENT_NAME), "[0, \"%s\"]" % AGENT_NAME)
+        # ------------------------------------------------- TA:SETNAME
+        elif command.find("setname") > -1:
+            if command.find('=') > -1:
+                parts = command.split('=')
+                if len(parts) != 2:
+                    message = "Bad TA:setname - must have a name after the \'=\' operator"
+                    self.send(build_TA_Response(2, message), "[2, \"%s\"]" % message)
+                else:
+                    with agentLock:
+                        AGENT_NAME = parts[LAST].strip()
+                    if VERBOSE: showMessage("Agent Name set to \"%s\"" % AGENT_NAME)
+                    message = "Agent Name set to \'%s\'" % AGENT_NAME
+                    self.send(build_TA_Response(0, message), "[0, \"%s\"]" % message)
+            else:
+                message = "TA:setname requires an assignment using \'=\'"
+                self.send(build_TA_Response(1, message), "[1, \"%s\"]" % message)
+        # --------------------------------------------- TA:GETUSERNAME
+        elif command == "getusername" or command == "GETUSERNAME":
+            self.send(build_TA_Response(0, USER), "[0, \"%s\"]" % USER)
+        # ----------------------------------------------- TA:LOCALTIME
+        elif command == "localtime" or command == "LOCALTIME":
+            self.send(build_TA_Response(0, now()))
+        # ------------------------------------------------ TA:PROTOCOL
+        elif command.split('=')[FIRST].strip() == "protocol":
+            self.setProtocol(command)
+        # -------------------------------------------------- TA:FORMAT
+        elif command.split('=')[FIRST].strip() == "format":
+            self.setFormat(command)
+        # ----------------------------------------------- TA:MULTIPLEX
+        elif command.split('=')[FIRST].strip() == "multiplex":
+            self.setMultiplex(command)
+        # ---------------------------------------------------- TA:PING
+        elif command.split('=')[FIRST].strip() == "ping":
+            payload = command.split('=', 1)[LAST] if command.find('=') > -1 else None
+            self.send(build_TA_Response(0, "PONG", payload))
+        # ------------------------------------------------ TA:COMPRESS
+        elif command.split('=')[FIRST].strip() == "compress":
+            self.setCompression(command)
+        # --------------------------------------------------- TA:SHELL
+        elif command.split('=')[FIRST].strip() == "shell":
+            self.setShell(command)
+        # ------------------------------------------ TA:CACHE, UNCACHE
+        elif command.split('=')[FIRST].strip() in ("cache", "uncache"):
+            self.processCache(command)
+        # ------------------------------------------------- TA:STATS
+        elif command.split('=')[FIRST].strip() == "stats":
+            argument = command.split('=', 1)[LAST].strip() if command.find('=') > -1 else ""
+            if argument == "reset":
+                agentStats.reset()
+                self.send(build_TA_Response(0, "STATS RESET"))
+            elif argument == "":
+                snapshot = agentStats.snapshot()
+                self.send(build_TA_Response(0, "STATS %.1fs" % snapshot["seconds"], snapshot))
+            else:
+                self.send(build_TA_Response(97, "Unknown TA:stats argument \"%s\"" % argument))
+        # ---------------------------------- TA:PROC, FDS, SOCKETS, LOADAVG
+        elif command.split('=')[FIRST].strip() in ("proc", "fds", "sockets", "loadavg"):
+            self.processTelemetry(command)
+        # ---------------------------------------------------- TA:HELP
+        elif command == "help" or command == "HELP":
+            message = "Valid TA Commands are: version, localtime, protocol, format, proc, fds, sockets, loadavg, cache, uncache, stats, compress, shell, multiplex, ping, bye, shutdown, restart, help"
+            self.send(build_TA_Response(0, message))
+        # --------------------------------------------- TA:BAD COMMAND
+        else:
+            message = "Unknown TA Command \"%s\"" % command
+            self.send(build_TA_Response(97, message))
+
+    # ----------------------------------------------------- Session.setProtocol()
+    def setProtocol(self, command):
+        """ TA:protocol[=1|2] - reports or switches the session wire protocol.
+            The reply goes out in the old protocol, then the switch happens. """
+        parts = command.split('=', 1)
+        if len(parts) == 1:
+            self.send(build_TA_Response(0, "PROTOCOL %d" % (2 if self.framed else 1)))
+            return
+        version = parts[LAST].strip()
+        if version not in ("1", "2"):
+            self.send(build_TA_Response(97, "Unknown protocol \"%s\", must be 1 or 2" % version))
+            return
+        self.send(build_TA_Response(0, "PROTOCOL %s" % version))
+        self.framed = (version == "2")
+        if not self.framed:
+            self.compressThreshold = None  # Compression needs the frame flag
+            self.stopMultiplexer()         # Out of order replies need frames
+
+    # ------------------------------------------------------- Session.setFormat()
+    def setFormat(self, command):
+        """ TA:format[=text|json] - reports or switches the reply encoding.
+            The reply to the switch is already in the new format. """
+        parts = command.split('=', 1)
+        if len(parts) > 1:
+            replyFormat = parts[LAST].strip().lower()
+            if replyFormat not in ("text", "json"):
+                self.send(build_TA_Response(97, "Unknown format \"%s\", must be text or json" % replyFormat))
+                return
+            self.jsonReplies = (replyFormat == "json")
+        self.send(build_TA_Response(0, "FORMAT %s" % ("json" if self.jsonReplies else "text")))
+
+    # -------------------------------------------------- Session.setCompression()
+    def setCompression(self, command):
+        """ TA:compress[=on|off|BYTES] - reports or switches compressed replies.
+            The reply to the switch is sent before the switch happens. """
+        parts = command.split('=', 1)
+        threshold = self.compressThreshold
+        if len(parts) > 1:
+            setting = parts[LAST].strip().lower()
+            if not self.framed:
+                self.send(build_TA_Response(221, "TA:compress requires TA:protocol=2"))
+                return
+            try:
+                if setting == "on":
+                    threshold = COMPRESS_THRESHOLD
+                elif setting == "off":
+                    threshold = None
+                else:
+                    threshold = int(setting)
+                    if threshold < 0: raise ValueError()
+            except ValueError:
+                self.send(build_TA_Response(97, "Unknown compress setting \"%s\", must be on, off or bytes" % setting))
+                return
+        if threshold is None:
+            self.send(build_TA_Response(0, "COMPRESS off"))
+        else:
+            self.send(build_TA_Response(0, "COMPRESS %d" % threshold))
+        self.compressThreshold = threshold
+
+    # ---------------------------------------------------- Session.setMultiplex()
+    def setMultiplex(self, command):
+        """ TA:multiplex[=on|off|N] - reports, starts or stops concurrent
+            tagged requests on this session. """
+        parts = command.split('=', 1)
+        if len(parts) > 1:
+            setting = parts[LAST].strip().lower()
+            if not self.framed:
+                self.send(build_TA_Response(221, "TA:multiplex requires TA:protocol=2"))
+                return
+            try:
+                if setting == "on":
+                    parallel = MUX_PARALLEL
+                elif setting == "off":
+                    parallel = 0
+                else:
+                    parallel = int(setting)
+                    if parallel < 1 or parallel > MAX_MUX_PARALLEL: raise ValueError()
+            except ValueError:
+                message = "Unknown multiplex setting \"%s\", must be on, off or 1-%d" % (setting, MAX_MUX_PARALLEL)
+                self.send(build_TA_Response(97, message))
+                return
+            self.stopMultiplexer()
+            if parallel > 0:
+                self.multiplexer = ThreadPoolExecutor(max_workers=parallel,
+                                                      thread_name_prefix="mux-%s:%s" % self.remoteAddr)
+                self.multiplexParallel = parallel
+        if self.multiplexer is None:
+            self.send(build_TA_Response(0, "MULTIPLEX off"))
+        else:
+            self.send(build_TA_Response(0, "MULTIPLEX %d" % self.multiplexParallel))
+
+    # ------------------------------------------------- Session.stopMultiplexer()
+    def stopMultiplexer(self):
+        """ Waits for outstanding multiplexed requests, then stops the threads. """
+        if self.multiplexer is not None:
+            self.multiplexer.shutdown(wait=True)
+            self.multiplexer = None
+
+    # -------------------------------------------------------- Session.setShell()
+    def setShell(self, command):
+        """ TA:shell[=on|off] - reports, starts or stops the session's
+            persistent shell. """
+        parts = command.split('=', 1)
+        if len(parts) > 1:
+            setting = parts[LAST].strip().lower()
+            if setting == "on" and self.shell is None:
+                try:
+                    self.shell = PersistentShell()
+                except OSError as e:
+                    self.send(build_TA_Response(97, "Unable to start a shell: %s" % str(e)))
+                    return
+            elif setting == "off" and self.shell is not None:
+                self.shell.close()
+                self.shell = None
+            elif setting not in ("on", "off"):
+                self.send(build_TA_Response(97, "Unknown shell setting \"%s\", must be on or off" % setting))
+                return
+        self.send(build_TA_Response(0, "SHELL %s" % ("on" if self.shell is not None else "off")))
+
+    # ---------------------------------------------------- Session.restartAgent()
+    def restartAgent(self, command):
+        """ TA:restart[=force] - starts the new agent on our listening socket,
+            then ends this session and stops this agent's listener. """
+        force = command.split('=', 1)[LAST].strip() == "force" if command.find('=') > -1 else False
+        if WORKER_INDEX is not None:
+            self.send(build_TA_Response(204, "Unable to restart: not available with --workers"))
+            return
+        running = jobTable.running()
+        if running > 0 and not force:
+            message = "Unable to restart: %d job(s) running, TA:restart=force cancels them" % running
+            self.send(build_TA_Response(204, message))
+            return
+        replies = queue.Queue(1)
+        restartRequests.put(replies)  # The listener starts the new agent, see handOverListener()
+        try:
+            os.write(wakeWriter, b"r")
+            result = replies.get(timeout=RESTART_TIMEOUT + ACCEPT_POLL + 1.0)
+        except (OSError, queue.Empty):
+            result = OSError("the listener is shutting down")
+        if isinstance(result, Exception):
+            self.send(build_TA_Response(204, "Unable to restart: %s" % str(result)))
+            if LOGGING: log.logit("TA:restart failed: %s" % str(result), ERROR)
+            return
+        message = "RESTARTING AGENT, NEW PID %d" % result.pid
+        if LOGGING: log.logit(message)
+        self.send(build_TA_Response(0, message))
+        self.active = False  # Flag end of session
+
+    # ---------------------------------------------------- Session.processCache()
+    def processCache(self, command):
+        """ TA:cache (counters), TA:cache=clear and TA:uncache=COMMAND. """
+        parts = command.split('=', 1)
+        name = parts[FIRST].strip()
+        argument = parts[LAST].strip() if len(parts) > 1 else ""
+        if name == "uncache":
+            dropped = resultCache.invalidate(argument)
+            self.send(build_TA_Response(0, "UNCACHED %d" % dropped))
+        elif argument == "clear":
+            dropped = resultCache.invalidate()
+            self.send(build_TA_Response(0, "CLEARED %d" % dropped))
+        elif argument == "":
+            counters = resultCache.counters()
+            message = "CACHE %d hits, %d misses" % (counters["hits"], counters["misses"])
+            self.send(build_TA_Response(0, message, counters))
+        else:
+            self.send(build_TA_Response(97, "Unknown TA:cache argument \"%s\"" % argument))
+
+    # ------------------------------------------------ Session.processTelemetry()
+    def processTelemetry(self, command):
+        """ TA:proc=, TA:fds=, TA:sockets[=port] and TA:loadavg - read /proc
+            in the agent itself, no subprocess. """
+        parts = command.split('=', 1)
+        name = parts[FIRST].strip()
+        argument = parts[LAST].strip() if len(parts) > 1 else ""
+        try:
+            if name == "proc":
+                if len(argument) < 1:
+                    raise ValueError("TA:proc needs a process name or pid")
+                data = []
+                for pid in findProcesses(argument):
+                    try:
+                        data.append(self._sampleProcess(pid))
+                    except OSError:
+                        pass  # Exited while we looked
+                message = "PROC %d" % len(data)
+            elif name == "fds":
+                data = countFileDescriptors(int(argument))
+                message = "FDS %d" % data
+            elif name == "sockets":
+                data = socketStates(int(argument) if argument else None)
+                message = "SOCKETS %d" % sum(data.values())
+            else:
+                data = loadAverage()
+                message = "LOADAVG %s %s %s" % (data["1m"], data["5m"], data["15m"])
+        except (OSError, ValueError) as e:
+            self.send(build_TA_Response(202, "Unable to read %s: %s" % (name, str(e))))
+            return
+        self.send(build_TA_Response(0, message, data))
+
+    # --------------------------------------------------- Session._sampleProcess()
+    def _sampleProcess(self, pid):
+        """ readProcess() plus cpu_percent since this session's last sample. """
+        sample = readProcess(pid)
+        sampledAt = time.monotonic()
+        previous = self._cpuSamples.get(pid)
+        if previous is not None and sampledAt > previous[FIRST]:
+            elapsed = sampledAt - previous[FIRST]
+            used = sample["cpu_seconds"] - previous[LAST]
+        else:
+            elapsed = sample["age_seconds"]
+            used = sample["cpu_seconds"]
+        sample["cpu_percent"] = round(100.0 * used / elapsed, 2) if elapsed > 0 else 0.0
+        self._cpuSamples[pid] = (sampledAt, sample["cpu_seconds"])
+        return sample
+
+    # ------------------------------------------------------- Session.processOS()
+    def processOS(self, command, options):
+        """ Executes a command on the operating system the agent runs on. """
+        #
+        #    *** **************************** ***
+        #    *** OS DIRECTIVES PROCESSED HERE ***
+        #    *** **************************** ***
+        #
+        if VERBOSE: showMessage("OS Command \"%s\"" % command)
+        try:
+            settings = commandSettings(options)
+            cacheTTL = cacheSetting(options)
+        except ValueError as e:
+            self.send(build_TA_Response(220, "Unable to process OS Command: %s" % str(e)))
+            return
+        if "stream" in options:
+            self.streamOS(command, settings)
+            return
+        if "async" in options:
+            job = jobTable.start(command, settings)
+            if job is None:
+                self.send(build_TA_Response(226, "Unable to start job: %d jobs already running" % MAX_JOBS))
+                return
+            response = build_TA_Response(0, "JOB %d" % job.jobId)
+            response.update({JOB_ID: job.jobId, OS_COMMAND: job.command.command})
+            self.send(response)
+            return
+        if self.shell is not None and not ({"shell", "cpu", "maxrss"} & set(options)):
+            results = self.shell.run(command, settings.get("timeout"), settings.get("maxout"), self.connection)
+        else:
+            results = executeCommand(command, cacheTTL, **settings)
+        if results["limit"]:
+            message = "LIMIT %s" % results["limit"]
+        else:
+            message = "CACHED" if results.get("cached") else ""
+        response = build_OS_Response(0,
+                                     message,
+                                     results["command"],
+                                     results["output"],
+                                     results["error"],
+                                     results["returnCode"])
+        if any(key in settings for key in LIMIT_KEYS):
+            response[OS_LIMIT] = results["limit"]
+        self.send(response)
+
+    # ---------------------------------------------------- Session.processBATCH()
+    def processBATCH(self, command, options):
+        """ BATCH:["cmd", ...] - runs several OS commands and returns all of
+            their results in a single reply. """
+        try:
+            commands = json.loads(command)
+            if not isinstance(commands, list) or len(commands) < 1:
+                raise ValueError("expected a non-empty JSON list of commands")
+            commands = [str(c) for c in commands]
+            settings = commandSettings(options)
+            cacheTTL = cacheSetting(options)
+            if "sequential" in options:
+                parallel = 1
+            else:
+                parallel = int(options.get("parallel", BATCH_PARALLEL))
+                parallel = max(1, min(parallel, MAX_BATCH_PARALLEL, len(commands)))
+        except Exception as e:
+            self.send(build_TA_Response(222, "Unable to process BATCH: %s" % str(e)))
+            return
+        if VERBOSE: showMessage("BATCH of %d commands, %d at a time" % (len(commands), parallel))
+        if parallel == 1:
+            results = [runOSCommand(c, settings, cacheTTL) for c in commands]
+        else:
+            with ThreadPoolExecutor(max_workers=parallel) as pool:
+                results = list(pool.map(runOSCommand, commands,
+                                        [settings] * len(commands),
+                                        [cacheTTL] * len(commands)))
+        response = build_TA_Response(0, "BATCH OF %d" % len(commands))
+        response[OS_RESULTS] = results
+        self.send(response)
+
+    # ------------------------------------------------------ Session.processJOB()
+    def processJOB(self, command, options):
+        """ JOB:ACTION=ID - status, output, wait, cancel or forget an
+            OS,async job, or JOB:list for every job. """
+        parts = command.split('=', 1)
+        action = parts[FIRST].strip().lower()
+        if action == "list":
+            jobs = [job.status() for job in jobTable.list()]
+            self.send(build_TA_Response(0, "JOBS %d" % len(jobs), jobs))
+            return
+        try:
+            if action not in ("status", "output", "wait", "cancel", "forget"):
+                raise ValueError("unknown action \"%s\"" % action)
+            if len(parts) != 2:
+                raise ValueError("JOB:%s needs a job ID after the \'=\' operator" % action)
+            job = jobTable.get(int(parts[LAST]))
+            if job is None:
+                raise ValueError("no job %s" % parts[LAST].strip())
+            stdoutOffset = int(options.get("stdout", 0))
+            stderrOffset = int(options.get("stderr", 0))
+            timeout = float(options.get("timeout", JOB_WAIT))
+        except ValueError as e:
+            self.send(build_TA_Response(225, "Unable to process JOB: %s" % str(e)))
+            return
+        if action == "forget":
+            if not jobTable.forget(job):
+                self.send(build_TA_Response(225, "Unable to process JOB: job %d is still running" % job.jobId))
+                return
+            self.send(build_TA_Response(0, "FORGOTTEN %d" % job.jobId))
+            return
+        if action == "cancel":
+            job.command.cancel()
+            job.done.wait(CLOSE_LINGER)
+        elif action == "wait":
+            job.done.wait(max(0.0, timeout))
+        if action in ("output", "wait"):
+            self.send(job.output(stdoutOffset, stderrOffset))
+        else:
+            self.send(job.status())
+
+    # ------------------------------------------------------ Session.processGET()
+    def processGET(self, path, options):
+        """ GET[,offset=N]:PATH - sends the header reply, then the file from
+            FILE_OFFSET as raw bytes with sendfile(). """
+        if not self.framed:
+            self.send(build_TA_Response(221, "GET requires TA:protocol=2"))
+            return
+        try:
+            offset = int(options.get("offset", 0))
+            if offset < 0: raise ValueError("bad offset \"%s\"" % options["offset"])
+            transfer = open(path, 'rb')
+        except (ValueError, OSError) as e:
+            self.send(build_TA_Response(223, "Unable to GET %s: %s" % (path, str(e))))
+            return
+        with transfer:
+            try:
+                size = os.fstat(transfer.fileno()).st_size
+                checksum = fileSHA256(transfer)
+            except OSError as e:
+                self.send(build_TA_Response(223, "Unable to GET %s: %s" % (path, str(e))))
+                return
+            if offset > size:
+                offset = 0  # Stale partial copy on the client, start over
+            response = build_TA_Response(0, "GET")
+            response.update({FILE_PATH: path, FILE_SIZE: size, FILE_OFFSET: offset,
+                             FILE_LENGTH: size - offset, FILE_SHA256: checksum})
+            with self._sendLock:  # No multiplexed reply may land inside the file data
+                self.send(response)
+                if size > offset:
+                    self.connection.sendfile(transfer, offset, size - offset)
+                    agentStats.bytesOut += size - offset
+        if LOGGING: log.logit("Sent %s (%d bytes from %d) to %s" % (path, size - offset, offset, str(self.remoteAddr)))
+
+    # ------------------------------------------------------ Session.processPUT()
+    def processPUT(self, path, options):
+        """ PUT,size=N[,sha256=HEX][,mode=OCTAL]:PATH - replies READY with the
+            offset to resume from, receives the rest of the file into
+            PATH.part and moves it to PATH once the checksum matches. """
+        if not self.framed:
+            self.send(build_TA_Response(221, "PUT requires TA:protocol=2"))
+            return
+        partPath = path + ".part"
+        try:
+            size = int(options.get("size", -1))
+            if size < 0: raise ValueError("size=BYTES is required")
+            mode = int(str(options["mode"]), 8) if "mode" in options else None
+            expected = str(options.get("sha256", "")).lower()
+            transfer = open(partPath, 'ab')
+            offset = transfer.tell()
+            if offset > size:
+                transfer.truncate(0)  # Stale partial upload, start over
+                offset = 0
+        except (ValueError, OSError) as e:
+            self.send(build_TA_Response(223, "Unable to PUT %s: %s" % (path, str(e))))
+            return
+        with transfer:
+            response = build_TA_Response(0, "READY")
+            response.update({FILE_PATH: path, FILE_SIZE: size, FILE_OFFSET: offset})
+            self.send(response)
+            remaining = size - offset
+            if self._pending:
+                data, self._pending = self._pending[:remaining], self._pending[remaining:]
+                transfer.write(data)
+                remaining -= len(data)
+            buffer = bytearray(FILE_CHUNK)
+            while remaining > 0:
+                count = self.connection.recv_into(buffer, min(remaining, FILE_CHUNK))
+                if count == 0:
+                    # Keep PATH.part so the next PUT can resume
+                    message = "PUT of %s interrupted with %d bytes missing" % (path, remaining)
+                    if LOGGING: log.logit(message, WARN)
+                    self.active = False
+                    return
+                agentStats.bytesIn += count
+                transfer.write(memoryview(buffer)[:count])
+                remaining -= count
+        try:
+            with open(partPath, 'rb') as received:
+                checksum = fileSHA256(received)
+            if expected and checksum != expected:
+                os.remove(partPath)
+                message = "Checksum mismatch for %s: got %s, expected %s" % (path, checksum, expected)
+                self.send(build_TA_Response(224, message))
+                return
+            if mode is not None:
+                os.chmod(partPath, mode)
+            os.replace(partPath, path)
+        except OSError as e:
+            self.send(build_TA_Response(223, "Unable to PUT %s: %s" % (path, str(e))))
+            return
+        response = build_TA_Response(0, "PUT")
+        response.update({FILE_PATH: path, FILE_SIZE: size, FILE_SHA256: checksum})
+        self.send(response)
+        if LOGGING: log.logit("Received %s (%d bytes) from %s" % (path, size, str(self.remoteAddr)))
+
+    # -------------------------------------------------------- Session.streamOS()
+    def streamOS(self, command, settings):
+        """ OS,stream - sends each chunk of output as its own frame, then a
+            final STREAM END frame carrying the return code. """
+        if not self.framed:
+            self.send(build_TA_Response(221, "OS,stream requires TA:protocol=2"))
+            return
+        c = Command(command, **settings)
+        c.stream(lambda name, text: self.send({AGENT_RETURN_CODE: 0,
+                                               AGENT_MESSAGE: "STREAM",
+                                               OS_COMMAND: c.command,
+                                               OS_STREAM: name,
+                                               OS_DATA: text}))
+        response = build_OS_Response(0, "STREAM END", c.command, c.output, c.error, c.returnCode)
+        if c.limited:
+            response[OS_LIMIT] = c.limitHit
+        self.send(response)
+
+# === End of class Session =====
+
+
+# =============================================================== ExecutorPool()
+class ExecutorPool:
+
+    """ A warm pool of pre-forked executor processes (agent.py --executor).
+        Each executor runs one command at a time; callers wait for a free one. """
+
+    # --------------------------------------------------- ExecutorPool.__init__()
+    def __init__(self, size):
+        """ Starts size executor processes. """
+        self.size  = int(size)
+        self._idle = queue.Queue()
+        for i in range(self.size):
+            self._idle.put(self._spawn())
+
+    # ----------------------------------------------------- ExecutorPool._spawn()
+    def _spawn(self):
+        """ Starts one executor process. """
+        return subprocess.Popen([sys.executable, os.path.realpath(__file__), "--executor"],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+
+    # -------------------------------------------------------- ExecutorPool.run()
+    def run(self, command, options):
+        """ Runs a command on the next free executor and returns its results.
+            A dead executor is replaced and the command run locally instead. """
+        executor = self._idle.get()
+        try:
+            request = json.dumps({"command": command, "options": options}) + "\n"
+            executor.stdin.write(request.encode('utf-8'))
+            executor.stdin.flush()
+            reply = executor.stdout.readline()
+            if not reply:
+                raise OSError("executor %d exited" % executor.pid)
+            return json.loads(reply)
+        except (OSError, ValueError) as e:
+            message = "Executor failed, replacing it: %s" % str(e)
+            showWarning(message)
+            if LOGGING: log.logit(message, WARN)
+            executor.kill()
+            executor.wait()
+            executor = self._spawn()
+            c = Command(command, **options)
+            c.run()
+            return c.returnResults()
+        finally:
+            self._idle.put(executor)
+
+    # ------------------------------------------------------ ExecutorPool.close()
+    def close(self):
+        """ Stops the idle executors by closing their request pipes. """
+        while True:
+            try:
+                executor = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                executor.stdin.close()
+                executor.wait(1.0)
+            except (OSError, subprocess.TimeoutExpired):
+                executor.kill()
+
+# === End of class ExecutorPool =====
+
+
+# ================================================================ ResultCache()
+class ResultCache:
+
+    """ TTL and LRU bounded cache of OS command results, shared by sessions. """
+
+    # ---------------------------------------------------- ResultCache.__init__()
+    def __init__(self, size):
+        """ Creates a cache holding at most size results. """
+        self.size      = int(size)
+        self._entries  = OrderedDict()  # key -> (expires, results), oldest use first
+        self._lock     = threading.Lock()
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+
+    # --------------------------------------------------------- ResultCache.get()
+    def get(self, key):
+        """ Returns a copy of the cached results marked "cached", or None. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[FIRST] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]  # Expired
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        results = dict(entry[LAST])
+        results["cached"] = True
+        return results
+
+    # --------------------------------------------------------- ResultCache.put()
+    def put(self, key, results, ttl):
+        """ Stores results for ttl seconds, evicting the least recently used. """
+        if self.size < 1:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, results)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    # -------------------------------------------------- ResultCache.invalidate()
+    def invalidate(self, command=None):
+        """ Drops every entry, or only those for one command. Returns the count. """
+        with self._lock:
+            if command is None:
+                dropped = len(self._entries)
+                self._entries.clear()
+            else:
+                keys = [key for key in self._entries if key[FIRST] == command]
+                for key in keys:
+                    del self._entries[key]
+                dropped = len(keys)
+        return dropped
+
+    # ---------------------------------------------------- ResultCache.counters()
+    def counters(self):
+        """ Hit/miss/eviction counters and the current number of entries. """
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": len(self._entries),
+                    "size": self.size}
+
+# === End of class ResultCache =====
+
+
+# ========================================================================= Job()
+class Job:
+
+    """ One OS,async command, run on its own thread with its output kept in
+        memory so any session can fetch it later. """
+
+    # ------------------------------------------------------------ Job.__init__()
+    def __init__(self, jobId, command, settings):
+        """ Creates the job and starts its command. """
+        self.jobId    = jobId
+        self.command  = Command(command, detach=True, **settings)
+        self.state    = "running"         # running, done or cancelled
+        self.started  = time.monotonic()
+        self.ended    = None              # time.monotonic() when the command ended
+        self.done     = threading.Event()  # Set when the command has ended
+        self._stdout  = []                # Output chunks, joined when read
+        self._stderr  = []
+        self._lock    = threading.Lock()
+        worker = threading.Thread(target=self._run, name="job-%d" % jobId)
+        worker.daemon = True
+        worker.start()
+
+    # ---------------------------------------------------------------- Job._run()
+    def _run(self):
+        """ Thread body: runs the command to the end. """
+        try:
+            self.command.stream(self._collect)
+            if self.command.error:
+                self._collect("stderr", self.command.error)  # Could not start
+        finally:
+            with self._lock:
+                self.state = "cancelled" if self.command.limitHit == "cancel" else "done"
+                self.ended = time.monotonic()
+            self.done.set()
+            if LOGGING: log.logit("Job %d %s with %d" % (self.jobId, self.state, self.command.returnCode))
+
+    # ------------------------------------------------------------ Job._collect()
+    def _collect(self, name, text):
+        with self._lock:
+            (self._stdout if name == "stdout" else self._stderr).append(text)
+
+    # ------------------------------------------------------------- Job._joined()
+    def _joined(self, chunks):
+        """ Joins the chunks in place (caller holds the lock) and returns the text. """
+        if len(chunks) > 1:
+            chunks[:] = ["".join(chunks)]
+        return chunks[FIRST] if chunks else ""
+
+    # -------------------------------------------------------------- Job.status()
+    def status(self):
+        """ Returns the job state as a reply dictionary without the output. """
+        with self._lock:
+            return self._status()
+
+    # ------------------------------------------------------------- Job._status()
+    def _status(self):
+        """ status() for callers already holding the lock. """
+        ended = self.ended if self.ended is not None else time.monotonic()
+        finished = self.state != "running"
+        return {AGENT_RETURN_CODE: 0,
+                AGENT_MESSAGE: self.state.upper(),
+                JOB_ID: self.jobId,
+                JOB_STATE: self.state,
+                JOB_SECONDS: round(ended - self.started, 3),
+                JOB_STDOUT_SIZE: len(self._joined(self._stdout)),
+                JOB_STDERR_SIZE: len(self._joined(self._stderr)),
+                OS_COMMAND: self.command.command,
+                OS_RETURNCODE: self.command.returnCode if finished else None,
+                OS_LIMIT: self.command.limitHit if finished else ""}
+
+    # -------------------------------------------------------------- Job.output()
+    def output(self, stdoutOffset=0, stderrOffset=0):
+        """ Returns the job state plus its output past the given offsets. """
+        with self._lock:
+            response = self._status()
+            response[OS_STDOUT] = self._joined(self._stdout)[stdoutOffset:]
+            response[OS_STDERR] = self._joined(self._stderr)[stderrOffset:]
+        return response
+
+# === End of class Job =====
+
+
+# ==================================================================== JobTable()
+class JobTable:
+
+    """ The agent's OS,async jobs by JOB_ID, shared by every session. """
+
+    # ------------------------------------------------------- JobTable.__init__()
+    def __init__(self):
+        """ Creates an empty table. """
+        self._jobs   = OrderedDict()  # JOB_ID -> Job, oldest first
+        self._nextId = 1
+        self._lock   = threading.Lock()
+
+    # ---------------------------------------------------------- JobTable.start()
+    def start(self, command, settings):
+        """ Starts a job and returns it, or None when MAX_JOBS are running.
+            Finished jobs older than JOB_KEEP are dropped on the way. """
+        with self._lock:
+            expired = time.monotonic() - JOB_KEEP
+            for jobId, job in list(self._jobs.items()):
+                if job.ended is not None and job.ended < expired:
+                    del self._jobs[jobId]
+            if self._running() >= MAX_JOBS:
+                return None
+            job = Job(self._nextId, command, settings)
+            self._jobs[job.jobId] = job
+            self._nextId += 1
+        if LOGGING: log.logit("Job %d started: %s" % (job.jobId, command))
+        return job
+
+    # -------------------------------------------------------- JobTable.running()
+    def running(self):
+        """ Returns the number of jobs still running. """
+        with self._lock:
+            return self._running()
+
+    # ------------------------------------------------------- JobTable._running()
+    def _running(self):
+        """ running() with _lock held """
+        return len([job for job in self._jobs.values() if not job.done.is_set()])
+
+    # ------------------------------------------------------------ JobTable.get()
+    def get(self, jobId):
+        """ Returns the job with this JOB_ID, or None. """
+        with self._lock:
+            return self._jobs.get(jobId)
+
+    # ----------------------------------------------------------- JobTable.list()
+    def list(self):
+        """ Returns every job, oldest first. """
+        with self._lock:
+            return list(self._jobs.values())
+
+    # --------------------------------------------------------- JobTable.forget()
+    def forget(self, job):
+        """ Drops a finished job. Returns False if it is still running. """
+        if not job.done.is_set():
+            return False
+        with self._lock:
+            self._jobs.pop(job.jobId, None)
+        return True
+
+    # ------------------------------------------------------ JobTable.cancelAll()
+    def cancelAll(self, deadline):
+        """ Cancels every running job and waits up to deadline seconds for
+            them to end. Returns the number of jobs cancelled. """
+        running = [job for job in self.list() if not job.done.is_set()]
+        for job in running:
+            job.command.cancel()
+        ends = time.monotonic() + deadline
+        for job in running:
+            job.done.wait(max(0.0, ends - time.monotonic()))
+        return len(running)
+
+# === End of class JobTable =====
+
+
+# ============================================================= PersistentShell()
+class PersistentShell:
+
+    """ A /bin/sh coprocess kept for one session (TA:shell=on), so state such
+        as the working folder and exported variables carries over between OS
+        commands. Each command is followed by a sentinel line on stdout (with
+        its exit status) and on stderr, which marks the end of its output. """
+
+    # ------------------------------------------------ PersistentShell.__init__()
+    def __init__(self):
+        """ Creates the object; the shell itself starts with the first command. """
+        self._process  = None
+        self._sentinel = None
+
+    # --------------------------------------------------- PersistentShell._start()
+    def _start(self):
+        """ Starts the shell in its own process group with a new sentinel. """
+        self._sentinel = "__AGENT_END_%s__" % os.urandom(8).hex()
+        self._process = subprocess.Popen(["/bin/sh"],
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE,
+                                         start_new_session=True)
+
+    # ------------------------------------------------------ PersistentShell.run()
+    def run(self, command, timeout=None, maxout=None, connection=None):
+        """ Runs a command in the shell and returns a Command.returnResults()
+            style dictionary. Hitting timeout or maxout (bytes), or the client
+            closing connection while the command runs, kills the shell and
+            everything in its process group; the next command gets a new one. """
+        results = {"command": command.strip(), "output": "", "error": "", "returnCode": 113, "limit": ""}
+        if self._process is None or self._process.poll() is not None:
+            self._start()
+        marker = b"\n" + self._sentinel.encode('utf-8')
+        script = "command eval %s </dev/null\n" % shlex.quote(command)
+        script += "printf '\\n%%s %%d\\n' %s $?; printf '\\n%%s\\n' %s >&2\n" % (self._sentinel, self._sentinel)
+        try:
+            self._process.stdin.write(script.encode('utf-8'))
+            self._process.stdin.flush()
+        except OSError as e:
+            self.close()
+            results["error"] = "Unable to execute: \"%s\" - %s" % (command, str(e))
+            return results
+
+        stdoutFd = self._process.stdout.fileno()
+        buffers  = {stdoutFd: bytearray(), self._process.stderr.fileno(): bytearray()}
+        found    = {}     # fd -> offset of its sentinel in buffers[fd]
+        finished = set()  # fds whose whole sentinel line has been read
+        exited   = False  # The shell itself exited ("exit" in the command)
+        # Room for the two sentinel lines on top of maxout bytes of output
+        allowed  = None if maxout is None else maxout + 2 * (len(marker) + 16)
+        selector = selectors.DefaultSelector()
+        selector.register(self._process.stdout, selectors.EVENT_READ)
+        selector.register(self._process.stderr, selectors.EVENT_READ)
+        if connection is not None:
+            selector.register(connection, selectors.EVENT_READ)
+        deadline = None if timeout is None else time.monotonic() + float(timeout)
+        try:
+            while len(finished) < 2 and not exited and not results["limit"]:
+                if deadline is not None and time.monotonic() >= deadline:
+                    results["limit"] = "timeout"
+                    break
+                wait = None if deadline is None else max(0.0, deadline - time.monotonic())
+                for key, mask in selector.select(wait):
+                    if key.fileobj is connection:
+                        try:
+                            gone = connection.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+                        except BlockingIOError:
+                            gone = False
+                        except OSError:
+                            gone = True
+                        if gone:
+                            results["limit"] = "disconnect"
+                        else:
+                            selector.unregister(connection)  # Pipelined request, read after this one
+                        continue
+                    chunk = os.read(key.fd, STREAM_CHUNK)
+                    if not chunk:
+                        exited = True
+                        break
+                    buffer = buffers[key.fd]
+                    if key.fd not in found:
+                        # Only the new chunk and the bytes a split sentinel could start in
+                        start = max(0, len(buffer) - len(marker) + 1)
+                        buffer += chunk
+                        offset = buffer.find(marker, start)
+                        if offset > -1:
+                            found[key.fd] = offset
+                    else:
+                        buffer += chunk
+                    if key.fd in found and buffer.find(b"\n", found[key.fd] + len(marker)) > -1:
+                        finished.add(key.fd)
+                if allowed is not None and sum(len(b) for b in buffers.values()) > allowed:
+                    results["limit"] = "maxout"
+        finally:
+            selector.close()
+
+        stdout = bytes(buffers[stdoutFd])
+        stderr = bytes(buffers[self._process.stderr.fileno()])
+        if results["limit"]:
+            self.close()  # State is lost, the next command gets a new shell
+            results["returnCode"] = -signal.SIGKILL
+        elif exited:
+            results["returnCode"] = self._process.wait()
+            self.close()
+        else:
+            stdout, status = stdout[:found[stdoutFd]], stdout[found[stdoutFd] + len(marker):]
+            stderr = stderr[:found[self._process.stderr.fileno()]]
+            results["returnCode"] = int(status.split()[FIRST])
+        if maxout is not None:
+            stdout = stdout[:maxout]
+            stderr = stderr[:max(0, maxout - len(stdout))]
+        results["output"] = stdout.decode('utf-8', 'replace').strip()
+        results["error"]  = stderr.decode('utf-8', 'replace').strip()
+        return results
+
+    # ---------------------------------------------------- PersistentShell.abort()
+    def abort(self):
+        """ Kills the shell's process group from another thread (shutdown),
+            so a run() in progress sees the shell exit and returns. """
+        process = self._process
+        if process is not None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    # ---------------------------------------------------- PersistentShell.close()
+    def close(self):
+        """ Stops the shell and anything it left running in its process group. """
+        if self._process is None:
+            return
+        try:
+            os.killpg(self._process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self._process.wait()
+        for pipe in (self._process.stdin, self._process.stdout, self._process.stderr):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        self._process = None
+
+# === End of class PersistentShell =====
+
+
+# ================================================================= AgentStats()
+class AgentStats:
+
+    """ Load counters and per-directive latency histograms behind TA:stats.
+        Byte counters are bumped without the lock (a lost update under a race
+        only makes them slightly low); everything else is updated under it. """
+
+    # ----------------------------------------------------- AgentStats.__init__()
+    def __init__(self):
+        """ Creates an instance of an object of type AgentStats. """
+        self._lock = threading.Lock()
+        self._bounds = [STATS_MIN_MS * (2 ** n) / 1000.0 for n in range(STATS_BUCKETS)]
+        self.reset()
+
+    # -------------------------------------------------------- AgentStats.reset()
+    def reset(self):
+        """ Zeroes every counter; sessions still open stay counted as active. """
+        with self._lock:
+            self.started    = time.monotonic()
+            self.accepted   = 0
+            self.rejected   = 0
+            self.bytesIn    = 0
+            self.bytesOut   = 0
+            self.packedIn   = 0    # \
+            self.packedOut  = 0    #  > Reply compression: bytes before and after, time
+            self.packTime   = 0.0  # /
+            self.packFrames = 0
+            self.directives = {}  # DIRECTIVE -> [count, total, max, bucket counts...]
+
+    # ---------------------------------------------- AgentStats.sessionAccepted()
+    def sessionAccepted(self):
+        """ Counts one accepted client connection. """
+        with self._lock:
+            self.accepted += 1
+
+    # ---------------------------------------------- AgentStats.sessionRejected()
+    def sessionRejected(self):
+        """ Counts one client turned away with a busy reply. """
+        with self._lock:
+            self.rejected += 1
+
+    # --------------------------------------------------- AgentStats.compressed()
+    def compressed(self, before, after, elapsed):
+        """ Counts one reply compressed from before to after bytes. """
+        with self._lock:
+            self.packFrames += 1
+            self.packedIn   += before
+            self.packedOut  += after
+            self.packTime   += elapsed
+
+    # ------------------------------------------------------- AgentStats.record()
+    def record(self, directive, elapsed):
+        """ Counts one request of directive that took elapsed seconds. """
+        bucket = bisect.bisect_left(self._bounds, elapsed)  # Past the end = overflow bucket
+        with self._lock:
+            counts = self.directives.get(directive)
+            if counts is None:
+                counts = self.directives[directive] = [0, 0.0, 0.0] + [0] * (STATS_BUCKETS + 1)
+            counts[0] += 1
+            counts[1] += elapsed
+            counts[2] = max(counts[2], elapsed)
+            counts[3 + bucket] += 1
+
+    # ---------------------------------------------------- AgentStats._quantile()
+    def _quantile(self, counts, q):
+        """ Upper bound in seconds of the bucket holding the q quantile. """
+        rank = q * counts[0]
+        seen = 0
+        for bucket, n in enumerate(counts[3:]):
+            seen += n
+            if n and seen >= rank:
+                if bucket == STATS_BUCKETS:
+                    return counts[2]
+                return min(self._bounds[bucket], counts[2])
+        return counts[2]
+
+    # ----------------------------------------------------- AgentStats.snapshot()
+    def snapshot(self):
+        """ Returns the counters as a dictionary for TA:stats. """
+        with sessionsChanged:
+            active = len(activeSessions)
+            inFlight = sum(s.requestsInFlight() for s in activeSessions)
+        jobs = jobTable.running() if jobTable is not None else 0
+        with self._lock:
+            directives = {}
+            for directive, counts in self.directives.items():
+                directives[directive] = {
+                    "count": counts[0],
+                    "mean_ms": round(counts[1] / counts[0] * 1000.0, 3),
+                    "p50_ms": round(self._quantile(counts, 0.50) * 1000.0, 3),
+                    "p90_ms": round(self._quantile(counts, 0.90) * 1000.0, 3),
+                    "p99_ms": round(self._quantile(counts, 0.99) * 1000.0, 3),
+                    "max_ms": round(counts[2] * 1000.0, 3)}
+            return {"seconds": round(time.monotonic() - self.started, 3),
+                    "sessions_accepted": self.accepted,
+                    "sessions_rejected": self.rejected,
+                    "sessions_active": active,
+                    "requests_in_flight": inFlight + jobs,
+                    "jobs_running": jobs,
+                    "bytes_in": self.bytesIn,
+                    "bytes_out": self.bytesOut,
+                    "compression": {"replies": self.packFrames,
+                                    "bytes_before": self.packedIn,
+                                    "bytes_after": self.packedOut,
+                                    "ratio": round(self.packedIn / self.packedOut, 2) if self.packedOut else None,
+                                    "ms": round(self.packTime * 1000.0, 3)},
+                    "directives": directives}
+
+# === End of class AgentStats =====
+
+
 # ==============================================================================
 # NATIVE FUNCTIONS
 #    This section holds all of the functions used by the script.
@@ -371,36 +2450,55 @@ class Logger:
 # ---------------------------------------------------------------------- usage()
 def usage():
     """usage() - Prints the usage message on stdout. """
-    print "\n\n%s, Version %s, This is a Remote Agent.              " % (ME, VERSION)
-    print "\nUSAGE: %s [OPTIONS]                                    " % ME
-    print "                                                         "
-    print "OPTIONS:                                                 "
-    print "   -h --help      Display this message.                  "
-    print "   -v --verbose   Runs the program in verbose mode, default: %s. " % VERBOSE
-    print "   -d --debug     Runs the program on debug mode (implies verbose). "
-    print "   -p --port=     The TCP port number for the listener, default: %s " % PORT
-    print "   -a --address=  The TCP address for the listener, default: %s " % HOST
-    print "   -l --logging   Enables logging, default=%s, logfile=%s  " % (LOGGING, LOG_FILE)
-    print "   -b --buffer=   The size of the TCP comm. buffer, default: %d " % BUF_SIZE
-    print "                                                         "
-    print "EXIT CODES:                                              "
-    print "    0 - Successful completion of the program.            "
-    print "    1 - Cannot import this script as a module.           "
-    print "    2 - Bad command line arguments.                      "
-    print "    3 - Bad port, must be a an integer                   "
-    print "    4 - Bad port, must be between 1025-65534 inclusive   "
-    print "    5 - Bad address, must be a string                    "
-    print "    6 - Bad buffer, must be etween 1025-65534 inclusive "
-    print "                                                         "
-    print "EXAMPLES:                                                "
-    print "    TODO - I'll make some examples up later.             "
-    print "                                                         "
+    print("\n\n%s, Version %s, This is a Remote Agent.              " % (ME, VERSION))
+    print("\nUSAGE: %s [OPTIONS]                                    " % ME)
+    print("                                                         ")
+    print("OPTIONS:                                                 ")
+    print("   -h --help      Display this message.                  ")
+    print("   -v --verbose   Runs the program in verbose mode, default: %s. " % VERBOSE)
+    print("   -d --debug     Runs the program on debug mode (implies verbose). ")
+    print("   -p --port=     The TCP port number for the listener, default: %s " % PORT)
+    print("   -a --address=  The TCP address for the listener, default: %s " % HOST)
+    print("   -l --logging   Enables logging, default=%s, logfile=%s  " % (LOGGING, LOG_FILE))
+    print("   -b --buffer=   The size of the TCP comm. buffer, default: %d " % BUF_SIZE)
+    print("   -m --max-sessions= Concurrent client sessions, default: %d " % MAX_SESSIONS)
+    print("      --busy=     Past max sessions: reject (busy reply) or queue, default: %s " % BUSY_POLICY)
+    print("      --retry-after= Milliseconds rejected clients are told to wait, default: %d " % RETRY_AFTER)
+    print("   -B --backlog=  Connections waiting to be accepted, default: %d " % BACKLOG)
+    print("   -I --idle=     Seconds before an idle session is ended (0 = never), default: %s " % IDLE_TIMEOUT)
+    print("   -K --keepalive= Seconds before TCP keepalive probes (0 = off), default: %d " % KEEPALIVE)
+    print("   -D --drain=    Seconds in-flight sessions get to finish on shutdown, default: %s " % DRAIN_DEADLINE)
+    print("   -x --shell=    How OS commands start: auto, always or never, default: %s " % SHELL_MODE)
+    print("   -P --prefork=  Pre-forked executor processes, default: %d " % PREFORK)
+    print("      --benchmark= Time N command starts in each mode, then exit ")
+    print("   -C --cache-size= OS,cache results kept (0 disables caching), default: %d " % CACHE_SIZE)
+    print("   -W --workers=  Agent processes sharing the port (SO_REUSEPORT), default: %d " % WORKERS)
+    print("                                                         ")
+    print("EXIT CODES:                                              ")
+    print("    0 - Successful completion of the program.            ")
+    print("    1 - Cannot import this script as a module.           ")
+    print("    2 - Bad command line arguments.                      ")
+    print("    3 - Bad port, must be a an integer                   ")
+    print("    4 - Bad port, must be between 1025-65534 inclusive   ")
+    print("    5 - Bad address, must be a string                    ")
+    print("    6 - Bad buffer, must be etween 1025-65534 inclusive ")
+    print("    7 - Bad max sessions, must be a positive integer     ")
+    print("    8 - Bad drain deadline, must be a number of seconds >= 0 ")
+    print("    9 - Bad shell mode, must be auto, always or never    ")
+    print("   10 - Bad prefork, benchmark or cache size, must be an integer >= 0 ")
+    print("   11 - Bad workers, must be an integer >= 0 with SO_REUSEPORT available ")
+    print("   12 - Bad backlog, idle, keepalive, busy or retry-after setting ")
+    print("   13 - Bad --inherit-fd or --ready-fd (internal, used by TA:restart) ")
+    print("                                                         ")
+    print("EXAMPLES:                                                ")
+    print("    TODO - I'll make some examples up later.             ")
+    print("                                                         ")
 
 
 # ----------------------------------------------------------------------------- pause()
 def pause():
     """pause() Holds script execution until the user responds. """
-    raw_input(PAUSE_PROMPT)
+    input(PAUSE_PROMPT)
     return
 
 # ----------------------------------------------------------------------------- now()
@@ -435,11 +2533,13 @@ def showMessage(message):
 
 
 # ----------------------------------------------------------------------------- build_TA_Response()
-def build_TA_Response(taCode, taMessage):
+def build_TA_Response(taCode, taMessage, taData=None):
     response = {}
     try:
         response[AGENT_RETURN_CODE] = int(taCode)
         response[AGENT_MESSAGE] = str(taMessage)
+        if taData is not None:
+            response[AGENT_DATA] = taData
     except:
         response = {AGENT_RETURN_CODE: 99,
                     AGENT_MESSAGE: "Unable to process Test Agent Directive"}
@@ -462,6 +2562,503 @@ def build_OS_Response(taCode, taMessage, osCommand, osOutput, osError, osReturnc
     return response
 
 
+# ----------------------------------------------------------------------------- runOSCommand()
+def runOSCommand(command, settings, cacheTTL=None):
+    """ Runs one command and returns its OS_* result dictionary (no agent keys). """
+    results = executeCommand(command, cacheTTL, **settings)
+    response = {OS_COMMAND: results["command"],
+                OS_STDOUT: results["output"],
+                OS_STDERR: results["error"],
+                OS_RETURNCODE: results["returnCode"]}
+    if any(key in settings for key in LIMIT_KEYS):
+        response[OS_LIMIT] = results["limit"]
+    return response
+
+
+# ----------------------------------------------------------------------------- executeCommand()
+def executeCommand(command, cacheTTL=None, **settings):
+    """ Runs a command to completion, on a pre-forked executor when there is
+        a pool, and returns Command.returnResults(). settings are Command()
+        keyword arguments (shell and limits). With a cacheTTL, a fresh cached
+        result is returned instead (marked "cached": True) and a successful
+        result is cached. """
+    if cacheTTL is not None:
+        key = (command, tuple(sorted(settings.items())))
+        results = resultCache.get(key)
+        if results is not None:
+            return results
+    if executorPool is not None:
+        results = executorPool.run(command, settings)
+    else:
+        c = Command(command, **settings)
+        c.run()
+        results = c.returnResults()
+    if cacheTTL is not None and results["returnCode"] == 0 and not results["limit"]:
+        resultCache.put(key, results, cacheTTL)
+    return results
+
+
+# ----------------------------------------------------------------------------- fileSHA256()
+def fileSHA256(transfer):
+    """ Returns the hex SHA-256 of an open binary file, leaving it at the start. """
+    digest = hashlib.sha256()
+    transfer.seek(0)
+    for chunk in iter(lambda: transfer.read(FILE_CHUNK), b""):
+        digest.update(chunk)
+    transfer.seek(0)
+    return digest.hexdigest()
+
+
+# ----------------------------------------------------------------------------- cacheSetting()
+def cacheSetting(options):
+    """ Returns the TTL in seconds asked for by the cache option, or None. """
+    if "cache" not in options:
+        return None
+    if options["cache"] is True:
+        return CACHE_TTL
+    try:
+        ttl = float(options["cache"])
+        if ttl <= 0: raise ValueError()
+    except ValueError:
+        raise ValueError("bad cache TTL \"%s\"" % options["cache"])
+    return ttl
+
+
+# ----------------------------------------------------------------------------- commandSettings()
+def commandSettings(options):
+    """ Turns OS/BATCH directive options into Command() keyword arguments.
+        Always includes shell; limits only when given. Raises ValueError. """
+    settings = {"shell": options.get("shell", SHELL_MODE)}
+    if settings["shell"] not in ("auto", "always", "never"):
+        raise ValueError("unknown shell mode \"%s\", must be auto, always or never" % settings["shell"])
+    for name, parse in (("timeout", float), ("cpu", int), ("maxout", parseSize), ("maxrss", parseSize)):
+        if name in options:
+            try:
+                value = parse(options[name])
+                if value <= 0: raise ValueError()
+            except (TypeError, ValueError):
+                raise ValueError("bad %s limit \"%s\"" % (name, options[name]))
+            settings[name] = value
+    return settings
+
+
+# ----------------------------------------------------------------------------- findProcesses()
+def findProcesses(nameOrPid):
+    """ Returns the pids matching a pid or a process name (comm, or the base
+        name of argv[0]). """
+    if nameOrPid.isdigit():
+        return [int(nameOrPid)] if os.path.exists("/proc/%s" % nameOrPid) else []
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/comm" % entry, FOR_READING) as f:
+                comm = f.read().strip()
+            if comm != nameOrPid:
+                with open("/proc/%s/cmdline" % entry, 'rb') as f:
+                    argv0 = f.read().split(b"\0", 1)[FIRST].decode('utf-8', 'replace')
+                if os.path.basename(argv0) != nameOrPid:
+                    continue
+        except OSError:
+            continue  # Process went away
+        pids.append(int(entry))
+    return pids
+
+
+# ----------------------------------------------------------------------------- readProcess()
+def readProcess(pid):
+    """ Reads one process's figures from /proc/<pid>/stat. Raises OSError if
+        the process does not exist. """
+    with open("/proc/%d/stat" % pid, FOR_READING) as f:
+        stat = f.read()
+    name = stat[stat.find('(') + 1:stat.rfind(')')]
+    fields = stat.rsplit(')', 1)[LAST].split()  # fields[0] is field 3 (state)
+    with open("/proc/uptime", FOR_READING) as f:
+        uptime = float(f.read().split()[FIRST])
+    cpuSeconds = (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)  # utime + stime
+    try:
+        fds = countFileDescriptors(pid)
+    except OSError:
+        fds = None  # Another user's process
+    return {"pid": pid,
+            "name": name,
+            "state": fields[FIRST],
+            "threads": int(fields[17]),
+            "fds": fds,
+            "rss_bytes": int(fields[21]) * PAGE_SIZE,
+            "cpu_seconds": round(cpuSeconds, 3),
+            "age_seconds": round(uptime - int(fields[19]) / float(CLOCK_TICKS), 3)}
+
+
+# ----------------------------------------------------------------------------- countFileDescriptors()
+def countFileDescriptors(pid):
+    """ Number of open file descriptors of a process. """
+    return len(os.listdir("/proc/%d/fd" % pid))
+
+
+# ----------------------------------------------------------------------------- socketStates()
+def socketStates(port=None):
+    """ Counts IPv4 and IPv6 TCP sockets by state, optionally only those with
+        the given local port. """
+    counts = {}
+    for table in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            f = open(table, FOR_READING)
+        except OSError:
+            continue  # No IPv6
+        with f:
+            next(f)  # Header line
+            for line in f:
+                fields = line.split()
+                if port is not None and int(fields[1].rsplit(':', 1)[LAST], 16) != port:
+                    continue
+                state = TCP_STATES.get(fields[3], fields[3])
+                counts[state] = counts.get(state, 0) + 1
+    return counts
+
+
+# ----------------------------------------------------------------------------- loadAverage()
+def loadAverage():
+    """ Load averages and running/total scheduling entities from /proc/loadavg. """
+    with open("/proc/loadavg", FOR_READING) as f:
+        fields = f.read().split()
+    running, total = fields[3].split('/')
+    return {"1m": float(fields[0]),
+            "5m": float(fields[1]),
+            "15m": float(fields[2]),
+            "running": int(running),
+            "total": int(total)}
+
+
+# ----------------------------------------------------------------------------- parseSize()
+def parseSize(text):
+    """ "512", "64K", "10M" or "2G" -> number of bytes. """
+    text = str(text).strip().upper()
+    scale = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}.get(text[LAST:], 1)
+    if scale > 1:
+        text = text[:LAST]
+    return int(text) * scale
+
+
+# ----------------------------------------------------------------------------- processGroupRSS()
+def processGroupRSS(processGroup):
+    """ Returns the total resident memory in bytes of every process in a
+        process group, read from /proc (Linux). """
+    total = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry, FOR_READING) as f:
+                fields = f.read().rsplit(')', 1)[LAST].split()
+        except OSError:
+            continue  # Process went away
+        if int(fields[2]) == processGroup:  # pgrp
+            total += int(fields[21]) * PAGE_SIZE  # rss in pages
+    return total
+
+
+# ----------------------------------------------------------------------------- processGroupCPU()
+def processGroupCPU(processGroup):
+    """ Returns the CPU seconds used by every process in a process group,
+        including the children they already waited for, read from /proc
+        (Linux). """
+    ticks = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry, FOR_READING) as f:
+                fields = f.read().rsplit(')', 1)[LAST].split()
+        except OSError:
+            continue  # Process went away
+        if int(fields[2]) == processGroup:  # pgrp
+            ticks += sum(int(field) for field in fields[11:15])  # utime stime cutime cstime
+    return ticks / float(CLOCK_TICKS)
+
+
+# ----------------------------------------------------------------------------- waitForUsage()
+def waitForUsage(process):
+    """ process.wait() that also returns the CPU seconds used by the process
+        and the children it waited for, e.g. every member of a shell
+        pipeline (os.wait4). Returns (returnCode, cpuSeconds). """
+    try:
+        pid, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        return process.wait(), 0.0  # Reaped elsewhere (poll() from cancel())
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage.ru_utime + usage.ru_stime
+
+
+# ----------------------------------------------------------------------------- executorLoop()
+def executorLoop():
+    """ Body of a pre-forked executor (agent.py --executor). Reads one JSON
+        request per line, {"command": ..., "options": {...}}, runs it and
+        writes the Command.returnResults() dictionary back as one JSON line.
+        Exits when the agent closes the pipe. """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # <Control>-<C> is for the agent
+    requests = os.fdopen(os.dup(0), 'rb')
+    replies  = os.fdopen(os.dup(1), 'wb')
+    devNull  = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devNull, 0)  # \__ Commands must not read or write the control pipes
+    os.dup2(devNull, 1)  # /
+    for line in requests:
+        request = json.loads(line)
+        c = Command(request["command"], **request.get("options", {}))
+        c.run()
+        replies.write((json.dumps(c.returnResults()) + "\n").encode('utf-8'))
+        replies.flush()
+    return EXIT_SUCCESS
+
+
+# ----------------------------------------------------------------------------- superviseWorkers()
+def superviseWorkers(count, workerArguments):
+    """ --workers=N: starts count workers sharing the port, restarts those that
+        crash and stops them all when any is shut down or on SIGTERM or
+        <Control>-<C>. Returns the exit code for the supervisor. """
+    def spawn(index):
+        command = [sys.executable, os.path.realpath(__file__), "--worker=%d" % index]
+        return subprocess.Popen(command + workerArguments)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: shutdownRequested.set())
+    workers = {}  # index -> (Popen, time started)
+    for index in range(1, count + 1):
+        workers[index] = (spawn(index), time.monotonic())
+    message = "Started %d workers on %s:%d" % (count, HOST, PORT)
+    if VERBOSE: showMessage(message)
+    if LOGGING: log.logit(message)
+
+    exitCode = EXIT_SUCCESS
+    try:
+        while not shutdownRequested.is_set():
+            time.sleep(WORKER_POLL)
+            for index, (worker, started) in list(workers.items()):
+                returnCode = worker.poll()
+                if returnCode is None:
+                    continue
+                if returnCode == EXIT_SUCCESS:
+                    shutdownRequested.set()  # A worker was shut down, stop the rest
+                    break
+                if returnCode == BIND_FAILED:
+                    message = "Worker %d unable to bind to %s:%d, stopping" % (index, HOST, PORT)
+                    showError(message)
+                    if LOGGING: log.logit(message, ERROR)
+                    exitCode = BIND_FAILED
+                    shutdownRequested.set()
+                    break
+                if time.monotonic() - started < WORKER_BACKOFF:
+                    continue  # Crash looping, restart on a later check
+                message = "Worker %d (pid %d) exited with %d, restarting" % (index, worker.pid, returnCode)
+                showWarning(message)
+                if LOGGING: log.logit(message, WARN)
+                workers[index] = (spawn(index), time.monotonic())
+    except KeyboardInterrupt:
+        message = "Caught <Control>-<C>, stopping workers"
+        print("")
+        showMessage(message)
+        if LOGGING: log.logit(message)
+
+    # --- Stop the workers, each drains its own sessions ------------------------
+    for worker, started in workers.values():
+        if worker.poll() is None:
+            worker.send_signal(signal.SIGTERM)
+    deadline = time.monotonic() + DRAIN_DEADLINE + CLOSE_LINGER + 1.0
+    for index, (worker, started) in workers.items():
+        try:
+            worker.wait(max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            message = "Worker %d (pid %d) did not stop, killing it" % (index, worker.pid)
+            showWarning(message)
+            if LOGGING: log.logit(message, WARN)
+            worker.kill()
+            worker.wait()
+    message = "Stopped %d workers" % count
+    if VERBOSE: showMessage(message)
+    if LOGGING: log.logit(message)
+    return exitCode
+
+
+# ----------------------------------------------------------------------------- runBenchmark()
+def runBenchmark(runs, command=BENCHMARK_COMMAND):
+    """ Times BENCHMARK_COMMAND started through /bin/sh, directly, and on a
+        pre-forked executor, and prints a small report on stdout. """
+    pool = ExecutorPool(1)
+    modes = [("shell",   lambda: Command(command, "always").run()),
+             ("direct",  lambda: Command(command, "never").run()),
+             ("prefork", lambda: pool.run(command, {"shell": "never"}))]
+    print("Start-up benchmark: \"%s\" x %d" % (command, runs))
+    print("%-10s %10s %10s %10s %12s" % ("mode", "mean ms", "p50 ms", "p99 ms", "commands/s"))
+    for name, runOnce in modes:
+        runOnce()  # warm up
+        times = []
+        for i in range(runs):
+            start = time.perf_counter()
+            runOnce()
+            times.append((time.perf_counter() - start) * 1000.0)
+        times.sort()
+        mean = sum(times) / len(times)
+        print("%-10s %10.3f %10.3f %10.3f %12.1f" % (name, mean,
+                                                     times[len(times) // 2],
+                                                     times[min(len(times) - 1, int(len(times) * 0.99))],
+                                                     1000.0 / mean))
+    pool.close()
+
+
+# ----------------------------------------------------------------------------- parseDirective()
+def parseDirective(text):
+    """ Splits "DIRECTIVE,option,key=value" into ("DIRECTIVE", {options}).
+        Flag options map to True, option names are lower case. """
+    parts = text.split(',')
+    directive = parts[FIRST].strip().upper()
+    options = {}
+    for part in parts[1:]:
+        if part.find('=') > -1:
+            key, value = part.split('=', 1)
+            options[key.strip().lower()] = value.strip()
+        elif len(part.strip()) > 0:
+            options[part.strip().lower()] = True
+    return directive, options
+
+
+# ----------------------------------------------------------------------------- serveSession()
+def serveSession(connection, remoteAddr, sessionSlots):
+    """ Worker thread body: runs one session and then gives its slot back. """
+    session = Session(connection, remoteAddr)
+    agentStats.sessionAccepted()
+    with sessionsChanged:
+        activeSessions.add(session)
+    try:
+        session.run()
+    except Exception as e:
+        message = "Session with %s failed: %s" % (str(remoteAddr), str(e))
+        showError(message)
+        if LOGGING: log.logit(message, ERROR)
+    finally:
+        with sessionsChanged:
+            activeSessions.discard(session)
+            sessionsChanged.notify_all()
+        sessionSlots.release()
+
+
+# ----------------------------------------------------------------------------- configureConnection()
+def configureConnection(connection):
+    """ Applies the idle timeout and TCP keepalive settings to an accepted
+        client socket. """
+    connection.setblocking(True)
+    if IDLE_TIMEOUT > 0:
+        connection.settimeout(IDLE_TIMEOUT)  # recv() raises socket.timeout when idle
+    if KEEPALIVE > 0:
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (("TCP_KEEPIDLE", KEEPALIVE),
+                              ("TCP_KEEPINTVL", max(1, KEEPALIVE // 4)),
+                              ("TCP_KEEPCNT", 4)):
+            if hasattr(socket, option):  # Linux; other platforms keep their defaults
+                connection.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+# ----------------------------------------------------------------------------- rejectBusy()
+def rejectBusy(connection, remoteAddr):
+    """ Tells a client that arrived with every session slot in use to retry
+        after RETRY_AFTER ms, then drops it without tying up the listener. """
+    agentStats.sessionRejected()
+    message = "BUSY, RETRY AFTER %d MS" % RETRY_AFTER
+    response = build_TA_Response(203, message)
+    response[RETRY_AFTER_MS] = RETRY_AFTER
+    try:
+        connection.setblocking(False)  # A fresh socket takes a short reply at once
+        connection.send(str(response).encode('utf-8'))
+        connection.shutdown(socket.SHUT_WR)
+        while connection.recv(BUF_SIZE):
+            pass  # Discard what already arrived so close() does not reset the reply
+    except (BlockingIOError, socket.error):
+        pass
+    connection.close()
+    if VERBOSE: showMessage("Rejected %s: %s" % (str(remoteAddr), message))
+    if LOGGING: log.logit("Rejected %s: %s" % (str(remoteAddr), message), WARN)
+
+
+# ----------------------------------------------------------------------------- requestShutdown()
+def requestShutdown():
+    """ Asks the listener loop to stop accepting and wakes it up right away. """
+    shutdownRequested.set()
+    try:
+        os.write(wakeWriter, b"x")
+    except OSError:
+        pass
+
+
+# ----------------------------------------------------------------------------- startReplacement()
+def startReplacement():
+    """ Runs this script again with the same options, handing it tcpSocket
+        (--inherit-fd) and a pipe (--ready-fd), and waits up to RESTART_TIMEOUT
+        seconds for it to report that it is accepting. Returns the new agent's
+        Popen; raises OSError, after killing it, if it never gets that far. """
+    arguments = [arg for arg in sys.argv[1:]
+                 if not arg.startswith(("--inherit-fd", "--ready-fd"))]
+    readyReader, readyWriter = os.pipe()
+    listenerFd = tcpSocket.fileno()
+    try:
+        process = subprocess.Popen([sys.executable, os.path.realpath(__file__),
+                                    "--inherit-fd=%d" % listenerFd,
+                                    "--ready-fd=%d" % readyWriter] + arguments,
+                                   pass_fds=(listenerFd, readyWriter),
+                                   start_new_session=True)  # Outlives us, away from our terminal signals
+    except OSError:
+        os.close(readyReader)
+        raise
+    finally:
+        os.close(readyWriter)  # Only the new agent holds it, EOF if it dies
+    try:
+        with selectors.DefaultSelector() as selector:
+            selector.register(readyReader, selectors.EVENT_READ)
+            ready = selector.select(RESTART_TIMEOUT) and os.read(readyReader, 16) == b"ready"
+    finally:
+        os.close(readyReader)
+    if not ready:
+        process.kill()
+        returnCode = process.wait()
+        raise OSError("new agent did not start accepting (exit code %d)" % returnCode)
+    return process
+
+
+# ----------------------------------------------------------------------------- handOverListener()
+def handOverListener():
+    """ Runs on the listener thread when it is woken up: answers queued
+        TA:restart requests with the new agent's Popen (or the OSError), so
+        that nothing is accepted here while the new agent starts - clients that
+        arrive meanwhile wait in the backlog for it. Returns True once the
+        listener has been handed over and this agent should shut down. """
+    global replacement
+    while True:
+        try:
+            replies = restartRequests.get_nowait()
+        except queue.Empty:
+            return replacement is not None
+        if replacement is not None:
+            replies.put(OSError("a restart is already in progress"))
+            continue
+        try:
+            replacement = startReplacement()
+            replies.put(replacement)
+        except OSError as e:
+            replies.put(e)
+
+
+# ----------------------------------------------------------------------------- drainSessions()
+def drainSessions(deadline):
+    """ Lets in-flight sessions finish their current request, for at most
+        deadline seconds (None waits for as long as they take). Idle sessions
+        are ended straight away. Returns the number of sessions still running
+        when the deadline passed. """
+    with sessionsChanged:
+        for session in activeSessions:
+            if not session.busy:
+                session.wake()
+        sessionsChanged.wait_for(lambda: len(activeSessions) == 0, timeout=deadline)
+        return len(activeSessions)
+
+
 # ==============================================================================
 # MAIN
 if __name__ == "__main__":
@@ -476,17 +3073,36 @@ if __name__ == "__main__":
         except:
             pass  # if reached => USER = "Unknown"
 
+    # --- Pre-forked executors skip everything else ----------------------------
+    if "--executor" in sys.argv[1:]:
+        sys.exit(executorLoop())
+
     # --- Process command line arguments ----------------------------------------
     try:
         arguments = getopt.getopt(sys.argv[1:],
-                                  "hvdp:a:lb:",
+                                  "hvdp:a:lb:m:D:x:P:C:W:B:I:K:",
                                   ['help',
                                    'verbose',
                                    'debug',
                                    'port=',
                                    'address=',
                                    'logging',
-                                   'buffer='])
+                                   'buffer=',
+                                   'max-sessions=',
+                                   'drain=',
+                                   'shell=',
+                                   'prefork=',
+                                   'benchmark=',
+                                   'cache-size=',
+                                   'workers=',
+                                   'worker=',
+                                   'backlog=',
+                                   'idle=',
+                                   'keepalive=',
+                                   'busy=',
+                                   'retry-after=',
+                                   'inherit-fd=',
+                                   'ready-fd='])
     except:
         showError("Bad command line argument(s)")
         usage()
@@ -516,7 +3132,7 @@ if __name__ == "__main__":
             try:
                 tryPort = int(arg[1])
             except:
-                message = "Invalid port specified \"%s\", port must be an integer." % tryPort
+                message = "Invalid port specified \"%s\", port must be an integer." % arg[1]
                 showError(message)
                 usage()
                 sys.exit(3)
@@ -535,7 +3151,7 @@ if __name__ == "__main__":
                 socket.inet_aton(tryAddress)  # valid IPV4 address check
                 HOST = tryAddress  # Looks good, let's use it
             except:
-                message = "Invalid address specified \"%s\", address must be a string." % tryPort
+                message = "Invalid address specified \"%s\", address must be a string." % arg[1]
                 showError(message)
                 usage()
                 sys.exit(5)
@@ -545,7 +3161,7 @@ if __name__ == "__main__":
             try:
                 tryBuffer = int(arg[1])
             except:
-                message = "Invalid buffer specified \"%s\", port must be an integer." % tryBuffer
+                message = "Invalid buffer specified \"%s\", port must be an integer." % arg[1]
                 showError(message)
                 usage()
                 sys.exit(6)
@@ -556,23 +3172,159 @@ if __name__ == "__main__":
                 showError(message)
                 usage()
                 sys.exit(6)
+    # --- Check for a "--max-sessions" or "-m" option
+    for arg in arguments[0]:
+        if arg[0] == "-m" or arg[0] == "--max-sessions":
+            try:
+                MAX_SESSIONS = int(arg[1])
+                if MAX_SESSIONS < 1: raise ValueError()
+            except:
+                message = "Invalid max sessions specified \"%s\", must be a positive integer." % arg[1]
+                showError(message)
+                usage()
+                sys.exit(7)
+    # --- Check for a "--drain" or "-D" option
+    for arg in arguments[0]:
+        if arg[0] == "-D" or arg[0] == "--drain":
+            try:
+                DRAIN_DEADLINE = float(arg[1])
+                if DRAIN_DEADLINE < 0: raise ValueError()
+            except:
+                message = "Invalid drain deadline specified \"%s\", must be a number of seconds >= 0." % arg[1]
+                showError(message)
+                usage()
+                sys.exit(8)
+    # --- Check for a "--shell" or "-x" option
+    for arg in arguments[0]:
+        if arg[0] == "-x" or arg[0] == "--shell":
+            if arg[1] not in ("auto", "always", "never"):
+                message = "Invalid shell mode specified \"%s\", must be auto, always or never." % arg[1]
+                showError(message)
+                usage()
+                sys.exit(9)
+            SHELL_MODE = arg[1]
+    # --- Check for "--prefork"/"-P", "--benchmark" and "--cache-size"/"-C" options
+    for arg in arguments[0]:
+        if arg[0] in ("-P", "--prefork", "--benchmark", "-C", "--cache-size"):
+            try:
+                count = int(arg[1])
+                if count < 0: raise ValueError()
+            except:
+                message = "Invalid count specified for %s \"%s\", must be an integer >= 0." % (arg[0], arg[1])
+                showError(message)
+                usage()
+                sys.exit(10)
+            if arg[0] == "--benchmark":
+                BENCHMARK_RUNS = count
+            elif arg[0] in ("-C", "--cache-size"):
+                CACHE_SIZE = count
+            else:
+                PREFORK = count
+    if BENCHMARK_RUNS > 0:
+        runBenchmark(BENCHMARK_RUNS)
+        sys.exit(EXIT_SUCCESS)
+    # --- Check for a "--workers" or "-W" option (and the internal --worker)
+    for arg in arguments[0]:
+        if arg[0] in ("-W", "--workers", "--worker"):
+            try:
+                count = int(arg[1])
+                if count < 0 or (arg[0] == "--worker" and count < 1): raise ValueError()
+            except:
+                message = "Invalid count specified for %s \"%s\", must be an integer >= 0." % (arg[0], arg[1])
+                showError(message)
+                usage()
+                sys.exit(11)
+            if arg[0] == "--worker":
+                WORKER_INDEX = count
+                LOG_FILE = "%s.worker%d.log" % (ME, count)
+            else:
+                WORKERS = count
+    # --- Check for connection handling options
+    for arg in arguments[0]:
+        if arg[0] in ("-B", "--backlog", "-I", "--idle", "-K", "--keepalive", "--busy", "--retry-after"):
+            try:
+                if arg[0] == "--busy":
+                    if arg[1] not in ("reject", "queue"): raise ValueError()
+                    BUSY_POLICY = arg[1]
+                elif arg[0] in ("-I", "--idle"):
+                    IDLE_TIMEOUT = float(arg[1])
+                    if IDLE_TIMEOUT < 0: raise ValueError()
+                else:
+                    value = int(arg[1])
+                    if value < 0 or (value < 1 and arg[0] in ("-B", "--backlog")): raise ValueError()
+                    if arg[0] in ("-B", "--backlog"):
+                        BACKLOG = value
+                    elif arg[0] in ("-K", "--keepalive"):
+                        KEEPALIVE = value
+                    else:
+                        RETRY_AFTER = value
+            except ValueError:
+                message = "Invalid setting for %s \"%s\"." % (arg[0], arg[1])
+                showError(message)
+                usage()
+                sys.exit(12)
+    # --- Check for the internal TA:restart options
+    for arg in arguments[0]:
+        if arg[0] in ("--inherit-fd", "--ready-fd"):
+            try:
+                fd = int(arg[1])
+                os.fstat(fd)  # Must be open, passed down by the old agent
+            except (ValueError, OSError):
+                showError("Invalid file descriptor for %s \"%s\"" % (arg[0], arg[1]))
+                sys.exit(13)
+            if arg[0] == "--inherit-fd":
+                INHERIT_FD = fd
+            else:
+                READY_FD = fd
+    if WORKERS > 0 and not hasattr(socket, "SO_REUSEPORT"):
+        showError("--workers needs SO_REUSEPORT, which this platform does not have")
+        sys.exit(11)
 
                 # --- Initialize the Log file
     log = Logger(LOG_FILE)
     # --- Display operating parameters
     if DEBUG:
-        # TODO: Clean this up to support Python 3
-        print "--------------- PARAMETERS ---------------"
-        print "Program name is                  %s" % ME
-        print "Program running as user          %s" % USER
-        print "Program started at               %s" % now()
-        print "Program started on               %s" % HOST
-        print "Program started in               %s" % MY_PATH
-        print "Program configured for port      %s" % PORT
-        print "Program logging                  %s" % LOGGING
-        print "Program Buffer                   %s" % BUF_SIZE
+        print("--------------- PARAMETERS ---------------")
+        print("Program name is                  %s" % ME)
+        print("Program running as user          %s" % USER)
+        print("Program started at               %s" % now())
+        print("Program started on               %s" % HOST)
+        print("Program started in               %s" % MY_PATH)
+        print("Program configured for port      %s" % PORT)
+        print("Program logging                  %s" % LOGGING)
+        print("Program Buffer                   %s" % BUF_SIZE)
+        print("Program max sessions             %s" % MAX_SESSIONS)
+        print("Program busy policy              %s" % BUSY_POLICY)
+        print("Program idle timeout             %s" % IDLE_TIMEOUT)
+        print("Program shell mode               %s" % SHELL_MODE)
+        print("Program pre-forked executors     %s" % PREFORK)
+        print("Program worker processes         %s" % WORKERS)
         pause()
 
+    # --- Supervise worker processes instead of serving -------------------------
+    if WORKERS > 0 and WORKER_INDEX is None:
+        workerArguments = []
+        for arg in arguments[0]:
+            if arg[0] not in ("-W", "--workers"):
+                workerArguments += [arg[0], arg[1]] if arg[1] else [arg[0]]
+        exitCode = superviseWorkers(WORKERS, workerArguments)
+        log.close()
+        sys.exit(exitCode)
+    if WORKER_INDEX is not None:
+        # The supervisor stops workers with SIGTERM: drain like TA:shutdown
+        signal.signal(signal.SIGTERM, lambda signum, frame: requestShutdown())
+
+    resultCache = ResultCache(CACHE_SIZE)
+    agentStats  = AgentStats()
+    jobTable    = JobTable()
+
+    # --- Start the pre-forked executors ----------------------------------------
+    if PREFORK > 0:
+        executorPool = ExecutorPool(PREFORK)
+        message = "Started %d pre-forked executors" % PREFORK
+        if VERBOSE: showMessage(message)
+        if LOGGING: log.logit(message)
+
     # --- Program opens ---------------------------------------------------------
     message = "%s started on %s in %s as %s" % (ME, HOST, MY_PATH, USER)
     if VERBOSE: showMessage(message)
@@ -584,212 +3336,140 @@ if __name__ == "__main__":
         if VERBOSE: showMessage(message)
         if LOGGING: log.logit(message)
         listenerSocket = (HOST, PORT)
-        tcpSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if INHERIT_FD is None:
+            tcpSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if WORKER_INDEX is not None:
+                tcpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
         try:
-            tcpSocket.bind(listenerSocket)
-            tcpSocket.listen(5)
+            if INHERIT_FD is not None:
+                # TA:restart: the old agent's socket, already bound and listening
+                tcpSocket = socket.socket(fileno=INHERIT_FD)
+                if not tcpSocket.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN):
+                    raise socket.error("inherited descriptor %d is not listening" % INHERIT_FD)
+                if VERBOSE: showMessage("Inherited listener on %s:%d" % tcpSocket.getsockname()[:2])
+            else:
+                tcpSocket.bind(listenerSocket)
+                tcpSocket.listen(BACKLOG)
+            tcpSocket.setblocking(False)  # accept() only runs once select() says so
             if VERBOSE: showMessage("Listener started!")
-        except socketError, e:
+        except socket.error as e:
             message = "Test Agent unable to bind to %s:%s - " % (HOST, str(PORT))
-            message += "%s" % str(e[1])
+            message += "%s" % str(e)
             showError(message)
-            if LOGGING:
-                logit(message)
-            exit(6)  # Exit with 6 for "Unable to bind test_agent to host:port"
+            if LOGGING: log.logit(message, ERROR)
+            log.close()
+            sys.exit(BIND_FAILED)  # Exit with 6 for "Unable to bind test_agent to host:port"
 
         # --------------------------------------------------------- Listener Loop
-        # Listener loop starts here.
+        # Listener loop starts here. Each accepted connection is handed to a
+        # worker thread. With --busy=queue a session slot is taken *before*
+        # accept() so that once MAX_SESSIONS clients are being served, new ones
+        # wait in the backlog. With --busy=reject connections are always
+        # accepted and those that find no free slot get the busy reply.
         #
-        listenerRunning = True
-        while listenerRunning:
-            message = "Waiting for a connection ..."
-            if VERBOSE: showMessage(message)
-            if LOGGING: log.logit(message)
-            connection, remoteAddr = tcpSocket.accept()
+        sessionSlots = threading.BoundedSemaphore(MAX_SESSIONS)
+        listenerSelector = selectors.DefaultSelector()
+        listenerSelector.register(tcpSocket, selectors.EVENT_READ)
+        listenerSelector.register(wakeReader, selectors.EVENT_READ)  # requestShutdown(), TA:restart
+        message = "Waiting for connections (max sessions %d) ..." % MAX_SESSIONS
+        if VERBOSE: showMessage(message)
+        if LOGGING: log.logit(message)
+        if READY_FD is not None:
+            try:
+                os.write(READY_FD, b"ready")  # The old agent stops accepting now
+            except OSError:
+                pass  # The old agent gave up on us, serve on regardless
+            os.close(READY_FD)
+        queueing = (BUSY_POLICY == "queue")
+        while not shutdownRequested.is_set():
+            if queueing and not sessionSlots.acquire(timeout=ACCEPT_POLL):
+                if handOverListener():  # A TA:restart must not wait for a free slot
+                    shutdownRequested.set()
+                continue  # All sessions busy
+            ready = [key.fileobj for key, events in listenerSelector.select()]
+            if wakeReader in ready:
+                os.read(wakeReader, 512)
+                if handOverListener():
+                    shutdownRequested.set()  # The new agent accepts from here on
+            if tcpSocket not in ready or shutdownRequested.is_set():
+                if queueing: sessionSlots.release()
+                continue  # Woken up for shutdown or TA:restart
+            try:
+                connection, remoteAddr = tcpSocket.accept()
+            except (BlockingIOError, InterruptedError):
+                if queueing: sessionSlots.release()
+                continue
+            if not queueing and not sessionSlots.acquire(blocking=False):
+                rejectBusy(connection, remoteAddr)
+                continue
+            configureConnection(connection)
             message = "Connection from: %s" % str(remoteAddr)
             if VERBOSE: showMessage(message)
             if LOGGING: log.logit(message)
-            sessionActive = True
-            while sessionActive:
-
-                data = connection.recv(BUF_SIZE)
-                data = data.strip()
-                message = "Message from %s: %s" % (str(remoteAddr), data)
-                if VERBOSE: showMessage(message)
-                if LOGGING: log.logit(message)
-
-                # --- Check message from client and see if it is in form:
-                #     DIRECTIVE:COMMAND
-                messageParts = data.split(':', 1)
-                if len(messageParts) != 2:
-                    response = build_TA_Response(98, "Invalid message")
-                    if VERBOSE: showMessage("Sending: %s" % str(response))
-                    if LOGGING: log.logit("Sending: %s" % str(response))
-                    connection.send(str(response))
-                else:
-                    # --- Parse out and clean up the directive and command
-                    directive = messageParts[FIRST]
-                    directive = directive.strip()
-                    directive = directive.upper()
-                    command = messageParts[LAST]
-                    command = command.strip()
-                    # --- Process directives and commands
-
-                    if directive == "TA":
-                        #
-                        #    *** **************************** ***
-                        #    *** TA DIRECTIVES PROCESSED HERE ***
-                        #    *** **************************** ***
-                        #
-                        # ------------------------------------------------- TA:VERSION
-                        if command == "version":
-                            response = build_TA_Response(0, "VERSION %s" % VERSION)
-                            if VERBOSE: showMessage("Sending: %s" % str(response))
-                            if LOGGING: log.logit("Sending: %s" % str(response))
-                            connection.send(str(response))
-                        # ----------------------------------------------------- TA:BYE
-                        elif command == "bye" or command == "quit" or command == "exit":
-                            response = build_TA_Response(0, "CLOSING CONNECTION")
-                            if VERBOSE: showMessage("Sending: %s" % str(response))
-                            if LOGGING: log.logit("Sending: %s" % str(response))
-                            connection.send(str(response))
-                            time.sleep(closeSocketPause)
-                            connection.close()
-                            sessionActive = False  # Flag end of session
-                        # ------------------------------------------------ TA:SHUTDOWN
-                        elif command == "shutdown" or command == "SHUTDOWN":
-                            response = build_TA_Response(0, "SHUTTING DOWN AGENT")
-                            if VERBOSE: showMessage("Sending: %s" % str(response))
-                            if LOGGING: log.logit("Sending: %s" % str(response))
-                            connection.send(str(response))
-                            time.sleep(closeSocketPause)
-                            connection.close()
-                            sessionActive = False  # Flag end of session
-                            listenerRunning = False  # Flag end of listener Loop
-                        # ------------------------------------------------- TA:GETNAME
-                        elif command == "getname" or command == "GETNAME":
-                            if VERBOSE: showMessage("sending name: %s" % AGENT_NAME)
-                            connection.send("[0, \"%s\"]" % AGENT_NAME)
-                        elif command.find("setname") > -1:
-                            if command.find('=') > -1:
-                                parts = command.split('=')
-                                if len(parts) != 2:
-                                    connection.send(
-                                        "[2, \"Bad TA:setname - must have a name after the \'=\' operator\"]")
-                                else:
-                                    agentName = parts[LAST]
-                                    agentName = agentName.strip()
-                                    AGENT_NAME = agentName
-                                    if VERBOSE: showMessage("Agent Name set to \"%s\"" % AGENT_NAME)
-                                    connection.send("[0, \"Agent Name set to \'%s\'\"]" % AGENT_NAME)
-                            else:
-                                connection.send("[1, \"TA:setname requires an assignment using \'=\'\"]")
-                            pass
-                            # --------------------------------------------- TA:GETUSERNAME
-                        elif command == "getusername" or command == "GETUSERNAME":
-                            if VERBOSE:
-                                showMessage("Sending \"%s\"" % USER)
-                            connection.send("[0, \"%s\"]" % USER)
-                            # ----------------------------------------------- TA:LOCALTIME
-                        elif command == "localtime" or command == "LOCALTIME":
-                            timestamp = now()
-                            response = build_TA_Response(0, timestamp)
-                            if VERBOSE: showMessage("Sending: %s" % str(response))
-                            if LOGGING: log.logit("Sending: %s" % str(response))
-                            connection.send(str(response))
-                        # ----------------------------------------------- TA:LOCALTIME
-                        elif command == "help" or command == "HELP":
-                            message = "Valid TA Commands are: version, localtime, bye, shutdown, help"
-                            response = build_TA_Response(0, message)
-                            if VERBOSE: showMessage("Sending: %s" % str(response))
-                            if LOGGING: log.logit("Sending: %s" % str(response))
-                            connection.send(str(response))
-                        # --------------------------------------------- TA:BAD COMMAND
-                        else:
-                            message = "Unknown TA Command \"%s\"" % command
-                            response = build_TA_Response(97, message)
-                            if VERBOSE: showMessage("Sending: %s" % str(response))
-                            if LOGGING: log.logit("Sending: %s" % str(response))
-                            connection.send(str(response))
-
-                    elif directive == "OS":
-                        #
-                        #    *** **************************** ***
-                        #    *** OS DIRECTIVES PROCESSED HERE ***
-                        #    *** **************************** ***
-                        #
-                        # ------------------------------------------------- OS:COMMAND
-                        if VERBOSE: showMessage("OS Command \"%s\"" % command)
-                        c = Command(command)
-                        c.run()
-                        results = c.returnResults()
-                        response = build_OS_Response(0,
-                                                     "",
-                                                     results["command"],
-                                                     results["output"],
-                                                     results["error"],
-                                                     results["returnCode"])
-                        if VERBOSE: showMessage("Sending: %s" % str(response))
-                        if LOGGING: log.logit("Sending: %s" % str(response))
-                        connection.send(str(response))
-
-                    elif directive == "HELP" or directive == "help":
-                        #
-                        #    *** ****************************** ***
-                        #    *** HELP DIRECTIVES PROCESSED HERE ***
-                        #    *** ****************************** ***
-                        #
-                        message = "[0, \"%s\"]" % helpMessage
-                        response = build_TA_Response(0, helpMessage)
-                        if VERBOSE: showMessage("Sending: %s" % str(response))
-                        if LOGGING: log.logit("Sending: %s" % str(response))
-                        connection.send(message)
-
-
-                    else:
-                        #
-                        #    *** ********************************* ***
-                        #    *** UNKNOWN DIRECTIVES PROCESSED HERE ***
-                        #    *** ********************************* ***
-                        #
-                        if VERBOSE: showMessage("Sending Unknown Directive")
-                        connection.send("[200, \"UNKNOWN DIRECTIVE: %s\"]" % directive)
+            worker = threading.Thread(target=serveSession,
+                                      args=(connection, remoteAddr, sessionSlots),
+                                      name="session-%s:%s" % remoteAddr)
+            worker.daemon = True
+            worker.start()
 
         # --------------------------------------------------- End of Listener Loop
         #
-        # Shutting down the Agent on a shutdown command
+        # Shutting down the Agent on a shutdown or restart command
         message = "Shutting down agent ..."
+        if replacement is not None:
+            message = "Handed the listener to pid %d, shutting down agent ..." % replacement.pid
         if VERBOSE: showMessage(message)
         if LOGGING: log.logit(message)
 
 
     except  KeyboardInterrupt:
         # Close the socket on Control C
-        #TODO: Clean this up to support Python 3
-        print "\n\n\n"
-        print "*** ******************** ***"
-        print "*** Caught <Control>-<C> ***"
-        print "*** ******************** ***"
-        print ""
-        print "Closing listener ..."
+        print("\n\n\n")
+        print("*** ******************** ***")
+        print("*** Caught <Control>-<C> ***")
+        print("*** ******************** ***")
+        print("")
+        print("Closing listener ...")
         if LOGGING: log.logit("Caught <Control>-<C>")
 
         # --- Close the Listener Socket
+    # Stop accepting first so new clients are refused rather than left waiting
     message = "Closing the listener socket..."
     if VERBOSE: showMessage(message)
     if LOGGING: log.logit(message)
-    time.sleep(closeSocketPause)
     tcpSocket.close()
     message = "Closed listener socket"
     if VERBOSE: showMessage(message)
     if LOGGING: log.logit(message)
 
+    # --- Let in-flight sessions finish -----------------------------------------
+    shutdownRequested.set()  # Also set on <Control>-<C> so sessions stop reading
+    # After TA:restart nobody is waiting on us, so sessions finish no matter how long
+    remaining = drainSessions(None if replacement is not None else DRAIN_DEADLINE)
+    if remaining > 0:
+        message = "Drain deadline of %s seconds passed with %d session(s) still running" % (DRAIN_DEADLINE, remaining)
+        showWarning(message)
+        if LOGGING: log.logit(message, WARN)
+        with sessionsChanged:
+            for session in activeSessions:
+                if session.shell is not None:
+                    session.shell.abort()  # Its own process group would outlive us
+
+    # --- Running jobs do not outlive the agent ---------------------------------
+    cancelled = jobTable.cancelAll(CLOSE_LINGER)
+    if cancelled > 0:
+        message = "Cancelled %d running job(s)" % cancelled
+        if VERBOSE: showMessage(message)
+        if LOGGING: log.logit(message, WARN)
+
     # --- Program closes --------------------------------------------------------
     message = "%s terminated with exit code %d" % (ME, EXIT_SUCCESS)
     if LOGGING: log.logit(message)
     if VERBOSE: showMessage(message)
-    exit(EXIT_SUCCESS) # I miss programming in C
+    if executorPool is not None: executorPool.close()
+    log.close()  # Drain queued log entries before exiting
+    sys.exit(EXIT_SUCCESS) # I miss programming in C
 
 else:
     exit(1)
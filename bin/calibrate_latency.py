@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+# Network Latency Calibration
+# Measures the round trip time to the agent (bin/agent.py) on the target host
+# with a burst of TA:ping messages, reports the RTT distribution and can write
+# the measured latency back to conf/target.conf as network_latency, which the
+# test cases add to server_process_time to get their client timeouts. A written
+# value never goes below MIN_LATENCY, and never below the value already in the
+# config unless --force is given: a quiet loopback measures a fraction of a
+# millisecond, far too little slack for a client timeout.
+
+# -----------------------------------------------------------------------------
+# Standard Library Imports
+import os
+import sys
+import time
+import math
+from getopt import getopt
+from urllib.parse import urlparse
+
+# -----------------------------------------------------------------------------
+# Some useful variables
+VERSION        = "1.0.0"
+VERBOSE        = False
+DEBUG          = False
+FIRST          = 0
+LAST           = -1
+ME             = os.path.split(sys.argv[FIRST])[LAST]  # Name of this file
+MY_PATH        = os.path.dirname(os.path.realpath(__file__))  # Path for this file
+LIBRARY_PATH   = os.path.join(MY_PATH, "../lib")
+CONFIG_FILE    = os.path.join(MY_PATH, "../conf/target.conf")
+PINGS          = 200     # Timed pings in the burst
+WARMUP         = 10      # Untimed pings sent first (connection set up, caches warm)
+PAYLOAD        = 0       # Bytes of payload carried by each ping
+INTERVAL       = 0.0     # Seconds between pings, 0 = back to back
+PERCENTILE     = 99.0    # RTT percentile written as network_latency
+FACTOR         = 1.0     # Safety factor applied to the written latency
+MIN_LATENCY    = 0.1     # Smallest network_latency written, in seconds
+PASSED         = "\033[32mPASSED\033[0m"  #\
+WARNING        = "\033[33mWARNING\033[0m" # \___ Linux-specific colorization
+FAILED         = "\033[31mFAILED\033[0m"  # /
+ERROR          = "\033[31mERROR\033[0m"   #/
+
+sys.path.append(LIBRARY_PATH)
+from agent_client import AgentConnection, AgentError, DEFAULT_PORT
+from async_load import percentile
+from config import readConfigFile, writeConfigValue
+
+
+# ----------------------------------------------------------------------------- usage()
+def usage():
+    """usage() - Prints the usage message on stdout. """
+    print("\n\n%s, Version %s, Network Latency Calibration." % (ME, VERSION))
+    print("Measures the round trip time to an agent with TA:ping")
+    print(" ")
+    print("USAGE: %s [OPTIONS]" % ME)
+    print(" ")
+    print("OPTIONS: ")
+    print("   -h --help        Display this message. ")
+    print("   -v --verbose     Print every round trip time, default: %s. " % VERBOSE)
+    print("   -a --address=    Agent host, default: the base_url host in %s " % CONFIG_FILE)
+    print("   -p --port=       Agent port, default: %d " % DEFAULT_PORT)
+    print("   -n --count=      Timed pings, default: %d " % PINGS)
+    print("   -s --size=       Payload bytes per ping, default: %d " % PAYLOAD)
+    print("   -i --interval=   Seconds between pings, default: %s " % INTERVAL)
+    print("   -P --percentile= RTT percentile written to the config, default: %s " % PERCENTILE)
+    print("   -f --factor=     Safety factor for the written latency, default: %s " % FACTOR)
+    print("   -w --write       Write network_latency (seconds) to %s, " % CONFIG_FILE)
+    print("                    at least %s and never lower than the current value " % MIN_LATENCY)
+    print("   -F --force       With --write, also lower the current value (not below %s) " % MIN_LATENCY)
+    print(" ")
+    print("EXIT CODES: ")
+    print("    0 - Successful completion of the program. ")
+    print("    1 - Bad or missing command line arguments. ")
+    print("    2 - Unable to reach the agent. ")
+    print("    3 - Unable to write the config file. ")
+    print(" ")
+    print("EXAMPLES: ")
+    print("    %s -a 10.0.0.12 -n 500 -s 1024 --write " % ME)
+    print(" ")
+
+
+# ----------------------------------------------------------------------------- measure()
+def measure(host, port, count, size, interval):
+    """ Returns the round trip times, in seconds, of count TA:ping messages
+        carrying size bytes each, after WARMUP untimed ones. """
+    connection = AgentConnection(host, port)
+    message = "TA:ping=%s" % ("x" * size) if size > 0 else "TA:ping"
+    try:
+        for n in range(WARMUP):
+            connection.request(message)
+        rtts = []
+        for n in range(count):
+            started = time.perf_counter()
+            reply = connection.request(message)
+            rtts.append(time.perf_counter() - started)
+            if reply.get("AGENT_MESSAGE") != "PONG":
+                raise AgentError("agent does not support TA:ping: %s" % str(reply))
+            if VERBOSE: print("%4d  %8.3f ms" % (n + 1, rtts[LAST] * 1000.0))
+            if interval > 0:
+                time.sleep(interval)
+    finally:
+        connection.close()
+    return rtts
+
+
+# ----------------------------------------------------------------------------- report()
+def report(rtts):
+    """ Prints the RTT distribution """
+    ordered = sorted(rtts)
+    mean    = sum(ordered) / len(ordered)
+    stdev   = math.sqrt(sum((r - mean) ** 2 for r in ordered) / len(ordered))
+    print("Round trip times over %d pings (ms):" % len(ordered))
+    print("   min %8.3f   mean %8.3f   stdev %8.3f   max %8.3f" %
+          (ordered[FIRST] * 1000.0, mean * 1000.0, stdev * 1000.0, ordered[LAST] * 1000.0))
+    print("   p50 %8.3f   p90  %8.3f   p99   %8.3f   p99.9 %8.3f" %
+          (percentile(ordered, 50) * 1000.0, percentile(ordered, 90) * 1000.0,
+           percentile(ordered, 99) * 1000.0, percentile(ordered, 99.9) * 1000.0))
+
+
+# Parse and Process the command line options
+try:
+    arguments = getopt(sys.argv[1:],
+                       'hva:p:n:s:i:P:f:wF',
+                       ['help',
+                        'verbose',
+                        'address=',
+                        'port=',
+                        'count=',
+                        'size=',
+                        'interval=',
+                        'percentile=',
+                        'factor=',
+                        'write',
+                        'force'])
+except Exception as e:
+    sys.stderr.write("%s -- Bad or missing command line argument(s): %s\n\n" % (ERROR, str(e)))
+    usage()
+    sys.exit(1)
+
+host     = None
+port     = DEFAULT_PORT
+count    = PINGS
+size     = PAYLOAD
+interval = INTERVAL
+rank     = PERCENTILE
+factor   = FACTOR
+write    = False
+force    = False
+try:
+    for arg in arguments[0]:
+        if arg[0] == "-h" or arg[0] == "--help":
+            usage()
+            sys.exit(0)
+        elif arg[0] == "-v" or arg[0] == "--verbose":
+            VERBOSE = True
+        elif arg[0] == "-a" or arg[0] == "--address":
+            host = arg[1]
+        elif arg[0] == "-p" or arg[0] == "--port":
+            port = int(arg[1])
+        elif arg[0] == "-n" or arg[0] == "--count":
+            count = int(arg[1])
+            if count < 1: raise ValueError("count must be at least 1")
+        elif arg[0] == "-s" or arg[0] == "--size":
+            size = int(arg[1])
+            if size < 0: raise ValueError("size must be >= 0")
+        elif arg[0] == "-i" or arg[0] == "--interval":
+            interval = float(arg[1])
+        elif arg[0] == "-P" or arg[0] == "--percentile":
+            rank = float(arg[1])
+            if not 0 < rank <= 100: raise ValueError("percentile must be between 0 and 100")
+        elif arg[0] == "-f" or arg[0] == "--factor":
+            factor = float(arg[1])
+            if factor <= 0: raise ValueError("factor must be > 0")
+        elif arg[0] == "-w" or arg[0] == "--write":
+            write = True
+        elif arg[0] == "-F" or arg[0] == "--force":
+            force = True
+except ValueError as e:
+    sys.stderr.write("%s -- %s\n\n" % (ERROR, str(e)))
+    usage()
+    sys.exit(1)
+
+if host is None:
+    host = urlparse(readConfigFile(CONFIG_FILE).get("base_url", "")).hostname or "localhost"
+
+# -----------------------------------------------------------------------------
+# STEP 1: Ping the agent on the target host.
+try:
+    rtts = measure(host, port, count, size, interval)
+except AgentError as e:
+    sys.stderr.write("%s -- %s\n" % (ERROR, str(e)))
+    sys.exit(2)
+print("Agent %s:%d, payload %d bytes" % (host, port, size))
+report(rtts)
+
+# -----------------------------------------------------------------------------
+# STEP 2: Optionally write the measured latency back to the config.
+latency = max(MIN_LATENCY, math.ceil(percentile(sorted(rtts), rank) * factor * 1000.0) / 1000.0)
+print("network_latency (p%s x %s) = %.3f seconds" % (rank, factor, latency))
+if write:
+    try:
+        current = float(readConfigFile(CONFIG_FILE).get("network_latency", ""))
+    except ValueError:
+        current = None  # Missing or not a number, nothing to keep
+    if current is not None and latency < current and not force:
+        print("%s -- Kept network_latency %s in %s, the measured %.3f is lower (--force writes it)" %
+              (WARNING, current, CONFIG_FILE, latency))
+        sys.exit(0)
+    if not writeConfigValue(CONFIG_FILE, "network_latency", "%.3f" % latency):
+        sys.exit(3)
+    print("Wrote network_latency %.3f to %s" % (latency, CONFIG_FILE))
+sys.exit(0)
@@ -0,0 +1,407 @@
+#!/usr/bin/python3
+
+# This library holds a client for the remote agent (bin/agent.py).
+# Connections are switched to the framed protocol with JSON replies and kept
+# in a pool per agent so test cases can reuse them across calls instead of
+# reconnecting for every command.
+
+import os
+import ast
+import sys
+import json
+import hashlib
+import zlib
+import socket
+import struct
+import threading
+import time
+
+# -----------------------------------------------------------------------------
+# Some useful variables
+VERSION       = "1.0.0"
+VERBOSE       = False
+DEBUG         = False
+FIRST         = 0
+LAST          = -1
+ME            = os.path.split(sys.argv[FIRST])[LAST]  # Name of this file
+MY_PATH       = os.path.dirname(os.path.realpath(__file__))  # Path for this file
+PASSED        = "\033[32mPASSED\033[0m"  # \
+FAILED        = "\033[31mFAILED\033[0m"  # > Linux-specific colorization
+ERROR         = "\033[31mERROR\033[0m"   # /
+DEFAULT_PORT  = 1100      # Default agent port number
+BUF_SIZE      = 65536     # Size of each socket read
+TIMEOUT       = 30.0      # Default socket timeout in seconds
+MAX_IDLE      = 4         # Idle connections kept per agent
+BUSY_RETRIES  = 3         # Connection attempts repeated when the agent says it is busy
+FRAME_HEADER  = struct.Struct("!I")  # Must match FRAME_HEADER in bin/agent.py
+COMPRESSED_FLAG = 0x80000000  # Must match COMPRESSED_FLAG in bin/agent.py
+FILE_CHUNK    = 1024 * 1024  # Largest read or write of a file transfer
+
+
+# ============================================================================= AgentError
+class AgentError(Exception):
+    """ Raised when an agent cannot be reached or the session breaks. """
+    pass
+
+
+# ============================================================================= AgentBusy
+class AgentBusy(AgentError):
+    """ Raised when the agent has no free session and asks to retry later. """
+
+    def __init__(self, message, retry_after):
+        AgentError.__init__(self, message)
+        self.retry_after = retry_after  # Seconds the agent asked us to wait
+
+
+# ============================================================================= AgentConnection
+class AgentConnection:
+    """ One persistent session with an agent, using the framed protocol and
+        JSON replies. With compress set, replies of that many bytes or more
+        come back zlib compressed (TA:compress=BYTES). Not thread-safe; share
+        connections through AgentPool. """
+
+    # -------------------------------------------------------------------------- __init__()
+    def __init__(self, host, port=DEFAULT_PORT, timeout=TIMEOUT, compress=None, busy_retries=BUSY_RETRIES):
+        self.host    = str(host)
+        self.port    = int(port)
+        self.timeout = timeout
+        self.compress = compress
+        self._socket = None
+        self._buffer = b""
+        self.broken  = False  # Set when the session can no longer be trusted
+        self.received = 0     # Reply bytes read so far
+        self.dropped = False  # Set when the agent closed or reset the connection
+        self.multiplexed = None  # TA:multiplex setting once request_many() is used
+        for attempt in range(busy_retries + 1):
+            try:
+                self._connect()
+                return
+            except AgentBusy as e:
+                if attempt == busy_retries:
+                    raise
+                time.sleep(e.retry_after)
+
+    # -------------------------------------------------------------------------- _connect()
+    def _connect(self):
+        """ Opens the socket and negotiates the framed protocol and JSON replies """
+        self._buffer = b""
+        self.broken  = False
+        try:
+            self._socket = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # The reply to TA:protocol=2 still comes back in the legacy protocol
+            self._socket.sendall(b"TA:protocol=2")
+            reply = self._socket.recv(BUF_SIZE).decode("utf-8", "replace")
+            if reply.find("RETRY_AFTER_MS") > -1:
+                busy = ast.literal_eval(reply)
+                raise AgentBusy("Agent %s:%d is busy: %s" % (self.host, self.port, busy["AGENT_MESSAGE"]),
+                                busy["RETRY_AFTER_MS"] / 1000.0)
+            if reply.find("PROTOCOL 2") == -1:
+                raise AgentError("agent does not support the framed protocol: %s" % reply)
+            reply = self.request("TA:format=json")
+            if reply.get("AGENT_RETURN_CODE") != 0:
+                raise AgentError("agent does not support JSON replies: %s" % str(reply))
+            if self.compress is not None:
+                reply = self.request("TA:compress=%d" % int(self.compress))
+                if reply.get("AGENT_RETURN_CODE") != 0:
+                    raise AgentError("agent does not support compression: %s" % str(reply))
+        except (OSError, ValueError, SyntaxError) as e:
+            self.close()
+            raise AgentError("Unable to connect to agent %s:%d - %s" % (self.host, self.port, str(e)))
+        except AgentError:
+            self.close()
+            raise
+
+    # -------------------------------------------------------------------------- _recv_exact()
+    def _recv_exact(self, size):
+        while len(self._buffer) < size:
+            data = self._socket.recv(max(BUF_SIZE, size - len(self._buffer)))
+            if not data:
+                self.dropped = True
+                raise AgentError("Agent %s:%d closed the connection" % (self.host, self.port))
+            self.received += len(data)
+            self._buffer += data
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    # -------------------------------------------------------------------------- send()
+    def send(self, message):
+        """ Sends one DIRECTIVE:COMMAND message without waiting for the reply """
+        payload = str(message).encode("utf-8")
+        try:
+            self._socket.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+        except OSError as e:
+            self.broken = True
+            self.dropped = isinstance(e, ConnectionError)
+            raise AgentError("Unable to send to agent %s:%d - %s" % (self.host, self.port, str(e)))
+
+    # -------------------------------------------------------------------------- receive()
+    def receive(self):
+        """ Reads and decodes the next reply from the agent """
+        try:
+            size = FRAME_HEADER.unpack(self._recv_exact(FRAME_HEADER.size))[FIRST]
+            payload = self._recv_exact(size & ~COMPRESSED_FLAG)
+            if size & COMPRESSED_FLAG:
+                payload = zlib.decompress(payload)
+            return json.loads(payload.decode("utf-8"))
+        except (OSError, ValueError, zlib.error, AgentError) as e:
+            self.broken = True
+            self.dropped = self.dropped or isinstance(e, ConnectionError)
+            raise AgentError("Bad reply from agent %s:%d - %s" % (self.host, self.port, str(e)))
+
+    # -------------------------------------------------------------------------- settimeout()
+    def settimeout(self, timeout):
+        """ Sets the seconds allowed for each following send and reply read """
+        self.timeout = timeout
+        if self._socket is not None:
+            self._socket.settimeout(timeout)
+
+    # -------------------------------------------------------------------------- request()
+    def request(self, message):
+        """ Sends one message and returns the decoded reply dictionary """
+        self.send(message)
+        return self.receive()
+
+    # -------------------------------------------------------------------------- run()
+    def run(self, command, **options):
+        """ Runs an OS command, e.g. run("uname -a", ...) """
+        return self.request("%s:%s" % (directive_with_options("OS", options), command))
+
+    # -------------------------------------------------------------------------- start_job()
+    def start_job(self, command, **options):
+        """ Starts an OS command as an agent job (OS,async) and returns its JOB_ID.
+            The job keeps running if this connection closes. """
+        options["async"] = True
+        reply = self.run(command, **options)
+        if reply.get("AGENT_RETURN_CODE") != 0:
+            raise AgentError("Unable to start job %s: %s" % (command, reply.get("AGENT_MESSAGE")))
+        return reply["JOB_ID"]
+
+    # -------------------------------------------------------------------------- job()
+    def job(self, action, job_id=None, **options):
+        """ Sends JOB:action=job_id, e.g. job("wait", 7, timeout=60, stdout=1024) """
+        command = action if job_id is None else "%s=%d" % (action, int(job_id))
+        return self.request("%s:%s" % (directive_with_options("JOB", options), command))
+
+    # -------------------------------------------------------------------------- request_many()
+    def request_many(self, messages, parallel=None):
+        """ Sends several DIRECTIVE:COMMAND messages at once over this one
+            connection (TA:multiplex) and returns their replies in the order of
+            messages. OS, BATCH and JOB requests run concurrently on the agent;
+            OS,stream is not supported here. """
+        if self.multiplexed != (parallel or "on"):
+            reply = self.request("TA:multiplex=%s" % (parallel or "on"))
+            if reply.get("AGENT_RETURN_CODE") != 0:
+                raise AgentError("agent does not support multiplexing: %s" % str(reply))
+            self.multiplexed = parallel or "on"
+        for index, message in enumerate(messages):
+            directive, command = str(message).split(':', 1)
+            self.send("%s,id=%d:%s" % (directive, index, command))
+        replies = [None] * len(messages)
+        for count in range(len(messages)):
+            reply = self.receive()
+            replies[int(reply.get("REQUEST_ID", -1))] = reply
+        return replies
+
+    # -------------------------------------------------------------------------- stream()
+    def stream(self, command):
+        """ Runs an OS command with OS,stream and yields each reply frame:
+            STREAM chunks first, the STREAM END reply last. """
+        self.send("OS,stream:%s" % command)
+        while True:
+            reply = self.receive()
+            yield reply
+            if reply.get("AGENT_MESSAGE") != "STREAM":
+                return
+
+    # -------------------------------------------------------------------------- get_file()
+    def get_file(self, remote_path, local_path):
+        """ Copies a file from the agent host with the GET directive. Data is
+            received into local_path.part, so calling again after a failure
+            resumes where it stopped. Returns the agent's GET header reply. """
+        part_path = local_path + ".part"
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        reply = self.request("GET,offset=%d:%s" % (offset, remote_path))
+        if reply.get("AGENT_RETURN_CODE") != 0:
+            raise AgentError("GET %s failed: %s" % (remote_path, reply.get("AGENT_MESSAGE")))
+        remaining = reply["FILE_LENGTH"]
+        with open(part_path, "ab") as part:
+            part.truncate(reply["FILE_OFFSET"])  # The agent restarts past-the-end offsets
+            try:
+                if self._buffer:
+                    data, self._buffer = self._buffer[:remaining], self._buffer[remaining:]
+                    part.write(data)
+                    remaining -= len(data)
+                buffer = bytearray(FILE_CHUNK)
+                while remaining > 0:
+                    count = self._socket.recv_into(buffer, min(remaining, FILE_CHUNK))
+                    if count == 0:
+                        raise AgentError("Agent %s:%d closed the connection" % (self.host, self.port))
+                    part.write(memoryview(buffer)[:count])
+                    remaining -= count
+            except OSError as e:
+                self.broken = True
+                raise AgentError("GET %s interrupted - %s" % (remote_path, str(e)))
+        if file_sha256(part_path) != reply["FILE_SHA256"]:
+            os.remove(part_path)
+            raise AgentError("GET %s failed: checksum mismatch" % remote_path)
+        os.replace(part_path, local_path)
+        return reply
+
+    # -------------------------------------------------------------------------- put_file()
+    def put_file(self, local_path, remote_path, mode=None):
+        """ Copies a file to the agent host with the PUT directive, resuming
+            any earlier partial upload of the same size. mode is an octal
+            string such as "755". Returns the agent's final PUT reply. """
+        size = os.path.getsize(local_path)
+        options = {"size": size, "sha256": file_sha256(local_path), "mode": mode}
+        reply = self.request("%s:%s" % (directive_with_options("PUT", options), remote_path))
+        if reply.get("AGENT_RETURN_CODE") != 0:
+            raise AgentError("PUT %s failed: %s" % (remote_path, reply.get("AGENT_MESSAGE")))
+        offset = reply["FILE_OFFSET"]
+        try:
+            with open(local_path, "rb") as source:
+                if size > offset:
+                    self._socket.sendfile(source, offset, size - offset)
+        except OSError as e:
+            self.broken = True
+            raise AgentError("PUT %s interrupted - %s" % (remote_path, str(e)))
+        reply = self.receive()
+        if reply.get("AGENT_RETURN_CODE") != 0:
+            raise AgentError("PUT %s failed: %s" % (remote_path, reply.get("AGENT_MESSAGE")))
+        return reply
+
+    # -------------------------------------------------------------------------- close()
+    def close(self):
+        """ Ends the session politely if possible, then closes the socket """
+        if self._socket is None:
+            return
+        try:
+            if not self.broken:
+                self.send("TA:bye")
+        except AgentError:
+            pass
+        try:
+            self._socket.close()
+        except OSError:
+            pass
+        self._socket = None
+
+
+# ============================================================================= AgentPool
+class AgentPool:
+    """ Thread-safe pool of persistent AgentConnections, keyed by (host, port).
+        Connections are created on demand and up to max_idle per agent are
+        kept open for reuse between calls. An idle connection the agent has
+        since closed (its --idle timeout, TA:restart) fails before any reply
+        arrives; request() and run() then send once more on a new connection. """
+
+    # -------------------------------------------------------------------------- __init__()
+    def __init__(self, max_idle=MAX_IDLE, timeout=TIMEOUT, compress=None):
+        self.max_idle = int(max_idle)
+        self.timeout  = timeout
+        self.compress = compress
+        self._idle    = {}  # (host, port) -> [AgentConnection, ...]
+        self._lock    = threading.Lock()
+        self.created  = 0  # \__ Connection reuse counters
+        self.reused   = 0  # /
+
+    # -------------------------------------------------------------------------- acquire()
+    def acquire(self, host, port=DEFAULT_PORT):
+        """ Returns an open connection to the agent, reusing an idle one when possible """
+        return self._take(host, port)[FIRST]
+
+    # -------------------------------------------------------------------------- _take()
+    def _take(self, host, port, fresh=False):
+        """ acquire() that also says whether the connection was reused """
+        key = (str(host), int(port))
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle and not fresh:
+                self.reused += 1
+                return idle.pop(), True
+            self.created += 1
+        return AgentConnection(key[FIRST], key[LAST], self.timeout, self.compress), False
+
+    # -------------------------------------------------------------------------- release()
+    def release(self, connection):
+        """ Gives a connection back to the pool (broken connections are closed) """
+        if connection.broken:
+            connection.close()
+            return
+        key = (connection.host, connection.port)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    # -------------------------------------------------------------------------- request()
+    def request(self, host, port, message):
+        """ Sends one message to an agent on a pooled connection and returns the reply """
+        return self._call(host, port, lambda connection: connection.request(message))
+
+    # -------------------------------------------------------------------------- run()
+    def run(self, host, port, command, **options):
+        """ Runs an OS command on an agent on a pooled connection """
+        return self._call(host, port, lambda connection: connection.run(command, **options))
+
+    # -------------------------------------------------------------------------- _call()
+    def _call(self, host, port, call):
+        """ Returns call(connection) on a pooled connection. When the agent
+            drops a reused connection before a single reply byte arrives it
+            never read the message, so it is sent once more on a new one. A
+            reply that times out is not retried: the command may be running. """
+        connection, reused = self._take(host, port)
+        received = connection.received
+        try:
+            return call(connection)
+        except AgentError:
+            if not (reused and connection.dropped and connection.received == received):
+                raise
+            connection.broken = True  # Closed by the agent while idle in the pool
+        finally:
+            self.release(connection)
+        connection = self._take(host, port, fresh=True)[FIRST]
+        try:
+            return call(connection)
+        finally:
+            self.release(connection)
+
+    # -------------------------------------------------------------------------- close()
+    def close(self):
+        """ Closes every idle connection """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+# ----------------------------------------------------------------------------- file_sha256()
+def file_sha256(path):
+    """ Returns the hex SHA-256 of a local file, as carried in FILE_SHA256 """
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for chunk in iter(lambda: source.read(FILE_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# ----------------------------------------------------------------------------- directive_with_options()
+def directive_with_options(directive, options):
+    """ Builds "DIRECTIVE,flag,key=value" from a dictionary of options.
+        Options set to True become flags, False/None options are left out. """
+    parts = [directive]
+    for key, value in options.items():
+        if value is True:
+            parts.append(str(key))
+        elif value is not None and value is not False:
+            parts.append("%s=%s" % (key, value))
+    return ','.join(parts)
+
+
+if __name__ == "__main__":
+   pass
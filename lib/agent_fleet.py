@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+
+# This library sends one agent message (e.g. "OS:uname -r") to a fleet of
+# agents (bin/agent.py) in parallel and gathers the replies. Hosts are worked
+# on concurrently up to a limit, each with its own deadline (connect through
+# reply), so a fleet-wide operation takes about as long as the slowest host
+# instead of the sum of all of them, and no longer than the deadline when a
+# host hangs. Results are handed back one by one as hosts answer, then
+# summarized.
+#
+# As a script:  agent_fleet.py [OPTIONS] "DIRECTIVE:COMMAND"
+
+import os
+import sys
+import time
+import queue
+import threading
+from getopt import getopt
+from collections import deque
+
+from agent_client import AgentConnection, AgentError, DEFAULT_PORT
+
+# -----------------------------------------------------------------------------
+# Some useful variables
+VERSION       = "1.0.0"
+VERBOSE       = False
+DEBUG         = False
+FIRST         = 0
+LAST          = -1
+ME            = os.path.split(sys.argv[FIRST])[LAST]  # Name of this file
+MY_PATH       = os.path.dirname(os.path.realpath(__file__))  # Path for this file
+PASSED        = "\033[32mPASSED\033[0m"  # \
+FAILED        = "\033[31mFAILED\033[0m"  # > Linux-specific colorization
+ERROR         = "\033[31mERROR\033[0m"   # /
+CONCURRENCY   = 16      # Hosts worked on at once
+TIMEOUT       = 30.0    # Seconds allowed for each host, from connect to the last reply
+SLOWEST       = 5       # Slowest hosts listed in the summary
+
+
+# ----------------------------------------------------------------------------- parse_agent()
+def parse_agent(text):
+    """ "host" or "host:port" -> (host, port) """
+    text = text.strip()
+    if text.find(':') > -1:
+        host, port = text.rsplit(':', 1)
+        return host.strip(), int(port)
+    return text, DEFAULT_PORT
+
+
+# ----------------------------------------------------------------------------- read_agents_file()
+def read_agents_file(file_name):
+    """ Reads a list of agents, one "host[:port]" per line. Blank lines and
+        lines starting with '#' are skipped. """
+    agents = []
+    for line in open(file_name, 'r').read().split('\n'):
+        line = line.split('#', 1)[FIRST].strip()
+        if len(line) > 0:
+            agents.append(parse_agent(line))
+    return agents
+
+
+# ----------------------------------------------------------------------------- new_result()
+def new_result(host, port):
+    """ An empty result dictionary for one host (see query_agent()) """
+    return {"host": host, "port": port, "name": "", "ok": False,
+            "seconds": 0.0, "reply": None, "error": ""}
+
+
+# ----------------------------------------------------------------------------- remaining()
+def remaining(deadline):
+    """ Seconds left until deadline (time.monotonic()), AgentError once past it """
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise AgentError("timed out")
+    return left
+
+
+# ----------------------------------------------------------------------------- query_agent()
+def query_agent(host, port, message, timeout=TIMEOUT, names=False):
+    """ Sends one message to one agent and returns a result dictionary:
+        host, port, name (from TA:getname, only with names=True), ok, seconds,
+        reply and error. Each socket operation gets what is left of timeout,
+        so a reply trickling in slowly cannot keep the host much past it.
+        ok is False when the agent cannot be reached, answers with a non-zero
+        AGENT_RETURN_CODE or runs an OS command that exits non-zero. """
+    result = new_result(host, port)
+    started = time.monotonic()
+    deadline = started + timeout
+    connection = None
+    try:
+        connection = AgentConnection(host, port, timeout)
+        if names:
+            connection.settimeout(remaining(deadline))
+            result["name"] = str(connection.request("TA:getname").get("AGENT_MESSAGE", ""))
+        connection.settimeout(remaining(deadline))
+        reply = connection.request(message)
+        result["reply"] = reply
+        if reply.get("AGENT_RETURN_CODE") != 0:
+            result["error"] = "AGENT_RETURN_CODE %s: %s" % (reply.get("AGENT_RETURN_CODE"), reply.get("AGENT_MESSAGE"))
+        elif reply.get("OS_RETURNCODE", 0) != 0:
+            result["error"] = "OS_RETURNCODE %s: %s" % (reply.get("OS_RETURNCODE"), str(reply.get("OS_STDERR", "")).strip())
+        else:
+            result["ok"] = True
+    except AgentError as e:
+        result["error"] = str(e)
+    finally:
+        if connection is not None:
+            connection.close()
+        result["seconds"] = time.monotonic() - started
+    return result
+
+
+# ----------------------------------------------------------------------------- _query_thread()
+def _query_thread(finished, index, host, port, message, timeout, names):
+    """ Host thread body: puts (index, query_agent() result) on finished """
+    finished.put((index, query_agent(host, port, message, timeout, names)))
+
+
+# ----------------------------------------------------------------------------- run_fleet()
+def run_fleet(agents, message, concurrency=CONCURRENCY, timeout=TIMEOUT, on_result=None, names=False):
+    """ Sends message to every (host, port) in agents, at most concurrency at
+        a time, and returns the result dictionaries (see query_agent()) in the
+        order the hosts answered. on_result(result) is called for each host as
+        soon as it answers. A host still working timeout seconds after it was
+        started is reported as timed out and its slot goes to the next host;
+        its (daemon) thread is left to end on its own. names=True also asks
+        every agent for its name. """
+    results  = []
+    finished = queue.Queue()  # (index, result) from the host threads
+    running  = {}             # index -> time.monotonic() the host was started
+    upcoming = deque(enumerate(agents))
+    concurrency = max(1, int(concurrency))
+
+    def report(result):
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+
+    while upcoming or running:
+        while upcoming and len(running) < concurrency:
+            index, (host, port) = upcoming.popleft()
+            running[index] = time.monotonic()
+            threading.Thread(target=_query_thread, daemon=True,
+                             args=(finished, index, host, port, message, timeout, names)).start()
+        try:
+            index, result = finished.get(timeout=max(0.0, min(running.values()) + timeout - time.monotonic()))
+            if running.pop(index, None) is not None:  # Else already reported as timed out
+                report(result)
+        except queue.Empty:
+            pass
+        now = time.monotonic()
+        for index, started in list(running.items()):
+            if now - started >= timeout:
+                del running[index]
+                result = new_result(*agents[index])
+                result["seconds"] = now - started
+                result["error"] = "Timed out after %ss" % timeout
+                report(result)
+    return results
+
+
+# ----------------------------------------------------------------------------- summarize()
+def summarize(results, wall_seconds, slowest=SLOWEST):
+    """ Returns the fleet summary: counts, wall and summed host time, the
+        slowest hosts and every failure. """
+    failures = [r for r in results if not r["ok"]]
+    by_time  = sorted(results, key=lambda r: r["seconds"], reverse=True)
+    return {"hosts": len(results),
+            "ok": len(results) - len(failures),
+            "failed": len(failures),
+            "wall_seconds": wall_seconds,
+            "host_seconds": sum(r["seconds"] for r in results),
+            "slowest": by_time[:slowest],
+            "failures": failures}
+
+
+# ----------------------------------------------------------------------------- host_label()
+def host_label(result):
+    """ "name (host:port)" or just "host:port" for agents without a name """
+    address = "%s:%d" % (result["host"], result["port"])
+    if result["name"] and result["name"] != "NO_NAME":
+        return "%s (%s)" % (result["name"], address)
+    return address
+
+
+# ----------------------------------------------------------------------------- show_result()
+def show_result(result):
+    """ Prints one host's result on one line, as it arrives """
+    if result["ok"]:
+        reply = result["reply"]
+        text  = str(reply.get("OS_STDOUT", reply.get("AGENT_MESSAGE", ""))).strip()
+        lines = text.split('\n')
+        if len(lines) > 1 and not VERBOSE:
+            text = "%s ... (%d lines)" % (lines[FIRST], len(lines))
+        print("%s %-40s %7.3fs  %s" % (PASSED, host_label(result), result["seconds"], text))
+    else:
+        print("%s %-40s %7.3fs  %s" % (FAILED, host_label(result), result["seconds"], result["error"]))
+    sys.stdout.flush()
+
+
+# ----------------------------------------------------------------------------- show_summary()
+def show_summary(summary):
+    """ Prints the summary returned by summarize() """
+    print("")
+    print("Hosts %d, ok %d, failed %d, wall %.3fs, host time %.3fs" %
+          (summary["hosts"], summary["ok"], summary["failed"], summary["wall_seconds"], summary["host_seconds"]))
+    if summary["slowest"]:
+        print("Slowest hosts:")
+        for result in summary["slowest"]:
+            print("   %7.3fs  %s" % (result["seconds"], host_label(result)))
+    if summary["failures"]:
+        print("Failures:")
+        for result in summary["failures"]:
+            print("   %s - %s" % (host_label(result), result["error"]))
+
+
+# ----------------------------------------------------------------------------- usage()
+def usage():
+    """ Prints the usage message on stdout """
+    print("\n%s, Version %s, sends one message to many agents in parallel." % (ME, VERSION))
+    print("\nUSAGE: %s [OPTIONS] \"DIRECTIVE:COMMAND\"" % ME)
+    print("")
+    print("OPTIONS:")
+    print("   -h --help          Display this message.")
+    print("   -v --verbose       Print every line of each reply, default: %s" % VERBOSE)
+    print("   -a --agents=       Comma separated host[:port] list, default port: %d" % DEFAULT_PORT)
+    print("   -f --file=         File with one host[:port] per line ('#' comments)")
+    print("   -c --concurrency=  Hosts worked on at once, default: %d" % CONCURRENCY)
+    print("   -t --timeout=      Seconds per host, from connect to the reply, default: %s" % TIMEOUT)
+    print("   -n --names         Also ask each agent for its name (TA:getname), default: off")
+    print("   -s --slowest=      Slowest hosts listed in the summary, default: %d" % SLOWEST)
+    print("")
+    print("EXIT CODES:")
+    print("    0 - Every host succeeded.")
+    print("    1 - One or more hosts failed.")
+    print("    2 - Bad command line arguments.")
+    print("")
+    print("EXAMPLE:")
+    print("    %s -f conf/lab_agents.txt -c 32 -t 10 \"OS:uname -r\"" % ME)
+    print("")
+
+
+# ----------------------------------------------------------------------------- main()
+def main(agents, message, concurrency, timeout, slowest, names=False):
+    """ Runs the message across the fleet, printing results as they arrive,
+        then the summary. Returns the exit code. """
+    started = time.monotonic()
+    results = run_fleet(agents, message, concurrency, timeout, show_result, names)
+    summary = summarize(results, time.monotonic() - started, slowest)
+    show_summary(summary)
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    try:
+        arguments = getopt(sys.argv[1:],
+                           'hva:f:c:t:s:n',
+                           ['help',
+                            'verbose',
+                            'agents=',
+                            'file=',
+                            'concurrency=',
+                            'timeout=',
+                            'slowest=',
+                            'names'])
+    except Exception as e:
+        sys.stderr.write("%s -- Bad command line argument(s): %s\n" % (ERROR, str(e)))
+        usage()
+        sys.exit(2)
+    agents      = []
+    concurrency = CONCURRENCY
+    timeout     = TIMEOUT
+    slowest     = SLOWEST
+    names       = False
+    try:
+        for arg in arguments[0]:
+            if arg[0] == "-h" or arg[0] == "--help":
+                usage()
+                sys.exit(0)
+            elif arg[0] == "-v" or arg[0] == "--verbose":
+                VERBOSE = True
+            elif arg[0] == "-a" or arg[0] == "--agents":
+                agents += [parse_agent(a) for a in arg[1].split(',') if a.strip()]
+            elif arg[0] == "-f" or arg[0] == "--file":
+                agents += read_agents_file(arg[1])
+            elif arg[0] == "-c" or arg[0] == "--concurrency":
+                concurrency = int(arg[1])
+                if concurrency < 1: raise ValueError("concurrency must be at least 1")
+            elif arg[0] == "-t" or arg[0] == "--timeout":
+                timeout = float(arg[1])
+            elif arg[0] == "-s" or arg[0] == "--slowest":
+                slowest = int(arg[1])
+            elif arg[0] == "-n" or arg[0] == "--names":
+                names = True
+    except (ValueError, OSError) as e:
+        sys.stderr.write("%s -- %s\n" % (ERROR, str(e)))
+        usage()
+        sys.exit(2)
+    if len(arguments[1]) != 1 or len(agents) < 1:
+        sys.stderr.write("%s -- Need one or more agents and exactly one message\n" % ERROR)
+        usage()
+        sys.exit(2)
+    sys.exit(main(agents, arguments[1][FIRST], concurrency, timeout, slowest, names))
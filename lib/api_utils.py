@@ -30,6 +30,9 @@ except:
    sys.stderr.write("         Try: pip3 install requests --user\n\n")
    sys.exit(2)
 
+# Custom library imports
+import http_pool
+
 
 # ----------------------------------------------------------------------------- job_identifier_to_hash()
 def job_identifier_to_hash(endpoint):
@@ -37,7 +40,7 @@ def job_identifier_to_hash(endpoint):
    hashed_password = None
 
    try:
-      r = requests.get(endpoint)
+      r = http_pool.get(endpoint)
       hashed_password = r.text
       # print("Hashed Password from server: %s"%str(hashed_password))
    except Exception as e:
@@ -0,0 +1,356 @@
+#!/usr/bin/python3
+
+# This library drives the hash "happy path" flow for many concurrent clients
+# from one process with asyncio. Each client is a coroutine instead of an OS
+# thread: it POSTs a password to /hash, GETs /hash/<job identifier> and checks
+# the reply against the expected SHA-512. A coroutine costs a few KB where a
+# thread costs its stack and a requests.Session, so thousands of clients fit
+# in one process. Only the standard library is used (asyncio streams and a
+# minimal HTTP/1.1 client), so nothing has to be installed.
+#
+# run_load() also reports the cost of the load itself: resident memory per
+# concurrent client and CPU time per HTTP request, so a slow run can be told
+# apart from a load generator that ran out of steam.
+#
+# Clients are either started a fixed delay apart (closed loop, as the thread
+# engine does) or on an open-loop timeline from arrival_times(): each client
+# starts at its intended time no matter how many are still waiting on the
+# server, and its latency is measured from that intended time. A server that
+# stalls then shows up as the latency its users would see, instead of quietly
+# slowing the load down (coordinated omission).
+
+import os
+import sys
+import time
+import json
+import asyncio
+import resource
+import random
+import math
+from urllib.parse import urlparse
+
+from sha512 import get_sha512_hash
+
+# -----------------------------------------------------------------------------
+# Some useful variables
+VERSION         = "1.0.0"
+VERBOSE         = False
+DEBUG           = False
+FIRST           = 0
+LAST            = -1
+ME              = os.path.split(sys.argv[FIRST])[LAST]  # Name of this file
+MY_PATH         = os.path.dirname(os.path.realpath(__file__))  # Path for this file
+PASSED          = "\033[32mPASSED\033[0m"  # \
+FAILED          = "\033[31mFAILED\033[0m"  # > Linux-specific colorization
+ERROR           = "\033[31mERROR\033[0m"   # /
+TIMEOUT         = 6.0     # Seconds allowed for each connect and each reply
+MAX_HEADER      = 65536   # Longest status or header line accepted
+SAMPLE_INTERVAL = 0.05    # Seconds between resident memory samples
+SPARE_FILES     = 64      # File descriptors kept free for everything but client sockets
+PAGE_SIZE       = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+# ----------------------------------------------------------------------------- LoadError
+class LoadError(Exception):
+    """ A malformed or missing HTTP reply """
+    pass
+
+
+# ----------------------------------------------------------------------------- read_response()
+async def read_response(reader):
+    """ Reads one HTTP/1.1 response and returns (status, headers, body) with
+        lower-case header names. Handles Content-Length, chunked bodies and
+        bodies delimited by the server closing the connection. """
+    status_line = await reader.readline()
+    if not status_line:
+        raise LoadError("server closed the connection")
+    parts = status_line.decode("latin-1").split(None, 2)
+    if len(parts) < 2 or not parts[1].isdigit():
+        raise LoadError("bad status line %r" % status_line[:80])
+    status = int(parts[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, separator, value = line.decode("latin-1").partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        body = b""
+        while True:
+            size = int((await reader.readline()).split(b';')[FIRST].strip() or b"0", 16)
+            if size == 0:
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass  # Trailers
+                break
+            body += await reader.readexactly(size)
+            await reader.readline()
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    else:
+        body = await reader.read()
+        headers["connection"] = "close"
+    return status, headers, body
+
+
+# ----------------------------------------------------------------------------- HTTPClient
+class HTTPClient:
+    """ One keep-alive HTTP/1.1 connection to host:port, opened on first use
+        and reopened when the server closes it. """
+
+    def __init__(self, host, port, timeout=TIMEOUT):
+        self.host    = host
+        self.port    = port
+        self.timeout = timeout
+        self.reader  = None
+        self.writer  = None
+
+    async def request(self, method, path, body=None, content_type=None):
+        """ Sends one request and returns (status, body). A kept-alive
+            connection that turns out to be closed is retried once on a new
+            one; anything else raises (LoadError, OSError or TimeoutError). """
+        body = body or b""
+        head = "%s %s HTTP/1.1\r\nHost: %s:%d\r\nContent-Length: %d\r\n" % (method, path, self.host, self.port, len(body))
+        if content_type:
+            head += "Content-Type: %s\r\n" % content_type
+        message = (head + "\r\n").encode("latin-1") + body
+        while True:
+            reused = self.writer is not None
+            if not reused:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port, limit=MAX_HEADER), self.timeout)
+            try:
+                self.writer.write(message)
+                await self.writer.drain()
+                status, headers, data = await asyncio.wait_for(read_response(self.reader), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError, LoadError):
+                self.close()
+                if reused:
+                    continue  # The server dropped the idle connection, try a new one
+                raise
+            except BaseException:
+                self.close()
+                raise
+            if headers.get("connection", "").lower() == "close":
+                self.close()
+            return status, data
+
+    def close(self):
+        """ Drops the connection, if any """
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+
+# ----------------------------------------------------------------------------- hash_client()
+async def hash_client(index, endpoint, password, timeout, counters, intended=None):
+    """ One client: POST the password, GET the hash for the job identifier and
+        compare it with the expected SHA-512. Returns a result dictionary:
+        client, ok, password, expected, observed, endpoint, in_flight (clients
+        running when this one finished), call_ms (the POST), lag_ms, error
+        and post_error ("timeout" or "error" when the POST itself failed).
+        Given the intended start time (loop.time()), call_ms is measured from
+        it and lag_ms is how late the client actually started. A failed POST
+        still gets a call_ms, the time until it failed. """
+    loop   = asyncio.get_running_loop()
+    url    = urlparse(endpoint)
+    client = HTTPClient(url.hostname, url.port or 80, timeout)
+    result = {"client": index, "ok": False, "password": password,
+              "expected": get_sha512_hash(password), "observed": None,
+              "endpoint": endpoint, "in_flight": 0, "call_ms": 0.0, "lag_ms": 0.0, "error": "",
+              "post_error": ""}
+    counters["in_flight"] += 1
+    counters["peak_in_flight"] = max(counters["peak_in_flight"], counters["in_flight"])
+    started = loop.time()
+    try:
+        if intended is not None:
+            result["lag_ms"] = max(0.0, started - intended) * 1000.0
+            started = min(started, intended)
+        status, job = await client.request("POST", url.path or "/",
+                                           json.dumps({"password": password}).encode("utf-8"),
+                                           "application/json")
+        result["call_ms"] = (loop.time() - started) * 1000.0
+        counters["requests"] += 1
+        if status != 200:
+            result["post_error"] = "error"
+            raise LoadError("POST returned status %d" % status)
+        status, observed = await client.request("GET", "%s/%s" % (url.path.rstrip('/'), job.decode("utf-8").strip()))
+        counters["requests"] += 1
+        result["observed"] = observed.decode("utf-8")
+        result["ok"] = (status == 200 and result["observed"] == result["expected"])
+    except (LoadError, OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+        result["error"] = str(e) or e.__class__.__name__
+        if not result["call_ms"]:  # The POST never completed
+            result["call_ms"] = (loop.time() - started) * 1000.0
+            result["post_error"] = "timeout" if isinstance(e, asyncio.TimeoutError) else "error"
+    finally:
+        client.close()
+        result["in_flight"] = counters["in_flight"]
+        counters["in_flight"] -= 1
+    return result
+
+
+# ----------------------------------------------------------------------------- resident_kb()
+def resident_kb():
+    """ Current resident set size of this process in KB (peak RSS where
+        /proc is not available) """
+    try:
+        with open("/proc/self/statm", 'r') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE // 1024
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# ----------------------------------------------------------------------------- raise_open_files_limit()
+def raise_open_files_limit(clients):
+    """ Raises the soft open files limit towards the hard one so that every
+        client can hold a socket. Returns the number of clients the limit
+        allows. """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = clients + SPARE_FILES
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        soft = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        except (ValueError, OSError):
+            soft = resource.getrlimit(resource.RLIMIT_NOFILE)[FIRST]
+    if soft == resource.RLIM_INFINITY:
+        return clients
+    return max(0, soft - SPARE_FILES)
+
+
+# ----------------------------------------------------------------------------- run_clients()
+async def run_clients(endpoint, passwords, delay, timeout, on_result, start_times=None):
+    """ Starts one hash_client() per password, delay seconds apart or at
+        the start_times offsets, and returns their results in the order they
+        finished, plus the load's own resource usage (see run_load()). """
+    loop      = asyncio.get_running_loop()
+    counters  = {"in_flight": 0, "peak_in_flight": 0, "requests": 0}
+    baseline  = resident_kb()
+    peak      = [baseline]
+    results   = []
+    finished  = asyncio.Event()
+
+    async def sample_memory():
+        while not finished.is_set():
+            peak[FIRST] = max(peak[FIRST], resident_kb())
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+    def collect(task):
+        results.append(task.result())
+        if on_result is not None:
+            on_result(results[LAST])
+
+    sampler = loop.create_task(sample_memory())
+    cpu     = time.process_time()
+    started = loop.time()
+    tasks   = []
+    for index, password in enumerate(passwords):
+        intended = started + (start_times[index] if start_times is not None else index * delay)
+        if intended > loop.time():
+            await asyncio.sleep(intended - loop.time())
+        task = loop.create_task(hash_client(index, endpoint, password, timeout, counters,
+                                            intended if start_times is not None else None))
+        task.add_done_callback(collect)
+        tasks.append(task)
+    await asyncio.gather(*tasks)
+    wall = loop.time() - started
+    cpu  = time.process_time() - cpu
+    finished.set()
+    await sampler
+    growth = max(0, peak[FIRST] - baseline)
+    usage = {"clients": len(passwords),
+             "peak_in_flight": counters["peak_in_flight"],
+             "requests": counters["requests"],
+             "wall_seconds": wall,
+             "cpu_seconds": cpu,
+             "cpu_ms_per_request": cpu * 1000.0 / max(1, counters["requests"]),
+             "rss_baseline_kb": baseline,
+             "rss_peak_kb": peak[FIRST],
+             "kb_per_client": float(growth) / max(1, counters["peak_in_flight"])}
+    return results, usage
+
+
+# ----------------------------------------------------------------------------- run_load()
+def run_load(endpoint, passwords, delay=0.0, timeout=TIMEOUT, on_result=None, start_times=None):
+    """ Runs one client per password against the POST endpoint (e.g.
+        "http://localhost:8088/hash"), starting them delay seconds apart, or
+        open loop at the start_times offsets (see arrival_times()) with
+        latency measured from each intended start. on_result(result) is
+        called as each client finishes (see
+        hash_client()). Returns (results, usage); usage holds clients,
+        peak_in_flight, requests, wall_seconds, cpu_seconds,
+        cpu_ms_per_request, rss_baseline_kb, rss_peak_kb and kb_per_client
+        (resident memory growth per concurrent client). """
+    allowed = raise_open_files_limit(len(passwords))
+    if allowed < len(passwords):
+        sys.stderr.write("%s -- Open files limit allows about %d concurrent clients, not %d\n"
+                         % (ERROR, allowed, len(passwords)))
+        sys.stderr.flush()
+    return asyncio.run(run_clients(endpoint, passwords, delay, timeout, on_result, start_times))
+
+
+# ----------------------------------------------------------------------------- arrival_times()
+def arrival_times(rate, duration, arrival="fixed", seed=None):
+    """ Intended start offsets, in seconds from the start of the run, for an
+        open-loop load of rate requests per second over duration seconds.
+        "fixed" spaces them exactly 1/rate apart; "poisson" draws exponential
+        gaps with the same mean, the way independent users arrive. """
+    if rate <= 0 or duration <= 0:
+        return []
+    if arrival == "fixed":
+        return [index / float(rate) for index in range(int(math.ceil(rate * duration - 1e-9)))]
+    if arrival != "poisson":
+        raise ValueError("arrival must be fixed or poisson, not %s" % str(arrival))
+    generator = random.Random(seed)
+    offsets = []
+    offset = generator.expovariate(rate)
+    while offset < duration:
+        offsets.append(offset)
+        offset += generator.expovariate(rate)
+    return offsets
+
+
+# ----------------------------------------------------------------------------- percentile()
+def percentile(ordered, p):
+    """ Nearest-rank percentile p (0-100) of an ordered list """
+    rank = max(1, int(math.ceil(p / 100.0 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+# ----------------------------------------------------------------------------- latency_summary()
+def latency_summary(latencies_ms, errors=0, timeouts=0):
+    """ count, mean, p50, p90, p99, p99.9 and max of a list of latencies,
+        plus how many of those requests failed (errors) or timed out
+        (timeouts). Failed requests belong in latencies_ms too, with the
+        time they took to fail, or the percentiles flatter an overloaded
+        server. """
+    ordered = sorted(latencies_ms)
+    if not ordered:
+        return {"count": 0, "mean": 0.0, "p50": 0.0, "p90": 0.0, "p99": 0.0, "p99.9": 0.0, "max": 0.0,
+                "errors": errors, "timeouts": timeouts}
+    summary = {"count": len(ordered), "mean": sum(ordered) / len(ordered), "max": ordered[LAST],
+               "errors": errors, "timeouts": timeouts}
+    for p in (50, 90, 99, 99.9):
+        summary["p%s" % p] = percentile(ordered, p)
+    return summary
+
+
+# ----------------------------------------------------------------------------- show_latency()
+def show_latency(summary, title="Latency"):
+    """ Prints a latency_summary() on two lines """
+    print("%s over %d requests, %d errors, %d timeouts (ms):" %
+          (title, summary["count"], summary.get("errors", 0), summary.get("timeouts", 0)))
+    print("   mean %9.1f   p50 %9.1f   p90 %9.1f   p99 %9.1f   p99.9 %9.1f   max %9.1f" %
+          (summary["mean"], summary["p50"], summary["p90"], summary["p99"], summary["p99.9"], summary["max"]))
+
+
+# ----------------------------------------------------------------------------- show_usage()
+def show_usage(usage):
+    """ Prints the resource usage returned by run_load() """
+    print("Load engine: asyncio, %d clients (peak %d concurrent), %d requests in %.2fs" %
+          (usage["clients"], usage["peak_in_flight"], usage["requests"], usage["wall_seconds"]))
+    print("   CPU    %.2fs total, %.3f ms per request" % (usage["cpu_seconds"], usage["cpu_ms_per_request"]))
+    print("   Memory %d KB -> %d KB resident, %.1f KB per concurrent client" %
+          (usage["rss_baseline_kb"], usage["rss_peak_kb"], usage["kb_per_client"]))
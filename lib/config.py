@@ -51,5 +51,38 @@ def readConfigFile(file_name):
     return configurations
 
 
+
+# ----------------------------------------------------------------------------- writeConfigValue()
+def writeConfigValue(file_name, key, value):
+    """ Sets key to value in a config file read by readConfigFile(). The
+        first line for the key is rewritten in place, keeping its spacing and
+        every other line as is; a missing key is appended. Returns True on
+        success. Any errors are sent to standard error.
+
+    """
+    delimiter = ' '
+    try:
+        lines = open(file_name, 'r').read().split('\n')
+        for index, line in enumerate(lines):
+            stripped = line.strip()
+            if len(stripped) < 1 or stripped[FIRST] == '#':
+                continue
+            if stripped.split(delimiter, 1)[FIRST] == key:
+                rest = stripped[len(key):]
+                spacing = rest[:len(rest) - len(rest.lstrip())] or delimiter
+                lines[index] = "%s%s%s" % (key, spacing, value)
+                break
+        else:
+            if len(lines) > 0 and lines[LAST] == "":
+                lines.insert(len(lines) - 1, "%s %s" % (key, value))
+            else:
+                lines.append("%s %s" % (key, value))
+        open(file_name, 'w').write('\n'.join(lines))
+    except Exception as e:
+        sys.stderr.write("%s -- Unable to write %s to configurations file %s\n" % (ERROR, key, file_name))
+        print(e)
+        return False
+    return True
+
 if __name__ == "__main__":
    pass
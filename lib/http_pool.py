@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+
+# This library holds the HTTP client shared by the test cases and api_utils.
+# Every thread gets its own requests.Session (cookies and settings are not
+# thread-safe to share), but all of them mount one HTTPAdapter, so the
+# keep-alive connections to each host are pooled across threads. A client
+# that posts a password and then fetches its hash reuses one connection
+# instead of opening two, and hundreds of clients no longer leave a TCP
+# handshake and a TIME_WAIT socket behind for every request.
+#
+# pool_stats() reads urllib3's per-pool counters to show how many connections
+# were opened for how many requests.
+
+import os
+import sys
+import threading
+
+# -----------------------------------------------------------------------------
+# Some useful variables
+VERSION    = "1.0.0"
+VERBOSE    = False
+DEBUG      = False
+FIRST      = 0
+LAST       = -1
+ME         = os.path.split(sys.argv[FIRST])[LAST]  # Name of this file
+MY_PATH    = os.path.dirname(os.path.realpath(__file__))  # Path for this file
+PASSED     = "\033[32mPASSED\033[0m"  # \
+FAILED     = "\033[31mFAILED\033[0m"  # > Linux-specific colorization
+ERROR      = "\033[31mERROR\033[0m"   # /
+POOL_SIZE  = 10     # Keep-alive connections kept per host, raise it to the client count
+POOL_HOSTS = 10     # Hosts that get a pool of their own
+POOL_BLOCK = False  # True: wait for a free connection instead of opening an extra one
+
+
+# Third-party library imports
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except:
+   sys.stderr.write("%s -- Unable to import the 'requests' third-party library\n" % ERROR)
+   sys.stderr.write("         Try: pip3 install requests --user\n\n")
+   sys.exit(2)
+
+_lock       = threading.Lock()   # Guards _adapter and _generation
+_adapter    = None               # The shared HTTPAdapter, created on first use
+_generation = 0                  # Bumped by configure() so thread sessions remount
+_local      = threading.local()  # Per thread: session and generation
+
+
+# ----------------------------------------------------------------------------- configure()
+def configure(pool_size=POOL_SIZE, pool_hosts=POOL_HOSTS, block=POOL_BLOCK):
+    """ Sets how many connections are kept per host (pool_size) and for how
+        many hosts (pool_hosts). With block=False a thread that finds every
+        pooled connection in use opens an extra one and drops it afterwards;
+        with block=True it waits instead. Replaces (and closes) the current
+        pools, so call it before starting the client threads. """
+    with _lock:
+        return _replace_adapter(pool_size, pool_hosts, block)
+
+
+# ----------------------------------------------------------------------------- _replace_adapter()
+def _replace_adapter(pool_size, pool_hosts, block):
+    """ configure() with _lock held """
+    global _adapter
+    global _generation
+    if _adapter is not None:
+        _adapter.close()
+    _adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, pool_block=block)
+    _generation += 1
+    return _adapter
+
+
+# ----------------------------------------------------------------------------- session()
+def session():
+    """ Returns the calling thread's requests.Session, which sends through
+        the shared connection pools """
+    if getattr(_local, "generation", None) != _generation:
+        with _lock:
+            if _adapter is None:
+                _replace_adapter(POOL_SIZE, POOL_HOSTS, POOL_BLOCK)
+            adapter, generation = _adapter, _generation
+        s = requests.Session()
+        s.mount("http://", adapter)
+        s.mount("https://", adapter)
+        _local.session = s
+        _local.generation = generation
+    return _local.session
+
+
+# ----------------------------------------------------------------------------- get()
+def get(url, **kwargs):
+    """ requests.get() over the shared pools """
+    return session().get(url, **kwargs)
+
+
+# ----------------------------------------------------------------------------- post()
+def post(url, **kwargs):
+    """ requests.post() over the shared pools """
+    return session().post(url, **kwargs)
+
+
+# ----------------------------------------------------------------------------- pool_stats()
+def pool_stats():
+    """ Returns the connection reuse counters: connections (opened), requests
+        and reused (requests sent on an already open connection), in total
+        and under "hosts" per scheme://host:port. Hosts pushed out of the
+        POOL_HOSTS most recently used take their counts with them. """
+    stats = {"connections": 0, "requests": 0, "reused": 0, "hosts": {}}
+    with _lock:
+        adapter = _adapter
+    if adapter is None:
+        return stats
+    pools = adapter.poolmanager.pools
+    for key in list(pools.keys()):
+        try:
+            pool = pools[key]
+        except KeyError:
+            continue  # Evicted meanwhile
+        host = "%s://%s:%s" % (pool.scheme, pool.host, pool.port)
+        counts = {"connections": pool.num_connections,
+                  "requests": pool.num_requests,
+                  "reused": max(0, pool.num_requests - pool.num_connections)}
+        stats["hosts"][host] = counts
+        for name in ("connections", "requests", "reused"):
+            stats[name] += counts[name]
+    return stats
+
+
+# ----------------------------------------------------------------------------- show_pool_stats()
+def show_pool_stats(stats=None):
+    """ Prints the pool_stats() totals on one line """
+    stats = stats or pool_stats()
+    share = 100.0 * stats["reused"] / stats["requests"] if stats["requests"] else 0.0
+    print("HTTP connections: %d opened for %d requests, %d reused (%.1f%%)" %
+          (stats["connections"], stats["requests"], stats["reused"], share))
@@ -42,6 +42,7 @@ try:
    from config    import readConfigFile
    from api_utils import job_identifier_to_hash
    from sha512    import get_sha512_hash
+   import http_pool
    from command   import Command
 except:
    sys.stderr.write("%s -- Unable to import custom library\n" % ERROR)
@@ -64,7 +65,7 @@ class Regression_Suite(unittest.TestCase):
       self.port                = configs["port"]
       self.hash_route          = configs["hash_route"]
       self.stats_route         = configs["stats_route"]
-      self.network_latency     = int(configs["network_latency"])
+      self.network_latency     = float(configs["network_latency"])
       self.server_process_time = int(configs["server_process_time"])
       self.timeout             = self.server_process_time + self.network_latency
       self.post_hash_endpoint  = "%s:%s/%s" %(self.base_url, self.port, self.hash_route)
@@ -75,12 +76,12 @@ class Regression_Suite(unittest.TestCase):
       # If it is not then just start it
       if VERBOSE: print("\n\n*** STARTING TEST CASE ***\n")
       r = None
-      try: r = requests.get(self.get_stats_endpoint)
+      try: r = http_pool.get(self.get_stats_endpoint)
       except: pass
       if r != None:
          # Send shutdown signal
          if VERBOSE: print("Shutting down server ...\n")
-         requests.post(self.post_hash_endpoint, data="shutdown")
+         http_pool.post(self.post_hash_endpoint, data="shutdown")
          time.sleep(3)
       # Start server, Assumes that we know where it is
       c = Command(self.server_start_command)
@@ -96,7 +97,7 @@ class Regression_Suite(unittest.TestCase):
    def tearDown(self):
       """ Send the shutdown signal to the server  """
       if VERBOSE: print("Shutting down server ...\n")
-      requests.post(self.post_hash_endpoint, data="shutdown")
+      http_pool.post(self.post_hash_endpoint, data="shutdown")
       time.sleep(3)
       if VERBOSE: print("*** Test Case complete ***\n")
 
@@ -108,7 +109,7 @@ class Regression_Suite(unittest.TestCase):
       return_values = {"status_code": 0, "job_identifier": ""}
       r = None
       try:
-         r = requests.post(self.post_hash_endpoint,
+         r = http_pool.post(self.post_hash_endpoint,
                            headers={'Content-type': 'application/json'},
                            json=payload )
          return_values["job_identifier"] = str(r.text)
@@ -201,7 +202,7 @@ class Regression_Suite(unittest.TestCase):
          response_times.append(elapsed_time)
 
       if len(response_times) > 0:
-         r = requests.get(self.get_stats_endpoint)
+         r = http_pool.get(self.get_stats_endpoint)
          response = json.loads(r.text)
          expected_requests     = len(response_times)
          expected_average_time = sum(response_times) / expected_requests
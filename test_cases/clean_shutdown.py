@@ -59,7 +59,7 @@ def thread_a(post_hash_endpoint):
          sys.stdout.flush()
          r = None
          try:
-            r = requests.post(post_hash_endpoint, json={"password": "P2$$w0rd"})
+            r = http_pool.post(post_hash_endpoint, json={"password": "P2$$w0rd"})
             message = "Thread 'A' Back from call to post hash route %d" %i
             sys.stdout.write("%s\n" % message)
             sys.stdout.flush()
@@ -96,7 +96,7 @@ def thread_b(post_hash_endpoint):
 
       time.sleep(1) # Ensure that Thread A got the fifth call in flight
 
-      r = requests.post(post_hash_endpoint, data='shutdown')
+      r = http_pool.post(post_hash_endpoint, data='shutdown')
       message = "Thread 'B' SENT SHUTDOWN SIGNAL TO SERVER %s" %post_hash_endpoint
       sys.stdout.write("%s\n" % message)
       sys.stdout.flush()
@@ -130,6 +130,7 @@ try:
    from config    import readConfigFile
    from api_utils import job_identifier_to_hash
    from sha512    import get_sha512_hash
+   import http_pool
 except:
    sys.stderr.write("%s -- Unable to import custom library\n" % ERROR)
    sys.stderr.write("         Try: git pull\n\n")
@@ -141,7 +142,7 @@ base_url            = configs["base_url"]
 port                = configs["port"]
 hash_route          = configs["hash_route"]
 stats_route         = configs["stats_route"]
-network_latency     = int(configs["network_latency"])
+network_latency     = float(configs["network_latency"])
 server_process_time = int(configs["server_process_time"])
 timeout             = server_process_time + network_latency
 post_hash_endpoint  = "%s:%s/%s" % (base_url, port, hash_route)
@@ -75,7 +75,7 @@ def post_password(endpoint, password):
    result = FAILED # Assume failure
    try:
       # make the call to post the password
-      s = Session()
+      s = http_pool.session()
       # Assumption: Using the argument json={} implies header "application/json"
       req = Request("POST", post_hash_endpoint, json={"password": password})
       prepped = s.prepare_request(req)
@@ -209,6 +209,7 @@ try:
    from config    import readConfigFile
    from api_utils import job_identifier_to_hash
    from sha512    import get_sha512_hash
+   import http_pool
 except:
    sys.stderr.write("%s -- Unable to import custom library\n" % ERROR)
    sys.stderr.write("         Try: git pull\n\n")
@@ -221,7 +222,7 @@ base_url            = configs["base_url"]
 port                = configs["port"]
 hash_route          = configs["hash_route"]
 stats_route         = configs["stats_route"]
-network_latency     = int(configs["network_latency"])
+network_latency     = float(configs["network_latency"])
 server_process_time = int(configs["server_process_time"])
 max_password_length = int(configs["max_password_length"])
 min_password_length = 1
@@ -42,6 +42,14 @@ THREAD_MONITOR = [] # array of threads. For each thread, 1 = running, 0 = not ru
 RESULT_MONITOR = [] # array of results. 0 = passed 1 = failed
 CLIENTS        = 10 # Default number of clients to execute in parallel
 THREAD_DELAY   = 0.01 # Time in seconds between clients/thread invocations
+ENGINE         = "threads" # Load engine: threads (one OS thread per client) or asyncio
+MAX_CLIENTS    = {"threads": 500, "asyncio": 20000} # Highest client count per engine
+ASYNC_DELAY    = 0.0005 # Time in seconds between asyncio client starts (2000 per second)
+RATE           = 0 # Open loop: clients started per second, 0 = closed loop (staggered burst)
+DURATION       = 10.0 # Open loop: seconds over which clients are started
+ARRIVAL        = "fixed" # Open loop timeline: fixed (evenly spaced) or poisson
+CALL_TIMES     = [] # POST call times in milliseconds, from the intended send time in open loop
+CALL_FAILURES  = [] # "timeout" or "error" for every POST that failed, its time is in CALL_TIMES too
 
 
 # Native Functions
@@ -79,8 +87,8 @@ def write_result_record_to_file(results_file=RESULTS_FILE, record=""):
       return
 
 # ----------------------------------------------------------------------------- post_password()
-def post_password(endpoint, password, thread_index):
-   """ per-thread client actions """
+def post_password(endpoint, password, thread_index, intended=None):
+   """ per-thread client actions, intended is the open-loop send time (time.time()) """
    global THREAD_MONITOR
    global RESULT_MONITOR
 
@@ -91,7 +99,7 @@ def post_password(endpoint, password, thread_index):
       THREAD_MONITOR[thread_index] = 1
 
       # make the call to post the password
-      s = Session()
+      s = http_pool.session()
       #
       req = Request("POST", post_hash_endpoint,
                     headers={'Content-type': 'application/json'},
@@ -101,9 +109,17 @@ def post_password(endpoint, password, thread_index):
          sys.stdout.write("   - Calling %s\n" %endpoint)
          sys.stdout.flush()
       start_time = time.time() * 1000.0
-      resp = s.send(prepped, timeout=timeout)
+      if intended is not None: start_time = min(start_time, intended * 1000.0) # Count our own lateness
+      try:
+         resp = s.send(prepped, timeout=timeout)
+      except Exception as e:
+         CALL_TIMES.append(time.time() * 1000.0 - start_time) # Failed calls count toward latency too
+         CALL_FAILURES.append("timeout" if isinstance(e, requests.exceptions.Timeout) else "error")
+         raise
       stop_time = time.time() * 1000.0
       elapsed_time = stop_time - start_time
+      CALL_TIMES.append(elapsed_time)
+      if resp.status_code != 200: CALL_FAILURES.append("error")
       if VERBOSE:
          sys.stdout.write("   - Call time:   %5.1f milliseconds\n" %elapsed_time)
          sys.stdout.write("   - Status Code: %s\n" % str(resp.status_code))
@@ -152,6 +168,29 @@ def post_password(endpoint, password, thread_index):
       THREAD_MONITOR[thread_index] = 0
       return results
 
+# ----------------------------------------------------------------------------- write_async_result()
+def write_async_result(result):
+   """ async_load on_result callback: records one finished asyncio client """
+   if VERBOSE:
+      sys.stdout.write("   - Client %d: %s %s\n" %(result["client"], PASSED if result["ok"] else FAILED, result["error"]))
+      sys.stdout.flush()
+   if result["error"]:
+      sys.stderr.write("%s -- Unable to post and validate %s %s\n" % (ERROR, result["endpoint"], result["password"]))
+      sys.stderr.write("%s\n\n" % result["error"])
+      sys.stderr.flush()
+      return
+   # "client, result, password, expected hash, observed hash, hash endpoint, client count, call time, "
+   result_record = "%d, %s, %s, %s, %s, %s, %d, %s " %(result["client"]                 ,
+                                                       PASSED if result["ok"] else FAILED,
+                                                       result["password"]               ,
+                                                       result["expected"]               ,
+                                                       result["observed"]               ,
+                                                       result["endpoint"]               ,
+                                                       result["in_flight"]              ,
+                                                       result["call_ms"]                )
+   write_result_record_to_file(record=result_record)
+   if result["ok"]: RESULT_MONITOR[result["client"]] = 0
+
 # ----------------------------------------------------------------------------- usage()
 def usage():
     """usage() - Prints the usage message on stdout. """
@@ -164,7 +203,11 @@ def usage():
     print("   -h --help      Display this message. ")
     print("   -v --verbose   Runs the program in verbose mode, default: %s. " % VERBOSE)
     print("   -d --debug     Runs the program in debug mode (implies verbose). ")
-    print("   -c --clients=  Client count [0-500], default: %s. " %str(CLIENTS))
+    print("   -c --clients=  Client count [0-%d] ([0-%d] with asyncio), default: %s. " %(MAX_CLIENTS["threads"], MAX_CLIENTS["asyncio"], str(CLIENTS)))
+    print("   -e --engine=   Load engine: threads or asyncio, default: %s. " %ENGINE)
+    print("   -r --rate=     Open loop: start this many clients per second (replaces --clients) ")
+    print("   -t --duration= Open loop: seconds to keep starting clients, default: %s. " %DURATION)
+    print("   -a --arrival=  Open loop: fixed or poisson arrivals, default: %s. " %ARRIVAL)
     print(" ")
     print("EXIT CODES: ")
     print("    0 - Successful completion of the program, all tests passed. ")
@@ -175,18 +218,22 @@ def usage():
 
     print(" ")
     print("EXAMPLES: ")
-    print("    TODO - I'll make some examples up later. ")
+    print("    %s -e asyncio -r 200 -t 30 -a poisson " %ME)
     print(" ")
 
 
 # Parse and Process the command line arguments
 try:
    arguments = getopt(sys.argv[1:]   ,
-                      'hvdc:'      ,
+                      'hvdc:e:r:t:a:',
                       ['help'      ,
                        'verbose'   ,
                        'debug'     ,
-                       'clients='  ] )
+                       'clients='  ,
+                       'engine='   ,
+                       'rate='     ,
+                       'duration=' ,
+                       'arrival='  ] )
 except:
   sys.stderr.write("ERROR -- Bad or missing command line argument(s)\n\n")
   usage()
@@ -207,12 +254,34 @@ try:
       if arg[0]== "-d" or arg[0] == "--debug":
          DEBUG   = True
          VERBOSE = True
+    # --- Check for an engine option
+    for arg in arguments[0]:
+      if arg[0]== "-e" or arg[0] == "--engine":
+         if arg[1] not in MAX_CLIENTS: raise ValueError("Bad engine argument %s, must be threads or asyncio" %str(arg[1]))
+         ENGINE = arg[1]
     for arg in arguments[0]:
       if arg[0]== "-c" or arg[0] == "--clients":
          try:
             CLIENTS = int(arg[1])
-            if CLIENTS > 500: raise ValueError("Client count too high, must be [0-500]")
+            if CLIENTS > MAX_CLIENTS[ENGINE]: raise ValueError("Client count too high, must be [0-%d]" %MAX_CLIENTS[ENGINE])
          except: raise ValueError("Bad clients argument %s" %str(arg[1]))
+    # --- Check for open loop options
+    for arg in arguments[0]:
+      if arg[0]== "-r" or arg[0] == "--rate":
+         try:
+            RATE = float(arg[1])
+            if RATE <= 0: raise ValueError()
+         except: raise ValueError("Bad rate argument %s, must be a number > 0" %str(arg[1]))
+      elif arg[0]== "-t" or arg[0] == "--duration":
+         try:
+            DURATION = float(arg[1])
+            if DURATION <= 0: raise ValueError()
+         except: raise ValueError("Bad duration argument %s, must be a number of seconds > 0" %str(arg[1]))
+      elif arg[0]== "-a" or arg[0] == "--arrival":
+         if arg[1] not in ("fixed", "poisson"): raise ValueError("Bad arrival argument %s, must be fixed or poisson" %str(arg[1]))
+         ARRIVAL = arg[1]
+    if RATE > 0 and RATE * DURATION > MAX_CLIENTS[ENGINE] * 1.1:
+       raise ValueError("Rate x duration too high, must give at most about %d clients with the %s engine" %(MAX_CLIENTS[ENGINE], ENGINE))
 except Exception as e:
     sys.stderr.write("%s -- %s\n\n" %(ERROR,str(e)))
     usage()
@@ -220,21 +289,26 @@ except Exception as e:
 
 # Third-party library imports
 # Import third party libraries after parsing command line arguments
-# so you can get the usage message even if the library is not installed
-try:
-    import requests
-    from requests import Request, Session
-except:
-   sys.stderr.write("%s -- Unable to import the 'requests' third-party library\n" % ERROR)
-   sys.stderr.write("         Try: pip3 install requests --user\n\n")
-   sys.exit(2)
+# so you can get the usage message even if the library is not installed.
+# The asyncio engine only needs the standard library.
+if ENGINE == "threads":
+   try:
+       import requests
+       from requests import Request, Session
+   except:
+      sys.stderr.write("%s -- Unable to import the 'requests' third-party library\n" % ERROR)
+      sys.stderr.write("         Try: pip3 install requests --user  (or use --engine=asyncio)\n\n")
+      sys.exit(2)
 
 # Custom library imports
 sys.path.append(LIBRARY_PATH)
 try:
    from config    import readConfigFile
-   from api_utils import job_identifier_to_hash
    from sha512    import get_sha512_hash
+   import async_load
+   if ENGINE == "threads":
+      from api_utils  import job_identifier_to_hash
+      import http_pool
 except:
    sys.stderr.write("%s -- Unable to import custom library\n" % ERROR)
    sys.stderr.write("         Try: git pull\n\n")
@@ -246,7 +320,7 @@ base_url            = configs["base_url"]
 port                = configs["port"]
 hash_route          = configs["hash_route"]
 stats_route         = configs["stats_route"]
-network_latency     = int(configs["network_latency"])
+network_latency     = float(configs["network_latency"])
 server_process_time = int(configs["server_process_time"])
 timeout             = server_process_time + network_latency
 post_hash_endpoint  = "%s:%s/%s" % (base_url, port, hash_route)
@@ -262,19 +336,46 @@ f = open(RESULTS_FILE, 'a')
 f.write("%s\n" % str(header))
 f.close()
 
-# Start the threads
-counter = 0
-
-for i in range(CLIENTS):
-   THREAD_MONITOR.append(0) # Create an array item for the thread and mark it is not running
-   RESULT_MONITOR.append(1) # Create an array item the the result and mark it as failing
-   counter += 1
-   password_length = random.randrange(0, 101, 2)
-   random_password = get_random_password(password_length )
-   if VERBOSE: print("Test %d: password=\"%s\"" %(counter, random_password))
-   t = Thread(target=post_password, args=(post_hash_endpoint, random_password, (len(THREAD_MONITOR)-1 ),))
-   t.start()
-   time.sleep(THREAD_DELAY)
+# Open loop: every client gets an intended send time, kept no matter how many
+# are still waiting on the server, and its latency is counted from that time
+schedule = None
+if RATE > 0:
+   schedule = async_load.arrival_times(RATE, DURATION, ARRIVAL)
+   CLIENTS  = len(schedule)
+   print("Open loop: %d clients at %.1f per second (%s arrivals) over %.1f seconds" %(CLIENTS, RATE, ARRIVAL, DURATION))
+
+# Run the clients on coroutines, all in this thread
+if ENGINE == "asyncio":
+   passwords = [get_random_password(random.randrange(0, 101, 2)) for i in range(CLIENTS)]
+   THREAD_MONITOR = [0] * CLIENTS
+   RESULT_MONITOR = [1] * CLIENTS
+   results, load_usage = async_load.run_load(post_hash_endpoint, passwords, ASYNC_DELAY,
+                                             timeout, write_async_result, schedule)
+   CALL_TIMES    = [r["call_ms"] for r in results]
+   CALL_FAILURES = [r["post_error"] for r in results if r["post_error"]]
+   async_load.show_usage(load_usage)
+else:
+   # One keep-alive connection per client thread, shared by its POST and GET
+   http_pool.configure(pool_size=max(CLIENTS, http_pool.POOL_SIZE))
+
+   # Start the threads
+   counter = 0
+   started = time.time()
+
+   for i in range(CLIENTS):
+      THREAD_MONITOR.append(0) # Create an array item for the thread and mark it is not running
+      RESULT_MONITOR.append(1) # Create an array item the the result and mark it as failing
+      counter += 1
+      password_length = random.randrange(0, 101, 2)
+      random_password = get_random_password(password_length )
+      if VERBOSE: print("Test %d: password=\"%s\"" %(counter, random_password))
+      intended = None
+      if schedule is not None:
+         intended = started + schedule[i]
+         if intended > time.time(): time.sleep(intended - time.time())
+      t = Thread(target=post_password, args=(post_hash_endpoint, random_password, (len(THREAD_MONITOR)-1 ), intended,))
+      t.start()
+      if schedule is None: time.sleep(THREAD_DELAY)
 
 while sum(THREAD_MONITOR) > 0:
    if VERBOSE: sys.stdout.write("Running %d clients\n" %sum(THREAD_MONITOR)  )
@@ -285,6 +386,10 @@ print("%s complete!" %ME)
 print("CLIENTS = %s" %str(len(THREAD_MONITOR)))
 print("FAILED  = %s" %str(sum(RESULT_MONITOR)))
 print("PASSED  = %d" %( len(THREAD_MONITOR) - sum(RESULT_MONITOR)))
+if ENGINE == "threads": http_pool.show_pool_stats()
+if schedule is not None:
+   async_load.show_latency(async_load.latency_summary(CALL_TIMES, CALL_FAILURES.count("error"), CALL_FAILURES.count("timeout")),
+                           "POST latency from intended send time")
 
 # Calculate the exit code 0=all passed 100=one or more failures
 if sum(RESULT_MONITOR) > 0:
@@ -109,6 +109,7 @@ try:
    from config    import readConfigFile
    from api_utils import job_identifier_to_hash
    from sha512    import get_sha512_hash
+   import http_pool
 except:
    sys.stderr.write("%s -- Unable to import custom library\n" % ERROR)
    sys.stderr.write("         Try: git pull\n\n")
@@ -121,7 +122,7 @@ base_url            = configs["base_url"]
 port                = configs["port"]
 hash_route          = configs["hash_route"]
 stats_route         = configs["stats_route"]
-network_latency     = int(configs["network_latency"])
+network_latency     = float(configs["network_latency"])
 server_process_time = int(configs["server_process_time"])
 max_password_length = int(configs["max_password_length"])
 min_password_length = 1
@@ -143,7 +144,7 @@ if OK_TO_TEST:
    print("Step 1: Calling %s with data %s" %(post_hash_endpoint, payload))
    try:
       start_time = time.time() * 1000.0
-      r = requests.post(post_hash_endpoint, data=payload)
+      r = http_pool.post(post_hash_endpoint, data=payload)
       stop_time = time.time() * 1000.0
       elapsed_time = stop_time - start_time
       print("Back from call in %d ms" %elapsed_time)
@@ -174,7 +175,7 @@ if OK_TO_TEST:
    time.sleep(5)
    print("Step 2: Validate that the server has actually shut down.")
    r = None
-   try: r = requests.post(post_hash_endpoint, data=payload)
+   try: r = http_pool.post(post_hash_endpoint, data=payload)
    except: pass
 
    if r == None:
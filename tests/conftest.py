@@ -0,0 +1,144 @@
+# Shared pytest fixtures: a real agent (bin/agent.py) listening on an ephemeral
+# loopback port for the whole test session, and helpers to talk to it.
+
+import os
+import sys
+import time
+import socket
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+MY_PATH      = os.path.dirname(os.path.realpath(__file__))  # Path for this file
+AGENT        = os.path.join(MY_PATH, "../bin/agent.py")
+LIBRARY_PATH = os.path.join(MY_PATH, "../lib")
+HOST         = "127.0.0.1"
+START_WAIT   = 15.0  # Seconds the agent gets to start listening
+STOP_WAIT    = 15.0  # Seconds the agent gets to drain and exit
+
+sys.path.insert(0, LIBRARY_PATH)
+
+
+# ----------------------------------------------------------------------------- free_port()
+def free_port():
+    """ A TCP port nothing listens on right now """
+    with socket.socket() as probe:
+        probe.bind((HOST, 0))
+        return probe.getsockname()[1]
+
+
+# ----------------------------------------------------------------------------- start_agent()
+def start_agent(folder, *options):
+    """ Starts a copy of the agent in folder (so its log lands there and not
+        in bin/) on a free port, with any extra command line options, and
+        returns (process, port) once it accepts connections """
+    port = free_port()
+    script = os.path.join(str(folder), "agent.py")
+    shutil.copy(AGENT, script)
+    process = subprocess.Popen([sys.executable, script, "-a", HOST, "-p", str(port)] + list(options),
+                               cwd=str(folder), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + START_WAIT
+    while True:
+        try:
+            socket.create_connection((HOST, port), timeout=1.0).close()
+            return process, port
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                pytest.fail("agent did not start listening on %s:%d" % (HOST, port))
+            time.sleep(0.1)
+
+
+# ----------------------------------------------------------------------------- stop_agent()
+def stop_agent(process, port):
+    """ Stops an agent from start_agent() with TA:shutdown, which also ends
+        its jobs, and kills it if it does not drain in time """
+    try:
+        with socket.create_connection((HOST, port), timeout=5.0) as session:
+            session.sendall(b"TA:shutdown")
+            session.recv(65536)
+    except OSError:
+        process.terminate()  # Not listening (any more)
+    try:
+        process.wait(STOP_WAIT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+# ----------------------------------------------------------------------------- agent()
+@pytest.fixture(scope="session")
+def agent(tmp_path_factory):
+    """ Starts the agent on a free port and yields (host, port) """
+    process, port = start_agent(tmp_path_factory.mktemp("agent"))
+    yield HOST, port
+    stop_agent(process, port)
+
+
+# ----------------------------------------------------------------------------- spawn_agent()
+@pytest.fixture
+def spawn_agent(tmp_path_factory):
+    """ Yields spawn(*options) -> port, which starts an agent of the test's
+        own with extra options; they are stopped after the test """
+    processes = []
+
+    def spawn(*options):
+        process, port = start_agent(tmp_path_factory.mktemp("agent"), *options)
+        processes.append((process, port))
+        return port
+
+    yield spawn
+    for process, port in processes:
+        stop_agent(process, port)
+
+
+# ----------------------------------------------------------------------------- connection()
+@pytest.fixture
+def connection(agent):
+    """ An agent_client.AgentConnection (framed protocol, JSON replies) """
+    from agent_client import AgentConnection
+    connection = AgentConnection(agent[0], agent[1], timeout=30.0)
+    yield connection
+    connection.close()
+
+
+# ----------------------------------------------------------------------------- RawSession
+class RawSession:
+    """ A bare socket session, for checking the wire format itself """
+
+    def __init__(self, host, port):
+        self.socket = socket.create_connection((host, port), timeout=30.0)
+
+    def legacy(self, message):
+        """ Sends one legacy (protocol 1) message and returns the reply text """
+        self.socket.sendall(message.encode("utf-8"))
+        return self.socket.recv(65536).decode("utf-8")
+
+    def framed(self, message):
+        """ Sends one framed (protocol 2) message and returns the reply text """
+        payload = message.encode("utf-8")
+        self.socket.sendall(struct.pack("!I", len(payload)) + payload)
+        size = struct.unpack("!I", self._exactly(4))[0]
+        return self._exactly(size).decode("utf-8")
+
+    def _exactly(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.socket.recv(size - len(data))
+            assert chunk, "agent closed the connection"
+            data += chunk
+        return data
+
+    def close(self):
+        self.socket.close()
+
+
+# ----------------------------------------------------------------------------- raw()
+@pytest.fixture
+def raw(agent):
+    """ A RawSession with the agent """
+    session = RawSession(*agent)
+    yield session
+    session.close()
@@ -0,0 +1,470 @@
+# End-to-end tests of bin/agent.py, run against the agent fixture in
+# conftest.py: an agent on an ephemeral loopback port.
+
+import os
+import ast
+import json
+import time
+import signal
+import struct
+import zlib
+
+
+# ----------------------------------------------------------------------------- framed protocol
+def test_legacy_reply_is_one_recv(raw):
+    reply = ast.literal_eval(raw.legacy("OS:echo hi"))
+    assert reply["AGENT_RETURN_CODE"] == 0
+    assert reply["OS_STDOUT"] == "hi"
+
+
+def test_framed_replies(raw):
+    assert "PROTOCOL 2" in raw.legacy("TA:protocol=2")  # Answered in the old mode
+    reply = ast.literal_eval(raw.framed("OS:echo framed"))
+    assert reply["OS_STDOUT"] == "framed"
+    assert ast.literal_eval(raw.framed("TA:protocol"))["AGENT_MESSAGE"] == "PROTOCOL 2"
+
+
+def test_framed_requests_can_be_pipelined(raw):
+    raw.legacy("TA:protocol=2")
+    payloads = [("OS:echo %d" % n).encode("utf-8") for n in range(5)]
+    raw.socket.sendall(b"".join(struct.pack("!I", len(p)) + p for p in payloads))
+    for n in range(5):
+        size = struct.unpack("!I", raw._exactly(4))[0]
+        assert ast.literal_eval(raw._exactly(size).decode("utf-8"))["OS_STDOUT"] == str(n)
+
+
+# ----------------------------------------------------------------------------- JSON replies
+def test_json_replies(raw):
+    raw.legacy("TA:protocol=2")
+    assert json.loads(raw.framed("TA:format=json"))["AGENT_MESSAGE"] == "FORMAT json"
+    reply = json.loads(raw.framed("OS:printf '%s' 'quotes \" and \\ survive'"))
+    assert reply["OS_STDOUT"] == 'quotes " and \\ survive'
+    assert reply["OS_RETURNCODE"] == 0
+    raw.framed("TA:format=text")
+    assert ast.literal_eval(raw.framed("OS:echo back"))["OS_STDOUT"] == "back"
+
+
+def test_client_reports_exit_status_and_stderr(connection):
+    reply = connection.run("echo oops >&2; exit 3")
+    assert reply["AGENT_RETURN_CODE"] == 0
+    assert reply["OS_RETURNCODE"] == 3
+    assert reply["OS_STDERR"] == "oops"
+
+
+# ----------------------------------------------------------------------------- limits
+BUSY_LOOP = "python3 -c 'while 1: pass'"
+
+
+def test_timeout_limit(connection):
+    started = time.monotonic()
+    reply = connection.run("sleep 30", timeout=1)
+    assert reply["OS_LIMIT"] == "timeout"
+    assert reply["OS_RETURNCODE"] == -signal.SIGKILL
+    assert time.monotonic() - started < 10
+
+
+def test_cpu_limit(connection):
+    reply = connection.run(BUSY_LOOP, cpu=1)
+    assert reply["OS_LIMIT"] == "cpu"
+
+
+def test_cpu_limit_inside_a_pipeline(connection):
+    reply = connection.run(BUSY_LOOP + " | cat", cpu=1)
+    assert reply["OS_LIMIT"] == "cpu"
+
+
+def test_cpu_limit_shared_by_a_pipeline(connection):
+    # Neither member reaches RLIMIT_CPU alone, together they pass the limit
+    member = "python3 -c 'import time\nwhile time.process_time() < 0.8: pass'"
+    reply = connection.run("%s | %s" % (member, member), cpu=1)
+    assert reply["OS_LIMIT"] == "cpu"
+
+
+def test_cpu_limit_not_guessed_from_the_exit_status(connection):
+    for command, returnCode in (("exit 152", 152), ("kill -9 $$", -signal.SIGKILL)):
+        reply = connection.run(command, cpu=30, shell="always")
+        assert reply["OS_RETURNCODE"] == returnCode
+        assert reply["OS_LIMIT"] == ""
+
+
+def test_maxout_limit(connection):
+    reply = connection.run("yes", maxout="1K")
+    assert reply["OS_LIMIT"] == "maxout"
+    assert len(reply["OS_STDOUT"]) <= 1024
+
+
+def test_no_limit_hit(connection):
+    reply = connection.run("echo fine", timeout=10, cpu=5, maxout="1M")
+    assert reply["OS_LIMIT"] == ""
+    assert reply["OS_STDOUT"] == "fine"
+
+
+def test_os_limit_only_reported_with_limits(connection):
+    assert "OS_LIMIT" not in connection.run("echo plain")
+    assert "OS_LIMIT" not in connection.run("echo plain", shell="never")
+    assert connection.run("echo limited", maxrss="1G")["OS_LIMIT"] == ""
+
+
+# ----------------------------------------------------------------------------- persistent shell
+def test_shell_keeps_state(connection):
+    assert connection.request("TA:shell=on")["AGENT_MESSAGE"] == "SHELL on"
+    connection.run("cd /tmp && export AGENT_TEST=42")
+    assert connection.run("pwd; echo $AGENT_TEST")["OS_STDOUT"] == "/tmp\n42"
+
+
+def test_shell_timeout_restarts_the_shell(connection):
+    connection.request("TA:shell=on")
+    connection.run("export AGENT_TEST=lost")
+    started = time.monotonic()
+    reply = connection.run("while :; do echo x; done", timeout=1)
+    assert reply["OS_LIMIT"] == "timeout"
+    assert time.monotonic() - started < 10
+    reply = connection.run("echo still-works $AGENT_TEST")
+    assert reply["OS_STDOUT"] == "still-works"  # A new shell, the old state is gone
+
+
+def test_shell_maxout(connection):
+    connection.request("TA:shell=on")
+    reply = connection.run("yes", maxout="1K")
+    assert reply["OS_LIMIT"] == "maxout"
+    assert len(reply["OS_STDOUT"]) <= 1024
+
+
+def test_shell_disconnect_kills_the_command(agent, tmp_path):
+    from agent_client import AgentConnection
+    pid_file = tmp_path / "pid"
+    connection = AgentConnection(agent[0], agent[1], timeout=30.0)
+    connection.request("TA:shell=on")
+    connection.send("OS:sh -c 'echo $$ > %s; exec sleep 300'" % pid_file)
+    deadline = time.monotonic() + 10
+    while not (pid_file.exists() and pid_file.read_text().strip()):
+        assert time.monotonic() < deadline, "command did not start"
+        time.sleep(0.05)
+    pid = int(pid_file.read_text())
+    connection._socket.close()  # Gone without TA:bye
+    while os.path.exists("/proc/%d" % pid):
+        assert time.monotonic() < deadline, "command still running after the disconnect"
+        time.sleep(0.05)
+
+
+# ----------------------------------------------------------------------------- file transfer
+FILE_BYTES = 300 * 1024
+
+
+def test_get_resumes_from_a_partial_file(connection, tmp_path):
+    from agent_client import file_sha256
+    data = os.urandom(FILE_BYTES)
+    remote = tmp_path / "remote.bin"
+    remote.write_bytes(data)
+    local = tmp_path / "local.bin"
+    (tmp_path / "local.bin.part").write_bytes(data[:100000])
+    reply = connection.get_file(str(remote), str(local))
+    assert reply["FILE_OFFSET"] == 100000
+    assert reply["FILE_LENGTH"] == FILE_BYTES - 100000
+    assert local.read_bytes() == data
+    assert reply["FILE_SHA256"] == file_sha256(str(local))
+
+
+def test_put_resumes_an_interrupted_upload(agent, connection, tmp_path):
+    from agent_client import AgentConnection, file_sha256
+    data = os.urandom(FILE_BYTES)
+    local = tmp_path / "local.bin"
+    local.write_bytes(data)
+    remote = tmp_path / "remote.bin"
+    header = "PUT,size=%d,sha256=%s:%s" % (FILE_BYTES, file_sha256(str(local)), remote)
+
+    first = AgentConnection(agent[0], agent[1], timeout=30.0)
+    assert first.request(header)["FILE_OFFSET"] == 0
+    first._socket.sendall(data[:100000])
+    first._socket.close()  # Interrupted part way
+    part = tmp_path / "remote.bin.part"
+    deadline = time.monotonic() + 10
+    while not (part.exists() and part.stat().st_size == 100000):
+        assert time.monotonic() < deadline, "partial upload not kept"
+        time.sleep(0.05)
+    assert not remote.exists()
+
+    reply = connection.request(header)
+    assert reply["FILE_OFFSET"] == 100000
+    connection._socket.sendall(data[100000:])
+    assert connection.receive()["AGENT_MESSAGE"] == "PUT"
+    assert remote.read_bytes() == data
+    assert not part.exists()
+
+
+def test_put_then_get_round_trip(connection, tmp_path):
+    data = os.urandom(FILE_BYTES)
+    local = tmp_path / "local.bin"
+    local.write_bytes(data)
+    connection.put_file(str(local), str(tmp_path / "remote.bin"), mode="640")
+    assert (tmp_path / "remote.bin").stat().st_mode & 0o777 == 0o640
+    connection.get_file(str(tmp_path / "remote.bin"), str(tmp_path / "back.bin"))
+    assert (tmp_path / "back.bin").read_bytes() == data
+
+
+
+# ----------------------------------------------------------------------------- multiplexed requests
+def test_multiplexed_replies_arrive_as_they_finish(connection):
+    assert connection.request("TA:multiplex=on")["AGENT_MESSAGE"].startswith("MULTIPLEX")
+    connection.send("OS,id=slow:sleep 1; echo slow")
+    connection.send("OS,id=fast:echo fast")
+    first, second = connection.receive(), connection.receive()
+    assert (first["REQUEST_ID"], first["OS_STDOUT"]) == ("fast", "fast")
+    assert (second["REQUEST_ID"], second["OS_STDOUT"]) == ("slow", "slow")
+
+
+def test_in_order_requests_do_not_wait_for_tagged_ones(connection):
+    connection.request("TA:multiplex=4")
+    connection.send("OS,id=7:sleep 1; echo tagged")
+    connection.send("OS:echo one")
+    connection.send("TA:getname")
+    connection.send("OS:echo two")
+    replies = [connection.receive() for n in range(4)]
+    assert [r.get("OS_STDOUT") for r in replies[:3]] == ["one", None, "two"]
+    assert all("REQUEST_ID" not in r for r in replies[:3])
+    assert (replies[3]["REQUEST_ID"], replies[3]["OS_STDOUT"]) == ("7", "tagged")
+
+
+def test_multiplex_off_waits_for_outstanding_requests(connection):
+    connection.request("TA:multiplex=on")
+    connection.send("OS,id=a:sleep 1; echo a")
+    connection.send("OS,id=b:sleep 0.5; echo b")
+    connection.send("TA:multiplex=off")
+    replies = [connection.receive() for n in range(3)]
+    assert sorted(r.get("REQUEST_ID") for r in replies[:2]) == ["a", "b"]
+    assert replies[2]["AGENT_MESSAGE"] == "MULTIPLEX off"
+    assert "REQUEST_ID" not in connection.run("echo in-order")
+
+
+# ----------------------------------------------------------------------------- async jobs
+def test_job_status_partial_output_and_wait(connection):
+    job = connection.start_job("echo first; sleep 1; echo second; echo err >&2")
+    assert connection.job("status", job)["JOB_STATE"] == "running"
+    deadline = time.monotonic() + 10
+    reply = connection.job("output", job)
+    while reply["OS_STDOUT"] != "first\n":
+        assert time.monotonic() < deadline, "no partial output"
+        time.sleep(0.05)
+        reply = connection.job("output", job)
+    assert reply["OS_RETURNCODE"] is None
+    reply = connection.job("wait", job, timeout=10, stdout=reply["JOB_STDOUT_SIZE"])
+    assert reply["JOB_STATE"] == "done"
+    assert reply["OS_STDOUT"] == "second\n"  # Only what came after the offset
+    assert reply["OS_STDERR"] == "err\n"
+    assert reply["OS_RETURNCODE"] == 0
+
+
+def test_job_wait_times_out_then_cancel_and_forget(connection):
+    job = connection.start_job("sleep 60")
+    started = time.monotonic()
+    assert connection.job("wait", job, timeout=0.5)["JOB_STATE"] == "running"
+    assert time.monotonic() - started < 5
+    assert connection.job("forget", job)["AGENT_RETURN_CODE"] == 225  # Still running
+    assert connection.job("cancel", job)["JOB_STATE"] == "cancelled"
+    assert connection.job("forget", job)["AGENT_MESSAGE"] == "FORGOTTEN %d" % job
+    assert connection.job("status", job)["AGENT_RETURN_CODE"] == 225
+    assert job not in [j["JOB_ID"] for j in connection.job("list")["AGENT_DATA"]]
+
+
+def test_job_survives_the_session_that_started_it(agent, connection):
+    from agent_client import AgentConnection
+    starter = AgentConnection(agent[0], agent[1], timeout=30.0)
+    job = starter.start_job("sleep 1; echo survived")
+    starter._socket.close()  # Gone without TA:bye
+    reply = connection.job("wait", job, timeout=10)
+    assert (reply["JOB_STATE"], reply["OS_STDOUT"]) == ("done", "survived\n")
+
+
+def test_job_limit_rejects_past_max_jobs(spawn_agent):
+    from agent_client import AgentConnection
+    from conftest import HOST
+    connection = AgentConnection(HOST, spawn_agent(), timeout=30.0)
+    try:
+        jobs = [connection.start_job("sleep 60") for n in range(256)]  # MAX_JOBS
+        assert connection.run("sleep 60", **{"async": True})["AGENT_RETURN_CODE"] == 226
+        connection.job("cancel", jobs[0])
+        assert connection.run("true", **{"async": True})["AGENT_RETURN_CODE"] == 0
+    finally:
+        connection.close()
+
+
+# ----------------------------------------------------------------------------- streamed output
+def test_stream_sends_output_as_it_is_produced(connection):
+    started = time.monotonic()
+    frames = connection.stream("echo first; sleep 1; echo second; echo err >&2; exit 4")
+    first = next(frames)
+    assert time.monotonic() - started < 0.9  # Before the command finished
+    assert (first["AGENT_MESSAGE"], first["OS_STREAM"], first["OS_DATA"]) == ("STREAM", "stdout", "first\n")
+    frames = [first] + list(frames)
+    chunks = [f for f in frames[:-1] if f["AGENT_MESSAGE"] == "STREAM"]
+    assert len(chunks) == len(frames) - 1
+    assert "".join(f["OS_DATA"] for f in chunks if f["OS_STREAM"] == "stdout") == "first\nsecond\n"
+    assert "".join(f["OS_DATA"] for f in chunks if f["OS_STREAM"] == "stderr") == "err\n"
+    assert (frames[-1]["AGENT_MESSAGE"], frames[-1]["OS_RETURNCODE"]) == ("STREAM END", 4)
+
+
+def test_stream_requires_the_framed_protocol(raw):
+    assert ast.literal_eval(raw.legacy("OS,stream:echo hi"))["AGENT_RETURN_CODE"] == 221
+
+
+# ----------------------------------------------------------------------------- BATCH
+def test_batch_results_keep_the_order_given(connection):
+    commands = ["sleep 1; echo slow", "echo fast", "echo err >&2; false"]
+    started = time.monotonic()
+    reply = connection.request("BATCH,parallel=3:%s" % json.dumps(commands))
+    assert time.monotonic() - started < 1.9  # Ran at once
+    assert reply["AGENT_MESSAGE"] == "BATCH OF 3"
+    results = reply["OS_RESULTS"]
+    assert [r["OS_COMMAND"] for r in results] == commands
+    assert [r["OS_STDOUT"] for r in results] == ["slow", "fast", ""]
+    assert [r["OS_RETURNCODE"] for r in results] == [0, 0, 1]
+    assert results[2]["OS_STDERR"] == "err"
+
+
+def test_batch_sequential_runs_one_after_another(connection, tmp_path):
+    log = tmp_path / "order"
+    commands = ["sleep 0.3; echo %d >> %s" % (n, log) for n in range(3)]
+    reply = connection.request("BATCH,sequential:%s" % json.dumps(commands))
+    assert [r["OS_RETURNCODE"] for r in reply["OS_RESULTS"]] == [0, 0, 0]
+    assert log.read_text() == "0\n1\n2\n"
+
+
+def test_batch_rejects_a_bad_list(connection):
+    assert connection.request("BATCH:not json")["AGENT_RETURN_CODE"] == 222
+    assert connection.request("BATCH:[]")["AGENT_RETURN_CODE"] == 222
+
+
+# ----------------------------------------------------------------------------- result cache
+def counting(path):
+    """ A command whose output changes on every run: the number of runs so far """
+    return "echo run >> %s; wc -l < %s" % (path, path)
+
+
+def test_cache_hit_and_uncache(connection, tmp_path):
+    command = counting(tmp_path / "runs")
+    assert connection.run(command, cache=60)["OS_STDOUT"] == "1"
+    reply = connection.run(command, cache=60)
+    assert (reply["AGENT_MESSAGE"], reply["OS_STDOUT"]) == ("CACHED", "1")
+    assert connection.run(command)["OS_STDOUT"] == "2"  # Without the option, never from the cache
+    assert connection.request("TA:uncache=%s" % command)["AGENT_MESSAGE"] == "UNCACHED 1"
+    reply = connection.run(command, cache=60)
+    assert (reply["AGENT_MESSAGE"], reply["OS_STDOUT"]) == ("", "3")
+
+
+def test_cache_ttl(connection, tmp_path):
+    command = counting(tmp_path / "runs")
+    connection.run(command, cache=0.5)
+    assert connection.run(command, cache=0.5)["AGENT_MESSAGE"] == "CACHED"
+    time.sleep(1)
+    assert connection.run(command, cache=0.5)["OS_STDOUT"] == "2"
+
+
+def test_cache_skips_failed_commands(connection, tmp_path):
+    command = counting(tmp_path / "runs") + "; false"
+    connection.run(command, cache=60)
+    assert connection.run(command, cache=60)["AGENT_MESSAGE"] == ""
+
+
+def test_cache_drops_the_least_recently_used(spawn_agent, tmp_path):
+    from agent_client import AgentConnection
+    from conftest import HOST
+    connection = AgentConnection(HOST, spawn_agent("--cache-size=2"), timeout=30.0)
+    try:
+        a, b, c = [counting(tmp_path / name) for name in "abc"]
+        connection.run(a, cache=60)
+        connection.run(b, cache=60)
+        assert connection.run(a, cache=60)["AGENT_MESSAGE"] == "CACHED"  # Now b is the oldest use
+        connection.run(c, cache=60)
+        assert connection.run(b, cache=60)["OS_STDOUT"] == "2"  # Evicted
+        assert connection.run(c, cache=60)["AGENT_MESSAGE"] == "CACHED"
+        counters = connection.request("TA:cache")["AGENT_DATA"]
+        assert (counters["entries"], counters["size"], counters["evictions"]) == (2, 2, 2)
+        assert (counters["hits"], counters["misses"]) == (2, 4)
+    finally:
+        connection.close()
+
+
+# ----------------------------------------------------------------------------- compressed frames
+def test_compressed_frames_and_their_stats(spawn_agent):
+    from conftest import HOST, RawSession
+    session = RawSession(HOST, spawn_agent())
+    try:
+        session.legacy("TA:protocol=2")
+        assert ast.literal_eval(session.framed("TA:compress=200"))["AGENT_MESSAGE"] == "COMPRESS 200"
+        assert ast.literal_eval(session.framed("OS:echo small"))["OS_STDOUT"] == "small"  # Under the threshold
+        request = b"OS:printf %05000d 0"
+        session.socket.sendall(struct.pack("!I", len(request)) + request)
+        size = struct.unpack("!I", session._exactly(4))[0]
+        assert size & 0x80000000  # COMPRESSED_FLAG
+        packed = session._exactly(size & ~0x80000000)
+        reply = ast.literal_eval(zlib.decompress(packed).decode("utf-8"))
+        assert reply["OS_STDOUT"] == "0" * 5000
+        assert len(packed) < 500
+        assert ast.literal_eval(session.framed("TA:compress=off"))["AGENT_MESSAGE"] == "COMPRESS off"
+        request = zlib.compress(b"OS:echo inflated")  # The agent takes compressed requests at any time
+        session.socket.sendall(struct.pack("!I", len(request) | 0x80000000) + request)
+        size = struct.unpack("!I", session._exactly(4))[0]
+        assert ast.literal_eval(session._exactly(size).decode("utf-8"))["OS_STDOUT"] == "inflated"
+        stats = ast.literal_eval(session.framed("TA:stats"))["AGENT_DATA"]["compression"]
+        assert stats["replies"] == 1
+        assert stats["bytes_before"] > 5000 and stats["bytes_after"] == len(packed)
+        assert stats["ratio"] == round(stats["bytes_before"] / stats["bytes_after"], 2)
+    finally:
+        session.close()
+
+
+def test_client_decompresses_replies(agent):
+    from agent_client import AgentConnection
+    connection = AgentConnection(agent[0], agent[1], timeout=30.0, compress=100)
+    try:
+        assert connection.run("printf %05000d 0")["OS_STDOUT"] == "0" * 5000
+    finally:
+        connection.close()
+
+
+# ----------------------------------------------------------------------------- agent statistics
+def test_stats_directive_percentiles(spawn_agent):
+    from agent_client import AgentConnection
+    from conftest import HOST
+    connection = AgentConnection(HOST, spawn_agent(), timeout=30.0)
+    try:
+        connection.request("TA:stats=reset")
+        for n in range(9):
+            connection.run("true")
+        connection.run("sleep 0.3")
+        os_stats = connection.request("TA:stats")["AGENT_DATA"]["directives"]["OS"]
+        assert os_stats["count"] == 10
+        assert os_stats["max_ms"] >= 300
+        assert os_stats["p50_ms"] <= os_stats["p90_ms"] < 300 <= os_stats["p99_ms"] == os_stats["max_ms"]
+        assert os_stats["p90_ms"] <= 2 * os_stats["mean_ms"]  # The fast runs, not the slow one
+    finally:
+        connection.close()
+
+
+def test_stats_requests_in_flight(spawn_agent):
+    from agent_client import AgentConnection
+    from conftest import HOST
+    port = spawn_agent()
+    starter, multiplexed, watcher = [AgentConnection(HOST, port, timeout=30.0) for n in range(3)]
+    try:
+        jobs = [starter.start_job("sleep 30") for n in range(2)]
+        multiplexed.request("TA:multiplex=on")
+        for n in range(3):
+            multiplexed.send("OS,id=%d:sleep 1" % n)
+        time.sleep(0.3)
+        stats = watcher.request("TA:stats")["AGENT_DATA"]
+        assert stats["jobs_running"] == 2
+        assert stats["requests_in_flight"] == 2 + 3 + 1  # Jobs, multiplexed requests and TA:stats itself
+        assert stats["sessions_active"] == 3
+        assert sorted(multiplexed.receive()["REQUEST_ID"] for n in range(3)) == ["0", "1", "2"]
+        for job in jobs:
+            starter.job("cancel", job)
+        deadline = time.monotonic() + 5  # A request counts until its reply is sent, a moment after it arrives
+        stats = watcher.request("TA:stats")["AGENT_DATA"]
+        while stats["requests_in_flight"] != 1 and time.monotonic() < deadline:
+            time.sleep(0.05)
+            stats = watcher.request("TA:stats")["AGENT_DATA"]
+        assert (stats["requests_in_flight"], stats["jobs_running"]) == (1, 0)
+    finally:
+        for connection in (starter, multiplexed, watcher):
+            connection.close()
@@ -0,0 +1,109 @@
+# Tests of lib/agent_client.py, and of the agent's session limits, against
+# agents of their own (spawn_agent in conftest.py) started with the options
+# each test needs.
+
+import os
+import re
+import ast
+import time
+import socket
+import signal
+import threading
+
+import pytest
+
+from agent_client import AgentConnection, AgentPool, AgentError, AgentBusy
+from conftest import HOST
+
+
+# ----------------------------------------------------------------------------- AgentPool
+def test_pool_reconnects_after_the_idle_timeout(spawn_agent):
+    port = spawn_agent("--idle=1")
+    pool = AgentPool()
+    try:
+        assert pool.run(HOST, port, "echo one")["OS_STDOUT"] == "one"
+        time.sleep(2)  # The agent ends the pooled session meanwhile
+        assert pool.run(HOST, port, "echo two")["OS_STDOUT"] == "two"
+        assert (pool.created, pool.reused) == (2, 1)
+    finally:
+        pool.close()
+
+
+def test_pool_reconnects_after_a_restart(spawn_agent):
+    port = spawn_agent()
+    pool = AgentPool()
+    replacement = None
+    try:
+        first = pool.run(HOST, port, "echo $PPID")["OS_STDOUT"]
+        reply = pool.request(HOST, port, "TA:restart")
+        replacement = int(re.search(r"NEW PID (\d+)", reply["AGENT_MESSAGE"]).group(1))
+        assert pool.run(HOST, port, "echo after")["OS_STDOUT"] == "after"
+        assert pool.run(HOST, port, "echo $PPID")["OS_STDOUT"] != first
+    finally:
+        pool.close()
+        if replacement is not None:
+            os.kill(replacement, signal.SIGTERM)
+
+
+def test_pool_does_not_resend_a_request_that_timed_out(spawn_agent, tmp_path):
+    port = spawn_agent()
+    marker = tmp_path / "runs"
+    pool = AgentPool(timeout=0.5)
+    try:
+        with pytest.raises(AgentError):
+            pool.run(HOST, port, "echo run >> %s; sleep 2" % marker)
+        time.sleep(2.5)
+        assert marker.read_text() == "run\n"
+    finally:
+        pool.close()
+
+
+# ----------------------------------------------------------------------------- busy policy and idle timeout
+def test_busy_reject_reply(spawn_agent):
+    port = spawn_agent("--max-sessions=1", "--retry-after=100")
+    holder = AgentConnection(HOST, port)
+    try:
+        with socket.create_connection((HOST, port), timeout=10) as rejected:
+            reply = ast.literal_eval(rejected.recv(65536).decode("utf-8"))
+            assert reply["AGENT_RETURN_CODE"] == 203
+            assert reply["RETRY_AFTER_MS"] == 100
+            assert rejected.recv(65536) == b""  # Then disconnected
+        with pytest.raises(AgentBusy) as busy:
+            AgentConnection(HOST, port, busy_retries=0)
+        assert busy.value.retry_after == 0.1
+    finally:
+        holder.close()
+
+
+def test_busy_client_retries_until_a_session_is_free(spawn_agent):
+    port = spawn_agent("--max-sessions=1", "--retry-after=100")
+    holder = AgentConnection(HOST, port)
+    threading.Timer(0.5, holder.close).start()
+    waiter = AgentConnection(HOST, port, busy_retries=30)
+    try:
+        assert waiter.run("echo got-in")["OS_STDOUT"] == "got-in"
+    finally:
+        waiter.close()
+
+
+def test_busy_queue_waits_for_a_free_session(spawn_agent):
+    port = spawn_agent("--max-sessions=1", "--busy=queue")
+    holder = AgentConnection(HOST, port)
+    with socket.create_connection((HOST, port), timeout=10) as queued:
+        queued.sendall(b"OS:echo queued")
+        queued.settimeout(0.5)
+        with pytest.raises(socket.timeout):
+            queued.recv(65536)  # Waits in the backlog, no reply
+        holder.close()
+        queued.settimeout(10)
+        assert ast.literal_eval(queued.recv(65536).decode("utf-8"))["OS_STDOUT"] == "queued"
+
+
+def test_idle_session_is_ended(spawn_agent):
+    port = spawn_agent("--idle=1")
+    with socket.create_connection((HOST, port), timeout=10) as idle:
+        idle.sendall(b"OS:echo hi")
+        assert ast.literal_eval(idle.recv(65536).decode("utf-8"))["OS_STDOUT"] == "hi"
+        started = time.monotonic()
+        assert idle.recv(65536) == b""  # Closed by the agent
+        assert 0.5 < time.monotonic() - started < 5
@@ -0,0 +1,111 @@
+# Tests of lib/agent_fleet.py: per-host deadlines, the concurrency limit and
+# the summary, against the agent fixture and local servers that misbehave.
+
+import time
+import socket
+import struct
+import threading
+
+import pytest
+
+import agent_fleet
+from conftest import HOST, free_port
+
+
+# ----------------------------------------------------------------------------- misbehaving servers
+@pytest.fixture
+def silent():
+    """ (HOST, port) of a server whose backlog accepts connections and never answers """
+    with socket.socket() as listener:
+        listener.bind((HOST, 0))
+        listener.listen(8)
+        yield HOST, listener.getsockname()[1]
+
+
+@pytest.fixture
+def trickling():
+    """ (HOST, port) of a server that takes the framed protocol, then sends its
+        reply one byte every 0.1s, so no single read ever times out """
+    stop = threading.Event()
+    listener = socket.socket()
+    listener.bind((HOST, 0))
+    listener.listen(8)
+
+    def serve():
+        connection, address = listener.accept()
+        with connection:
+            connection.recv(1024)
+            connection.sendall(b"{'AGENT_MESSAGE': 'PROTOCOL 2'}")
+            connection.recv(1024)
+            connection.sendall(struct.pack("!I", 1000))
+            while not stop.wait(0.1):
+                connection.sendall(b" ")
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield HOST, listener.getsockname()[1]
+    stop.set()
+    thread.join(5)
+    listener.close()
+
+
+# ----------------------------------------------------------------------------- deadline
+def test_silent_host_times_out(agent, silent):
+    started = time.monotonic()
+    results = agent_fleet.run_fleet([agent, silent], "OS:echo up", timeout=1.0)
+    assert time.monotonic() - started < 3
+    assert [r["port"] for r in results] == [agent[1], silent[1]]  # In the order they answered
+    assert results[0]["ok"] and results[0]["reply"]["OS_STDOUT"] == "up"
+    assert not results[1]["ok"] and "timed out" in results[1]["error"].lower()
+
+
+def test_trickling_host_is_cut_at_the_deadline(trickling):
+    started = time.monotonic()
+    results = agent_fleet.run_fleet([trickling], "OS:echo up", timeout=1.0)
+    assert time.monotonic() - started < 2
+    assert results[0]["error"] == "Timed out after 1.0s"
+    assert 1.0 <= results[0]["seconds"] < 2
+
+
+# ----------------------------------------------------------------------------- concurrency
+def test_concurrency_limit(agent):
+    started = time.monotonic()
+    results = agent_fleet.run_fleet([agent] * 4, "OS:sleep 0.5", concurrency=2, timeout=10)
+    assert 1.0 <= time.monotonic() - started < 1.9  # Two rounds of two
+    assert all(r["ok"] for r in results)
+    started = time.monotonic()
+    agent_fleet.run_fleet([agent] * 4, "OS:sleep 0.5", concurrency=4, timeout=10)
+    assert time.monotonic() - started < 0.95
+
+
+def test_results_are_reported_as_hosts_answer(agent):
+    seen = []
+    results = agent_fleet.run_fleet([agent, agent], "OS:sleep 0.3", on_result=seen.append)
+    assert seen == results
+
+
+# ----------------------------------------------------------------------------- summarize()
+def test_summary_lists_failures_and_the_slowest(agent):
+    refused = (HOST, free_port())
+    results = agent_fleet.run_fleet([agent], "OS:sleep 0.3; exit 3")
+    results += agent_fleet.run_fleet([agent, refused], "OS:echo fine")
+    summary = agent_fleet.summarize(results, 1.5, slowest=2)
+    assert (summary["hosts"], summary["ok"], summary["failed"]) == (3, 1, 2)
+    assert summary["wall_seconds"] == 1.5
+    assert summary["host_seconds"] == pytest.approx(sum(r["seconds"] for r in results))
+    assert len(summary["slowest"]) == 2
+    assert summary["slowest"][0]["error"].startswith("OS_RETURNCODE 3")
+    assert summary["slowest"][0]["seconds"] >= summary["slowest"][1]["seconds"]
+    assert sorted(r["port"] for r in summary["failures"]) == sorted([agent[1], refused[1]])
+
+
+def test_names(spawn_agent):
+    from agent_client import AgentConnection
+    port = spawn_agent()
+    connection = AgentConnection(HOST, port)
+    connection.request("TA:setname=web1")
+    connection.close()
+    result = agent_fleet.run_fleet([(HOST, port)], "OS:true", names=True)[0]
+    assert result["name"] == "web1"
+    assert agent_fleet.host_label(result) == "web1 (%s:%d)" % (HOST, port)
+    assert agent_fleet.run_fleet([(HOST, port)], "OS:true")[0]["name"] == ""
@@ -0,0 +1,66 @@
+# Tests of lib/async_load.py: the open-loop schedule and the accounting of
+# failed requests.
+
+import socket
+import statistics
+
+import pytest
+
+import async_load
+from conftest import HOST, free_port
+
+
+# ----------------------------------------------------------------------------- arrival_times()
+def test_fixed_arrivals_are_evenly_spaced():
+    offsets = async_load.arrival_times(4, 2.5)
+    assert offsets == [n * 0.25 for n in range(10)]
+
+
+def test_fixed_arrivals_do_not_overshoot_the_duration():
+    assert len(async_load.arrival_times(3, 1.0)) == 3
+    assert len(async_load.arrival_times(0.5, 10)) == 5
+
+
+def test_poisson_arrivals_keep_the_rate():
+    offsets = async_load.arrival_times(200, 50, "poisson", seed=7)
+    assert offsets == sorted(offsets)
+    assert 0 < offsets[0] and offsets[-1] < 50
+    assert abs(len(offsets) - 200 * 50) < 4 * (200 * 50) ** 0.5  # Within four standard deviations
+    gaps = [b - a for a, b in zip(offsets, offsets[1:])]
+    assert statistics.mean(gaps) == pytest.approx(1 / 200.0, rel=0.05)
+
+
+def test_poisson_arrivals_repeat_with_a_seed():
+    assert async_load.arrival_times(50, 2, "poisson", seed=3) == async_load.arrival_times(50, 2, "poisson", seed=3)
+
+
+def test_bad_arrival_arguments():
+    assert async_load.arrival_times(0, 10) == []
+    assert async_load.arrival_times(10, 0) == []
+    with pytest.raises(ValueError):
+        async_load.arrival_times(10, 1, "bursty")
+
+
+# ----------------------------------------------------------------------------- failed requests
+def test_refused_requests_keep_their_latency():
+    endpoint = "http://%s:%d/hash" % (HOST, free_port())  # Nothing listens there
+    results, usage = async_load.run_load(endpoint, ["a", "b"], start_times=[0.0, 0.05], timeout=2.0)
+    assert [r["post_error"] for r in results] == ["error", "error"]
+    assert all(r["call_ms"] > 0 for r in results)
+
+
+def test_timed_out_requests_keep_their_latency():
+    with socket.socket() as silent:  # Accepts connections and never answers
+        silent.bind((HOST, 0))
+        silent.listen(8)
+        endpoint = "http://%s:%d/hash" % (HOST, silent.getsockname()[1])
+        results, usage = async_load.run_load(endpoint, ["a"], start_times=[0.0], timeout=0.3)
+    assert results[0]["post_error"] == "timeout"
+    assert results[0]["call_ms"] >= 300
+
+
+def test_latency_summary_counts_failures():
+    summary = async_load.latency_summary([1.0, 2.0, 300.0], errors=1, timeouts=1)
+    assert summary["count"] == 3
+    assert summary["max"] == 300.0
+    assert (summary["errors"], summary["timeouts"]) == (1, 1)
@@ -0,0 +1,49 @@
+# Tests of lib/config.py on a copy of conf/target.conf.
+
+import os
+import shutil
+
+import pytest
+
+from config import readConfigFile, writeConfigValue
+from conftest import MY_PATH
+
+TARGET_CONF = os.path.join(MY_PATH, "../conf/target.conf")
+
+
+@pytest.fixture
+def conf(tmp_path):
+    """ Path of a scratch copy of conf/target.conf """
+    path = str(tmp_path / "target.conf")
+    shutil.copy(TARGET_CONF, path)
+    return path
+
+
+# ----------------------------------------------------------------------------- writeConfigValue()
+def test_write_then_read_round_trip(conf):
+    before = open(conf).read()
+    assert writeConfigValue(conf, "network_latency", "0.25")
+    values = readConfigFile(conf)
+    assert values["network_latency"] == "0.25"
+    assert values == dict(readConfigFile(TARGET_CONF), network_latency="0.25")
+    after = open(conf).read()
+    assert after.count("\n") == before.count("\n")  # Rewritten in place
+    assert "network_latency       0.25\n" in after  # Keeping the column
+
+
+def test_missing_key_is_appended(conf):
+    assert writeConfigValue(conf, "client_timeout", "7")
+    assert readConfigFile(conf)["client_timeout"] == "7"
+    assert open(conf).read().endswith("client_timeout 7")
+    assert writeConfigValue(conf, "client_timeout", "8")
+    assert open(conf).read().count("client_timeout") == 1
+
+
+def test_comments_are_not_keys(conf):
+    assert writeConfigValue(conf, "Config", "x")
+    assert open(conf).read().startswith("# Config file for the target to be tested\n")
+    assert readConfigFile(conf)["Config"] == "x"
+
+
+def test_unwritable_file(tmp_path):
+    assert writeConfigValue(str(tmp_path / "missing" / "target.conf"), "port", "1") is False
@@ -0,0 +1,105 @@
+# Tests of lib/http_pool.py: one Session per thread over one shared adapter,
+# and the reuse counters, against a local keep-alive HTTP stub.
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import http_pool
+from conftest import HOST
+
+
+# ----------------------------------------------------------------------------- stub server
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """ Answers every GET and POST with "ok", keeping the connection open """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    """ Base URL of the stub server; the pools start empty """
+    server = ThreadingHTTPServer((HOST, 0), KeepAliveHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    http_pool.configure()
+    yield "http://%s:%d" % (HOST, server.server_address[1])
+    http_pool.configure()  # Closes the pooled connections
+    server.shutdown()
+    server.server_close()
+
+
+def in_thread(function):
+    """ Runs function in a new thread and returns what it returned """
+    returned = []
+    thread = threading.Thread(target=lambda: returned.append(function()))
+    thread.start()
+    thread.join(30)
+    return returned[0]
+
+
+# ----------------------------------------------------------------------------- session()
+def test_one_session_per_thread_over_one_adapter(stub):
+    mine = http_pool.session()
+    assert http_pool.session() is mine
+    theirs = in_thread(http_pool.session)
+    assert theirs is not mine
+    assert theirs.get_adapter(stub) is mine.get_adapter(stub)
+
+
+def test_configure_replaces_the_sessions(stub):
+    before = http_pool.session()
+    adapter = http_pool.configure(pool_size=2)
+    assert http_pool.session() is not before
+    assert http_pool.session().get_adapter(stub) is adapter
+
+
+# ----------------------------------------------------------------------------- pool_stats()
+def test_requests_reuse_one_connection(stub):
+    assert http_pool.post(stub + "/hash", data="secret").text == "ok"
+    for n in range(4):
+        assert http_pool.get(stub + "/stats").status_code == 200
+    stats = http_pool.pool_stats()
+    assert (stats["connections"], stats["requests"], stats["reused"]) == (1, 5, 4)
+    assert stats["hosts"] == {stub: {"connections": 1, "requests": 5, "reused": 4}}
+
+
+def test_threads_share_the_pool(stub):
+    http_pool.configure(pool_size=4, block=True)
+    start = threading.Barrier(4)
+
+    def client():
+        start.wait()
+        for n in range(5):
+            http_pool.get(stub + "/stats")
+
+    threads = [threading.Thread(target=client) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    stats = http_pool.pool_stats()
+    assert stats["requests"] == 20
+    assert 1 <= stats["connections"] <= 4  # Never more than pool_size with block=True
+    assert stats["reused"] == 20 - stats["connections"]
+
+
+def test_show_pool_stats(stub, capsys):
+    http_pool.get(stub)
+    http_pool.get(stub)
+    http_pool.show_pool_stats()
+    assert capsys.readouterr().out == "HTTP connections: 1 opened for 2 requests, 1 reused (50.0%)\n"